@@ -0,0 +1,8 @@
+"""asv benchmarks for hax.
+
+Run them with `asv run` from the repository root (see asv.conf.json); results are stored in .asv/results,
+so you can compare commits with `asv compare` or `asv continuous`, and browse the history with `asv publish`.
+
+Most benchmarks use synthetic events and minitrees (see hax.event_sources), at several scales.
+Set HAX_BENCHMARK_MAX_EVENTS to skip the larger scales, e.g. on a laptop.
+"""
@@ -0,0 +1,34 @@
+"""Benchmarks of the cost of starting up hax: importing it and calling hax.init.
+
+Each benchmark runs in a fresh interpreter (asv timeraw_), so module import caches don't hide anything.
+"""
+
+# Options that let hax.init run outside an analysis facility, without access to the runs database
+INIT_OPTIONS = "pax_version_policy='loose', use_runs_db=False, corrections=[]"
+
+
+class TimeStartup:
+
+    def timeraw_import(self):
+        return """
+        import hax
+        """
+
+    def timeraw_init_lazy(self):
+        return """
+        import hax
+        hax.init(lazy_init=True, %s)
+        """ % INIT_OPTIONS
+
+    def timeraw_init_eager(self):
+        return """
+        import hax
+        hax.init(lazy_init=False, %s)
+        """ % INIT_OPTIONS
+
+    def timeraw_init_and_load_treemakers(self):
+        return """
+        import hax
+        hax.init(lazy_init=True, %s)
+        hax.minitrees.TREEMAKERS
+        """ % INIT_OPTIONS
@@ -0,0 +1,76 @@
+"""Benchmarks of working with minitrees: merging, cuts, saving and loading"""
+import os
+import shutil
+import tempfile
+
+import hax
+from hax import cuts, minitree_formats
+
+from .common import EVENT_SCALES, skip_if_too_large, synthetic_minitree, init_synthetic
+
+
+class TimeMerge:
+    params = EVENT_SCALES
+    param_names = ['n_events']
+    timeout = 600
+
+    def setup(self, n_events):
+        skip_if_too_large(n_events)
+        self.mt1 = synthetic_minitree(n_events, ['s1', 's2', 'x', 'y', 'z'])
+        self.mt2 = synthetic_minitree(n_events, ['s1', 'cs1', 'cs2', 'drift_time'], seed=1)
+
+    def time_merge_minitrees(self, n_events):
+        hax.minitrees._merge_minitrees(self.mt1, self.mt2)
+
+
+class TimeCuts:
+    params = EVENT_SCALES
+    param_names = ['n_events']
+    timeout = 600
+
+    def setup(self, n_events):
+        skip_if_too_large(n_events)
+        init_synthetic()
+        self.d = synthetic_minitree(n_events, ['s1', 's2', 'x', 'y', 'z'])
+
+    def time_selection(self, n_events):
+        cuts.selection(self.d, self.d['s1'] > 1000, desc='s1 above 1000')
+
+    def time_range_selections(self, n_events):
+        cuts.range_selections(self.d, ('s1', (10, 5000)), ('s2', (100, 1e5)), ('z', (10, 2000)))
+
+    def time_eval_selection(self, n_events):
+        cuts.eval_selection(self.d, '(s1 > 10) & (s2 > 100 * s1) & (x**2 + y**2 < 1e6)')
+
+
+class TimeFormats:
+    params = (EVENT_SCALES, ['pklz', 'root'])
+    param_names = ['n_events', 'format']
+    timeout = 1200
+
+    def setup(self, n_events, fmt):
+        skip_if_too_large(n_events)
+        if fmt == 'root':
+            minitree_formats._import_root()
+            if minitree_formats.ROOT is None:
+                raise NotImplementedError("ROOT not available")
+        init_synthetic()
+        self.tempdir = tempfile.mkdtemp()
+        self.treemaker = hax.minitrees.TREEMAKERS['Basics']
+        self.data = synthetic_minitree(n_events, ['s1', 's2', 'x_pax', 'y_pax', 'z', 'drift_time',
+                                                  'largest_other_s1', 'largest_other_s2'])
+        self.path = os.path.join(self.tempdir, 'load_me.' + fmt)
+        minitree_formats.get_format(self.path, self.treemaker).save_data({}, self.data)
+
+    def teardown(self, n_events, fmt):
+        shutil.rmtree(self.tempdir)
+
+    def time_save(self, n_events, fmt):
+        path = os.path.join(self.tempdir, 'save_me.' + fmt)
+        minitree_formats.get_format(path, self.treemaker).save_data({}, self.data)
+
+    def time_load(self, n_events, fmt):
+        minitree_formats.get_format(self.path, self.treemaker).load_data()
+
+    def time_load_metadata(self, n_events, fmt):
+        minitree_formats.get_format(self.path, self.treemaker).load_metadata()
@@ -0,0 +1,32 @@
+"""Benchmarks of the runs database utilities, for the synthetic datasets"""
+import hax
+
+from .common import RUN_SCALES, init_synthetic
+
+
+class TimeRuns:
+    params = RUN_SCALES
+    param_names = ['n_runs']
+
+    def setup(self, n_runs):
+        init_synthetic(n_runs=n_runs)
+        self.names = hax.runs.datasets['name'].values.tolist()
+        self.numbers = hax.runs.datasets['number'].values.tolist()
+
+    def time_update_datasets(self, n_runs):
+        hax.runs.update_datasets()
+
+    def time_get_run_number(self, n_runs):
+        for name in self.names:
+            hax.runs.get_run_number(name)
+
+    def time_get_run_name(self, n_runs):
+        for number in self.numbers:
+            hax.runs.get_run_name(number)
+
+    def time_tags_selection(self, n_runs):
+        # Only exclude: tag selections with include also query the runs database for the tag version
+        hax.runs.tags_selection(exclude=['bad', 'messy'])
+
+    def time_is_blind_many(self, n_runs):
+        hax.unblinding.is_blind_many(self.names)
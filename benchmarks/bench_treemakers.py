@@ -0,0 +1,89 @@
+"""Benchmarks of making minitrees (event loop throughput per treemaker).
+
+By default these run on synthetic runs of each size in EVENT_SCALES (see hax.event_sources). To benchmark on a
+real processed run instead, set the HAX_BENCHMARK_RUN environment variable to its name (or the path of the root
+file, without .root); then only the smallest scale runs.
+"""
+import os
+
+import numpy as np
+
+import hax
+
+from .common import EVENT_SCALES, init_synthetic, skip_if_too_large
+
+
+def _init(n_events):
+    """hax.init for the benchmark run, return its name"""
+    skip_if_too_large(n_events)
+    run = os.environ.get('HAX_BENCHMARK_RUN')
+    if run:
+        if n_events != EVENT_SCALES[0]:
+            raise NotImplementedError("The real run is only benchmarked once, at the smallest scale")
+        hax.init(pax_version_policy='loose', tqdm_on=False, minitree_caching=False,
+                 main_data_paths=['.', os.path.dirname(run) or '.'])
+        return os.path.basename(run)
+    init_synthetic(n_events=n_events)
+    return hax.runs.datasets['name'].values[0]
+
+
+class TimeVectorTreeMakers:
+    params = (['Fundamentals', 'Basics', 'TotalProperties'], [True, False], EVENT_SCALES)
+    param_names = ['treemaker', 'columnar', 'n_events']
+    timeout = 3600
+
+    def setup(self, treemaker, columnar, n_events):
+        self.run = _init(n_events)
+        self.treemaker_class = hax.minitrees.TREEMAKERS[treemaker]
+
+    def time_get_data(self, treemaker, columnar, n_events):
+        tm = self.treemaker_class()
+        tm.columnar = columnar
+        tm.get_data(self.run)
+
+
+class TimeTreeMakers:
+    params = (['Extended', 'LargestPeakProperties', 'TimeDifferences'], EVENT_SCALES)
+    param_names = ['treemaker', 'n_events']
+    timeout = 3600
+
+    def setup(self, treemaker, n_events):
+        self.run = _init(n_events)
+        self.treemaker_class = hax.minitrees.TREEMAKERS[treemaker]
+
+    def time_get_data(self, treemaker, n_events):
+        self.treemaker_class().get_data(self.run)
+
+
+class TimeProximity:
+    """Proximity's computation, with synthetic acquisition monitor pulses (so without reading AQM data)"""
+    params = [10 ** 4, 10 ** 5]
+    param_names = ['n_events']
+    timeout = 3600
+
+    def setup(self, n_events):
+        skip_if_too_large(n_events)
+        init_synthetic(n_events=n_events)
+        run = hax.runs.datasets['name'].values[0]
+        data = hax.minitrees.load_single_minitree(run, 'Fundamentals')
+        self.event_numbers = data['event_number'].values
+        self.event_duration = data['event_duration'].values
+        self.center_time = data['event_time'].values + self.event_duration // 2
+        rng = np.random.RandomState(0)
+        t0, t1 = self.center_time[0], self.center_time[-1]
+
+        try:
+            self.tm = hax.minitrees.TREEMAKERS['Proximity']()
+        except ImportError:
+            # hax.treemakers.trigger needs pax
+            raise NotImplementedError
+        self.tm.run_number = 0
+        self.tm.search_these = ([(label, np.sort(rng.randint(t0, t1, 1000)))
+                                 for label in self.tm.aqm_labels] +
+                                [(boundary + 'pe_event', self.center_time[::10])
+                                 for boundary in ['1e5', '3e5', '1e6']] +
+                                [('event', self.center_time)])
+        self.tm.s2s = rng.exponential(1e4, n_events)
+
+    def time_compute_proximity(self, n_events):
+        self.tm.compute_proximity(self.event_numbers, self.center_time, self.event_duration)
@@ -0,0 +1,40 @@
+"""Helpers shared by the benchmarks"""
+import os
+
+import numpy as np
+import pandas as pd
+
+import hax
+
+# Number of events for benchmarks of dataframe operations (merging, cuts, saving and loading)
+EVENT_SCALES = [10 ** 4, 10 ** 6, 10 ** 7]
+
+# Number of runs for benchmarks of run-level operations
+RUN_SCALES = [10, 1000]
+
+
+def skip_if_too_large(n_events):
+    """Skip the benchmark (asv skips benchmarks whose setup raises NotImplementedError)
+    if n_events is larger than the HAX_BENCHMARK_MAX_EVENTS environment variable.
+    """
+    max_events = os.environ.get('HAX_BENCHMARK_MAX_EVENTS')
+    if max_events is not None and n_events > int(max_events):
+        raise NotImplementedError("Skipping benchmark with %d events" % n_events)
+
+
+def init_synthetic(n_runs=1, n_events=10000, **kwargs):
+    """hax.init for the synthetic event source, without progress bars or saving minitrees"""
+    options = dict(pax_version_policy='loose', tqdm_on=False, minitree_caching=False, print_passthrough_info=False,
+                   event_source='synthetic', synthetic_datasets=dict(n_runs=n_runs, n_events=n_events, seed=0))
+    options.update(kwargs)
+    hax.init(**options)
+
+
+def synthetic_minitree(n_events, columns, n_runs=1, seed=0):
+    """Return a DataFrame like a minitree, with run_number, event_number and random float columns"""
+    rng = np.random.RandomState(seed)
+    data = dict(run_number=np.repeat(np.arange(n_runs), n_events // n_runs + 1)[:n_events],
+                event_number=np.arange(n_events) % (n_events // n_runs + 1))
+    for c in columns:
+        data[c] = rng.exponential(1000, n_events)
+    return pd.DataFrame(data, columns=['run_number', 'event_number'] + list(columns))
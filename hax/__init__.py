@@ -1,18 +1,33 @@
+from collections import OrderedDict
+import importlib
 import logging
 import os
 import inspect
+import sys
 from configparser import ConfigParser
 import socket
-import numba  # flake8: noqa: F401
-from . import misc, minitrees, paxroot, pmt_plot, raw_data, runs, utils, treemakers, data_extractor, slow_control, \
-    trigger_data, ipython, recorrect, unblinding  # flake8: noqa: F401
+import threading
 __version__ = '2.4.0'
 
 
 # Stitch the package together
-# I am surprised this works (even if we do 'from hax' instead of 'from .')
-# as some of the modules do 'import hax' or 'from hax.foo import bar'.. shouldn't we get circular imports??
-# I need to read up on python packaging more...
+# The submodules are only imported when you first access them (e.g. hax.minitrees), see __getattr__ below.
+# Several of them pull in heavy dependencies (ROOT, pax, matplotlib, dask...) that many jobs never need.
+submodules = ('misc', 'minitrees', 'paxroot', 'pmt_plot', 'raw_data', 'runs', 'utils', 'treemakers',
+              'data_extractor', 'slow_control', 'trigger_data', 'ipython', 'recorrect', 'unblinding',
+              'cuts', 'minitree_formats', 'corrections_handler', 'jagged',
+              'event_sources', 'profiling', 'expressions', 'cut_booleans')
+
+
+def __getattr__(name):
+    if name in submodules:
+        return importlib.import_module('hax.' + name)
+    raise AttributeError("module 'hax' has no attribute '%s'" % name)
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(submodules))
+
 
 # Store the directory of hax (i.e. this file's directory) as HAX_DIR
 hax_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -23,6 +38,22 @@ hax_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()
 # Just do import hax, then hax.init(), then access config has hax.config.
 config = {}
 
+# Initialization stages: (module, function) to call for each stage.
+# hax.init() does not run these right away (unless you set lazy_init = False): instead each stage is run
+# the first time something needs it, see require().
+init_stages = OrderedDict([
+    ('corrections', ('runs', 'load_corrections')),
+    ('datasets', ('runs', 'update_datasets')),
+    ('treemakers', ('minitrees', 'update_treemakers')),
+    ('slow_control', ('slow_control', 'init_sc_interface')),
+])
+
+# Stages that haven't been run since the last hax.init()
+pending_init_stages = []
+
+# Held while running init stages, so other threads wait for a stage to finish rather than see it half-done
+_init_lock = threading.RLock()
+
 log = logging.getLogger('hax.__init__')
 
 
@@ -65,11 +96,15 @@ def init(filename=None, **kwargs):
     if "raw_data_local_path" in config and isinstance(config["raw_data_local_path"], str):
         config["raw_data_local_path"] = [config["raw_data_local_path"]]
 
-    # Call some inits of the submodules
-    runs.load_corrections()
-    runs.update_datasets()
-    minitrees.update_treemakers()
-    slow_control.init_sc_interface()
+    # Schedule the inits of the submodules. Forget anything computed by a previous init.
+    global pending_init_stages
+    pending_init_stages = list(init_stages.keys())
+    for module_name in submodules:
+        module = sys.modules.get('hax.' + module_name)
+        for attribute_name in getattr(module, 'lazy_attributes', {}):
+            module.__dict__.pop(attribute_name, None)
+    if not config.get('lazy_init', True):
+        require(*init_stages.keys())
 
     if not config['cax_key'] or config['cax_key'] == 'sorry_I_dont_have_one':
         log.warning("You're not at a XENON analysis facility, or hax can't detect at which analysis facility you are.")
@@ -80,4 +115,38 @@ def init(filename=None, **kwargs):
             )
 
     # Setup unblinding selection
-    unblinding.make_unblinding_selection()
+    importlib.import_module('hax.unblinding').make_unblinding_selection()
+
+
+def require(*stages):
+    """Run the initialization stages (see init_stages) that have not yet been run since the last hax.init().
+    You should never have to call this yourself: hax calls it when it first needs e.g. the datasets or treemakers.
+    """
+    with _init_lock:
+        for stage in stages:
+            if stage not in pending_init_stages:
+                continue
+            # Remove the stage first, in case it (indirectly) requires itself
+            pending_init_stages.remove(stage)
+            module_name, function_name = init_stages[stage]
+            log.debug("Running hax init stage %s" % stage)
+            try:
+                getattr(importlib.import_module('hax.' + module_name), function_name)()
+            except Exception:
+                pending_init_stages.append(stage)
+                raise
+
+
+def get_lazy_attribute(module_name, attribute_name):
+    """Return the value of the lazily initialized attribute attribute_name of the hax submodule module_name.
+    Runs the init stage that sets it if needed. Hax submodules call this in their module-level __getattr__,
+    using their lazy_attributes dictionary {attribute_name: (init stage, function returning the default value)}.
+    """
+    module = sys.modules['hax.' + module_name]
+    stage, default = module.lazy_attributes[attribute_name]
+    with _init_lock:
+        require(stage)
+        if attribute_name not in module.__dict__:
+            # Stage did not set the attribute (or hax.init() was never called)
+            module.__dict__[attribute_name] = default()
+    return module.__dict__[attribute_name]
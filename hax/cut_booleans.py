@@ -0,0 +1,288 @@
+"""Cut booleans stored per run, so cuts (e.g. lax lichens) are evaluated once rather than in every session.
+
+For each run and cut, we store whether each event passes the cut as a bit-packed boolean array in an npz file
+next to the minitrees, named by the cut's name and version. Selecting on stored cuts then only takes loading
+these (tiny) arrays: several cuts are combined by a bitwise AND of the packed bits.
+
+    d = hax.minitrees.load(runs)
+    d = hax.cut_booleans.apply_lichen(d, ['S1SingleScatter', 'S2Threshold'])
+    d = hax.cut_booleans.apply(d, [hax.cut_booleans.expression_cut('LowEnergy', 'cs1 < 200')])
+
+The first time, the cuts are evaluated on the minitrees of the cut_boolean_treemakers (a hax.ini option).
+If one of these treemakers gets a new version, or the cut gets a new version, the cut booleans are remade.
+Since these minitrees are loaded with the blinding cut (for blinded runs), blinded events never pass stored cuts.
+"""
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+import hax
+from hax import cuts, runs
+from .utils import find_file_in_folders, get_user_id
+
+log = logging.getLogger('hax.cut_booleans')
+
+# Cut booleans loaded in this session, by (run name, cut key)
+_cache = {}
+
+
+class StoredCut(object):
+    """A cut whose booleans can be stored per run.
+    :param name: name of the cut (used in the cut history and the filename)
+    :param version: version of the cut. Cut booleans stored for another version are remade.
+    :param evaluate: function taking a dataframe (which it may change), returning a boolean array or Series
+    :param desc: description for the cut history, defaults to 'name vversion'
+    """
+
+    def __init__(self, name, version, evaluate, desc=None):
+        self.name = name
+        self.version = str(version)
+        self.evaluate = evaluate
+        self.desc = desc if desc is not None else '%s v%s' % (name, version)
+
+    def __repr__(self):
+        return 'StoredCut(%s)' % self.desc
+
+    @property
+    def key(self):
+        """Name and version of the cut, usable in a filename"""
+        return re.sub(r'[^\w.\-]', '_', '%s_v%s' % (self.name, self.version))
+
+
+def lichen_cuts(lichen_names, lichen_file='sciencerun1', deep=False):
+    """Return list of StoredCuts for the lax lichen(s) lichen_names from the lichen_file.
+    :param deep: if True (default False), return the sub-lichens instead
+    """
+    if isinstance(lichen_names, str):
+        lichen_names = [lichen_names]
+    try:
+        import lax
+    except ImportError:
+        print("You don't seem to have lax. A wise man once said software works better after you install it.")
+        raise
+
+    result = []
+    for lichen_name in lichen_names:
+        lichen = getattr(getattr(lax.lichens, lichen_file), lichen_name)()
+        for sub_lichen in (lichen.lichen_list if deep else [lichen]):
+            l_name = sub_lichen.__class__.__name__
+            # Same description as cuts.apply_lichen, so the cut histories are interchangeable
+            if hasattr(lichen, 'version'):
+                version, desc = str(sub_lichen.version), l_name + ' v' + str(sub_lichen.version)
+            else:
+                version, desc = 'lax' + lax.__version__, l_name + ' (lax v%s)' % lax.__version__
+            result.append(StoredCut(l_name, version, _LichenEvaluator(sub_lichen, l_name), desc=desc))
+    return result
+
+
+class _LichenEvaluator(object):
+    """Evaluate a lichen on a dataframe (adding the lichen's columns to it)"""
+
+    def __init__(self, lichen, name):
+        self.lichen = lichen
+        self.name = name
+
+    def __call__(self, data):
+        return getattr(self.lichen.process(data), 'Cut' + self.name)
+
+
+def expression_cut(name, eval_string, version=None):
+    """Return StoredCut selecting events for which eval_string (in pandas.DataFrame.eval syntax) is True.
+    :param version: version of the cut. Defaults to a hash of eval_string, so changing the string remakes the cut.
+    """
+    if version is None:
+        version = hashlib.md5(eval_string.encode()).hexdigest()[:8]
+    return StoredCut(name, version,
+                     lambda data: hax.expressions.evaluate(data, eval_string),
+                     desc='%s v%s (%s)' % (name, version, eval_string))
+
+
+class CutBooleans(object):
+    """Whether the events of one run pass a cut, as bits packed with np.packbits.
+    :param event_numbers: sorted event numbers of the events the cut was evaluated on
+    :param bits: packed booleans, bit i is whether event_numbers[i] passes
+    """
+
+    def __init__(self, event_numbers, bits, metadata=None):
+        self.event_numbers = np.asarray(event_numbers, dtype=np.int64)
+        self.bits = np.asarray(bits, dtype=np.uint8)
+        self.metadata = metadata or {}
+
+    @classmethod
+    def from_booleans(cls, event_numbers, booleans, metadata=None):
+        event_numbers = np.asarray(event_numbers, dtype=np.int64)
+        booleans = np.asarray(booleans, dtype=np.bool_)
+        order = np.argsort(event_numbers, kind='mergesort')
+        return cls(event_numbers[order], np.packbits(booleans[order]), metadata)
+
+    def __len__(self):
+        return len(self.event_numbers)
+
+    def __and__(self, other):
+        if not np.array_equal(self.event_numbers, other.event_numbers):
+            # Evaluated on different events, e.g. because some minitrees were remade in between
+            combined = self.booleans_for(other.event_numbers) & other.booleans()
+            return CutBooleans(other.event_numbers, np.packbits(combined))
+        return CutBooleans(self.event_numbers, self.bits & other.bits)
+
+    def booleans(self):
+        """Return boolean array, whether each event in self.event_numbers passes"""
+        return np.unpackbits(self.bits, count=len(self)).astype(np.bool_)
+
+    def booleans_for(self, event_numbers):
+        """Return boolean array, whether each event in event_numbers passes. Unknown events do not pass."""
+        event_numbers = np.asarray(event_numbers, dtype=np.int64)
+        if not len(self):
+            return np.zeros(len(event_numbers), dtype=np.bool_)
+        index = np.clip(np.searchsorted(self.event_numbers, event_numbers), 0, len(self) - 1)
+        found = self.event_numbers[index] == event_numbers
+        return self.booleans()[index] & found
+
+    def save(self, path):
+        np.savez(path, event_number=self.event_numbers, bits=self.bits,
+                 metadata=np.array(json.dumps(self.metadata)))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['event_number'], f['bits'], json.loads(str(f['metadata'])))
+
+
+def _filename(run_name, cut):
+    return '%s_CutBooleans_%s.npz' % (run_name, cut.key)
+
+
+def _treemaker_versions(treemakers):
+    return {name: str(tm.__version__)
+            for name, tm in [hax.minitrees.get_treemaker_name_and_class(t) for t in treemakers]}
+
+
+def _get_treemakers(treemakers):
+    if treemakers is None:
+        treemakers = hax.config['cut_boolean_treemakers']
+    if isinstance(treemakers, (type, str)):
+        treemakers = [treemakers]
+    return treemakers
+
+
+def check(run_id, cut, treemakers=None):
+    """Return path to up-to-date stored booleans of cut for run_id, or None if they have to be (re)made"""
+    treemakers = _get_treemakers(treemakers)
+    try:
+        path = find_file_in_folders(_filename(runs.get_run_name(run_id), cut), hax.config['minitree_paths'])
+    except FileNotFoundError:
+        return None
+    with np.load(path) as f:
+        metadata = json.loads(str(f['metadata']))
+    if metadata.get('treemaker_versions') != _treemaker_versions(treemakers):
+        log.debug("Cut booleans %s were made from other minitree versions, will be remade" % path)
+        return None
+    return path
+
+
+def make_cut_booleans(run_id, stored_cuts, treemakers=None, save_file=None):
+    """Evaluate stored_cuts on the minitrees of run_id, return list of CutBooleans.
+    The minitrees are loaded only once for all cuts.
+    :param treemakers: treemakers to load the minitrees of. Defaults to the cut_boolean_treemakers option.
+    :param save_file: save the cut booleans to disk. Defaults to the minitree_caching option.
+    """
+    treemakers = _get_treemakers(treemakers)
+    if save_file is None:
+        save_file = hax.config['minitree_caching']
+    run_name = runs.get_run_name(run_id)
+
+    # We own this dataframe, so the cuts can add columns to it without copying it
+    data, _ = hax.minitrees.load_single_dataset(run_id, treemakers)
+    metadata = dict(treemaker_versions=_treemaker_versions(treemakers),
+                    pax_version=hax.paxroot.get_metadata(run_id)['file_builder_version'],
+                    hax_version=hax.__version__,
+                    created_by=get_user_id(),
+                    timestamp=str(datetime.now()))
+
+    result = []
+    for cut in stored_cuts:
+        log.debug("Evaluating cut %s on run %s" % (cut.desc, run_name))
+        booleans = CutBooleans.from_booleans(data['event_number'].values, cut.evaluate(data),
+                                             metadata=dict(metadata, cut=cut.name, version=cut.version,
+                                                           desc=cut.desc))
+        if save_file:
+            creation_dir = hax.config['minitree_paths'][0]
+            if not os.path.exists(creation_dir):
+                os.makedirs(creation_dir)
+            booleans.save(os.path.join(creation_dir, _filename(run_name, cut)))
+        _cache[(run_name, cut.key)] = booleans
+        result.append(booleans)
+    return result
+
+
+def load_cut_booleans(run_id, stored_cuts, treemakers=None, force_reload=False):
+    """Return list of CutBooleans of stored_cuts for run_id, making those that are not available
+    :param force_reload: always remake the cut booleans, never load them from disk.
+    """
+    run_name = runs.get_run_name(run_id)
+    result = {}
+    to_make = []
+    for cut in stored_cuts:
+        if not force_reload and (run_name, cut.key) in _cache:
+            result[cut.key] = _cache[(run_name, cut.key)]
+            continue
+        path = None if force_reload else check(run_id, cut, treemakers)
+        if path is None:
+            to_make.append(cut)
+            continue
+        result[cut.key] = _cache[(run_name, cut.key)] = CutBooleans.load(path)
+
+    if to_make:
+        if not hax.config['make_minitrees']:
+            raise hax.minitrees.NoMinitreeAvailable(
+                "Cut booleans %s for run %s not available and make_minitrees is False" %
+                (', '.join([c.desc for c in to_make]), run_name))
+        for cut, booleans in zip(to_make, make_cut_booleans(run_id, to_make, treemakers)):
+            result[cut.key] = booleans
+    return [result[cut.key] for cut in stored_cuts]
+
+
+def _row_booleans(data, stored_cuts, treemakers=None, force_reload=False):
+    """Return boolean array, whether each row of data passes all stored_cuts"""
+    run_numbers = np.asarray(data['run_number'])
+    event_numbers = np.asarray(data['event_number'])
+    result = np.zeros(len(run_numbers), dtype=np.bool_)
+    for run_number in np.unique(run_numbers):
+        in_run = run_numbers == run_number
+        booleans = load_cut_booleans(int(run_number), stored_cuts, treemakers, force_reload)
+        combined = booleans[0]
+        for b in booleans[1:]:
+            combined = combined & b
+        result[in_run] = combined.booleans_for(event_numbers[in_run])
+    return result
+
+
+def apply(data, stored_cuts, combine=False, treemakers=None, force_reload=False, **kwargs):
+    """Select rows of data (with run_number and event_number columns) passing stored_cuts,
+    using the stored cut booleans (evaluating the cuts if needed).
+    :param stored_cuts: StoredCut or list of StoredCuts, see lichen_cuts and expression_cut
+    :param combine: if True, do one selection with all cuts (a bitwise AND of their booleans).
+                    If False (default), do a selection per cut, so each gets its line in the cut history.
+    :param kwargs: passed to hax.cuts.selection. data can also be a hax.cuts.CutPipeline.
+    """
+    if isinstance(stored_cuts, StoredCut):
+        stored_cuts = [stored_cuts]
+    if combine:
+        kwargs.setdefault('desc', ' & '.join([c.desc for c in stored_cuts]))
+        return cuts.selection(data, _row_booleans(data, stored_cuts, treemakers, force_reload), **kwargs)
+    for cut in stored_cuts:
+        data = cuts.selection(data, _row_booleans(data, [cut], treemakers, force_reload), desc=cut.desc, **kwargs)
+    return data
+
+
+def apply_lichen(data, lichen_names, lichen_file='sciencerun1', deep=False, **kwargs):
+    """Apply cuts defined by the lax lichen(s) lichen_names from the lichen_file to data, like
+    hax.cuts.apply_lichen, but using stored cut booleans. See apply for the other options.
+    :param deep: if True (default False), apply sub-lichens explicitly
+    """
+    return apply(data, lichen_cuts(lichen_names, lichen_file=lichen_file, deep=deep), **kwargs)
@@ -1,10 +1,13 @@
 """Helper functions for doing cuts/selections on dataframes,
 while printing out the passthrough info.
+
+Every selection on a pandas DataFrame copies the selected rows. If you do many cuts on a big dataframe,
+wrap it in a CutPipeline first: selections on it only update a boolean mask, and the selected rows are copied
+once, when you call materialize().
 """
 import pandas as pd
 import numpy as np
-import dask
-import dask.dataframe
+import sys
 
 # Unlike most hax modules, this doesn't require init()
 import hax
@@ -20,10 +23,17 @@ UNNAMED_DESCRIPTION = 'Unnamed'
 
 
 def history(d):
-    """Return pandas dataframe describing cuts history on dataframe."""
+    """Return pandas dataframe describing cuts history on dataframe.
+    For a dask dataframe, this computes the passthrough counts (but not the dataframe itself).
+    Use cuts.compute to get both in one pass.
+    """
     if not hasattr(d, 'cut_history'):
         raise ValueError("Cut history for this data not available.")
-    hist = pd.DataFrame(d.cut_history, columns=['selection_desc', 'n_before', 'n_after'])
+    cut_history = d.cut_history
+    if isinstance(cut_history, DelayedCutHistory):
+        import dask
+        cut_history = cut_history.combine(dask.compute(*cut_history.partition_histories), quiet=True)
+    hist = pd.DataFrame(cut_history, columns=['selection_desc', 'n_before', 'n_after'])
     hist['n_removed'] = hist.n_before - hist.n_after
     hist['fraction_passed'] = hist.n_after / hist.n_before
     hist['cumulative_fraction_left'] = hist.n_after / hist.iloc[0].n_before
@@ -38,8 +48,15 @@ def _get_history(d):
 
 def record_combined_histories(d, partial_histories, quiet=None):
     """Record history for dataframe d by combining list of dictionaries partial_histories"""
+    d.cut_history = _combine_histories(partial_histories, quiet=quiet)
+
+
+def _combine_histories(partial_histories, quiet=None):
+    """Return history combining the list of dictionaries partial_histories, see record_combined_histories"""
     if quiet is None:
         quiet = not hax.config.get('print_passthrough_info', False)
+    if not len(partial_histories):
+        return []
 
     new_history = []
     # Loop over cuts
@@ -50,7 +67,68 @@ def record_combined_histories(d, partial_histories, quiet=None):
         if not quiet:
             print(passthrough_message(q))
         new_history.append(q)
-    d.cut_history = new_history
+    return new_history
+
+
+class DelayedCutHistory(object):
+    """Cut history of a dask dataframe. For each partition, partition_histories has a dask.delayed list
+    of dictionaries with selection_desc, n_before and n_after, like the cut_history of a pandas dataframe.
+    Selections add the passthrough counts of each partition to the dask graph, so they are computed
+    together with the dataframe (see cuts.compute).
+    """
+
+    def __init__(self, partition_histories, descriptions=()):
+        self.partition_histories = list(partition_histories)
+        self.descriptions = list(descriptions)
+
+    def __repr__(self):
+        return 'DelayedCutHistory(%d partitions, %d cuts)' % (len(self.partition_histories), len(self.descriptions))
+
+    @classmethod
+    def for_frame(cls, d):
+        """Return empty DelayedCutHistory for dask dataframe d"""
+        import dask
+        return cls([dask.delayed([]) for _ in range(d.npartitions)])
+
+    def add(self, desc, d_before, d_after):
+        """Return new DelayedCutHistory, with the selection desc that turned d_before into d_after added"""
+        import dask
+        # Count the rows of each partition directly: map_partitions(len) gives a one-element Series per partition
+        n_before = [dask.delayed(len)(p) for p in d_before.to_delayed()]
+        n_after = [dask.delayed(len)(p) for p in d_after.to_delayed()]
+        if not len(n_before) == len(n_after) == len(self.partition_histories):
+            raise ValueError("Selection changed the number of partitions, can't track the cut history")
+        return DelayedCutHistory([dask.delayed(_add_passthrough)(h, desc, before, after)
+                                  for h, before, after in zip(self.partition_histories, n_before, n_after)],
+                                 self.descriptions + [desc])
+
+    def combine(self, computed_histories, quiet=None):
+        """Return history combining the computed partition_histories"""
+        # Partitions with missing minitrees have empty histories: they have no events, so we can skip them.
+        n_cuts = max([len(h) for h in computed_histories] + [0])
+        return _combine_histories([h for h in computed_histories if len(h) == n_cuts], quiet=quiet)
+
+
+def _add_passthrough(partition_history, desc, n_before, n_after):
+    return partition_history + [dict(selection_desc=desc, n_before=n_before, n_after=n_after)]
+
+
+def compute(d, quiet=None, **kwargs):
+    """Return pandas dataframe computed from dask dataframe d, with its cut history.
+    The passthrough counts of the cuts are computed in the same pass as the dataframe.
+    :param quiet: prints passthrough info if False, not if True.
+    :param kwargs: passed to dask.compute (e.g. scheduler)
+    """
+    import dask
+    cut_history = _get_history(d)
+    if not isinstance(cut_history, DelayedCutHistory):
+        result = d.compute(**kwargs)
+        result.cut_history = list(cut_history)
+        return result
+    computed = dask.compute(*([d] + cut_history.partition_histories), **kwargs)
+    result = computed[0]
+    result.cut_history = cut_history.combine(computed[1:], quiet=quiet)
+    return result
 
 ##
 # Cut helper functions
@@ -68,6 +146,79 @@ def passthrough_message(passthrough_dict):
         desc, n_before - n_after, n_after / n_before * 100)
 
 
+class CutPipeline(object):
+    """Lazy selection on a pandas DataFrame. Pass it to the functions in this module instead of a DataFrame:
+    selections then only combine their boolean arrays into a mask, rather than copying the selected rows.
+
+        d = cuts.CutPipeline(data)
+        d = cuts.range_selections(d, ('cs1', (0, 100)), ('cs2', (50, 5000)))
+        d = cuts.eval_selection(d, 'largest_other_s2 < 100')
+        cuts.history(d)
+        data = d.materialize()
+
+    Columns (d['cs1'] or d.cs1) and d.eval give values for all rows of the original dataframe,
+    so the boolean arrays of later cuts are for all rows too. len(d) is the number of rows passing the cuts so far.
+    Selections return a new CutPipeline sharing the same dataframe; only the mask is copied.
+    """
+
+    def __init__(self, data, mask=None, cut_history=None):
+        self.data = data
+        if mask is None:
+            mask = np.ones(len(data), dtype=np.bool_)
+        self.mask = mask
+        self.cut_history = list(_get_history(data) if cut_history is None else cut_history)
+
+    def __repr__(self):
+        return 'CutPipeline(%d of %d rows passing %d cuts)' % (len(self), len(self.data), len(self.cut_history))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.mask))
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in ('data', 'mask', 'cut_history'):
+            raise AttributeError(name)
+        if name in self.data.columns:
+            return self.data[name]
+        raise AttributeError("CutPipeline has no attribute or column %s" % name)
+
+    @property
+    def columns(self):
+        return self.data.columns
+
+    def eval(self, eval_string):
+        """Return self.data.eval(eval_string), for all rows"""
+        return self.data.eval(eval_string)
+
+    def select(self, bools):
+        """Return new CutPipeline with the rows that pass the cuts so far and for which bools is True.
+        Does not record history, use cuts.selection for that.
+        """
+        bools = np.asarray(bools, dtype=np.bool_)
+        if len(bools) != len(self.data):
+            raise ValueError("Selection has %d values, dataframe has %d rows" % (len(bools), len(self.data)))
+        return CutPipeline(self.data, mask=self.mask & bools, cut_history=self.cut_history)
+
+    def materialize(self):
+        """Return DataFrame with the rows passing all the cuts (with cut_history, for cuts.history)"""
+        if self.mask.all():
+            # A new frame, so we don't change the cut_history of the one we were given
+            result = self.data.copy()
+        else:
+            result = self.data[self.mask]
+        result.cut_history = list(self.cut_history)
+        return result
+
+
+def _is_dask_frame(d):
+    """Return if d is a dask DataFrame. Doesn't import dask: if nobody did, d can't be a dask DataFrame."""
+    if 'dask.dataframe' not in sys.modules:
+        return False
+    return isinstance(d, sys.modules['dask.dataframe'].DataFrame)
+
+
 def selection(d, bools, desc=UNNAMED_DESCRIPTION, return_passthrough_info=False, quiet=None, _invert=False,
               force_repeat=False):
     """Returns d[bools], print out passthrough info.
@@ -88,11 +239,22 @@ def selection(d, bools, desc=UNNAMED_DESCRIPTION, return_passthrough_info=False,
             return d, n_before, n_now
         return d
 
-    if isinstance(d, dask.dataframe.DataFrame):
-        # Cuts history tracking for delayed computations not yet implemented
+    if _is_dask_frame(d):
+        # The passthrough counts are only known once the dataframe is computed, see cuts.compute
         n_before = float('nan')
         n_now = float('nan')
+        prev_cuts = _get_history(d)
+        if not isinstance(prev_cuts, DelayedCutHistory):
+            prev_cuts = DelayedCutHistory.for_frame(d)
+        if desc != UNNAMED_DESCRIPTION and not force_repeat and desc in prev_cuts.descriptions:
+            log.debug("%s selection already performed on this data; cut skipped. Use force_repeat=True to repeat."
+                      % desc)
+            return get_return_value()
+        if _invert:
+            bools = ~bools
+        d_before = d
         d = d[bools]
+        d.cut_history = prev_cuts.add(desc, d_before, d)
         if not quiet:
             print("%s selection readied for delayed evaluation" % desc)
         return get_return_value()
@@ -115,7 +277,10 @@ def selection(d, bools, desc=UNNAMED_DESCRIPTION, return_passthrough_info=False,
         bools = True ^ bools
 
     # Apply the selection
-    d = d[bools]
+    if isinstance(d, CutPipeline):
+        d = d.select(bools)
+    else:
+        d = d[bools]
 
     # Print and track the passthrough infos
     n_now = len(d)
@@ -141,10 +306,8 @@ def notnan(d, axis, **kwargs):
 def isfinite(d, axis, **kwargs):
     """Require d[axis] finite. See selection for options and return value."""
     kwargs.setdefault('desc', 'Finite %s' % axis)
-    if isinstance(d, dask.dataframe.DataFrame):
-        raise NotImplementedError(
-            "isfinite not yet implemented for delayed computations. "
-            "Maybe cuts.notnan suffices?")
+    if _is_dask_frame(d):
+        return selection(d, d[axis].map_partitions(np.isfinite, meta=(axis, np.bool_)), **kwargs)
     return selection(d, np.isfinite(d[axis]), **kwargs)
 
 
@@ -205,6 +368,7 @@ def range_cuts(*args, **kwargs):
 
 def apply_lichen(data, lichen_names, lichen_file='sciencerun1', deep=False, **kwargs):
     """Apply cuts defined by the lax lichen(s) lichen_names from the lichen_file to data.
+    To evaluate the lichens once per run and store the results, use hax.cut_booleans.apply_lichen instead.
     :param deep: if True (default False), apply sub-lichens explicitly
     """
     # Support for single lichen
@@ -223,8 +387,13 @@ def apply_lichen(data, lichen_names, lichen_file='sciencerun1', deep=False, **kw
         for l in (lichen.lichen_list if deep else [lichen]):
             l_name = l.__class__.__name__
 
-            # .copy() to prevent pandas warning and pollution with new columns
-            d = l.process(data.copy())
+            if isinstance(data, CutPipeline):
+                # Process all rows, so the cut booleans line up with the mask. A shallow copy shares the
+                # column arrays with the dataframe, but the lichen's new columns are only added to the copy.
+                d = l.process(data.data.copy(deep=False))
+            else:
+                # .copy() to prevent pandas warning and pollution with new columns
+                d = l.process(data.copy())
 
             if hasattr(lichen, 'version'):
                 desc = l_name + ' v' + str(l.version)
@@ -246,9 +415,12 @@ def apply_lichen(data, lichen_names, lichen_file='sciencerun1', deep=False, **kw
 def eval_selection(d, eval_string, **kwargs):
     """Apply a selection specified by a pandas.DataFrame.eval string that returns the boolean array.
     If no description is provided, the eval string itself is used as the description.
+    The string is compiled once by hax.expressions, and evaluated on only the columns it uses.
     """
     kwargs.setdefault('desc', eval_string)
-    return selection(d, d.eval(eval_string), **kwargs)
+    if _is_dask_frame(d):
+        return selection(d, d.eval(eval_string), **kwargs)
+    return selection(d, hax.expressions.evaluate(d, eval_string), **kwargs)
 
 
 def eval_cut(d, eval_string, **kwargs):
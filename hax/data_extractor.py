@@ -1,9 +1,12 @@
 """Extract peak or hit info from processed root file
 """
+import json
+import os
 import warnings
 
 import numpy as np
 import hax
+from hax.expressions import compile_cut
 
 
 def root_to_numpy(base_object, field_name, attributes):
@@ -62,6 +65,156 @@ def make_named_array(array, field_names):
     return array
 
 
+class ChunkedArrayWriter(object):
+    """Writes rows of values to a directory of .npy files with chunk_size rows each, so the rows never
+    have to be in memory all at once. Use ChunkedArray to read the result.
+
+    Fields are floats, unless their values in the first rows are not numbers (e.g. the peak type):
+    then they are strings.
+    Chunks never span runs: call start_run before writing the rows of each run.
+    """
+
+    def __init__(self, directory, field_names, chunk_size=100000):
+        self.directory = directory
+        self.field_names = list(field_names)
+        # Type of each field ('f8' or 'U'), set by the first rows we get
+        self.field_types = None
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.n_buffered = 0
+        self.chunks = []
+        self.run_number = None
+        self.event_range = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start_run(self, run_number):
+        self.flush()
+        self.run_number = run_number
+
+    def append(self, rows, event_number):
+        """Write rows (2d array with a column per field) from the event event_number"""
+        rows = np.atleast_2d(rows)
+        if rows.shape[1] != len(self.field_names):
+            raise ValueError("Got rows with %d values, but there are %d fields" % (rows.shape[1],
+                                                                                   len(self.field_names)))
+        if self.field_types is None:
+            self.field_types = ['f8' if _is_numeric(rows[:, i]) else 'U' for i in range(rows.shape[1])]
+        while len(rows):
+            n = min(len(rows), self.chunk_size - self.n_buffered)
+            self.buffer.append(rows[:n])
+            self.n_buffered += n
+            if self.event_range is None:
+                self.event_range = [event_number, event_number]
+            self.event_range[1] = event_number
+            rows = rows[n:]
+            if self.n_buffered == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        """Write the buffered rows (if any) to a new chunk file"""
+        if not self.n_buffered:
+            return
+        rows = np.concatenate(self.buffer)
+        columns = []
+        for name, field_type, values in zip(self.field_names, self.field_types, rows.T):
+            try:
+                columns.append(values.astype(field_type))
+            except ValueError:
+                example = [v for v in values if not _is_numeric(np.array([v]))][0]
+                raise ValueError("Field %s has non-numeric values (e.g. %s), but the first rows had numbers"
+                                 % (name, example))
+        data = np.zeros(len(rows), dtype=[(name, c.dtype) for name, c in zip(self.field_names, columns)])
+        for name, c in zip(self.field_names, columns):
+            data[name] = c
+        filename = 'chunk_%06d.npy' % len(self.chunks)
+        np.save(os.path.join(self.directory, filename), data)
+        self.chunks.append(dict(filename=filename, run_number=int(self.run_number), n_rows=self.n_buffered,
+                                first_event=int(self.event_range[0]), last_event=int(self.event_range[1])))
+        self.buffer = []
+        self.n_buffered = 0
+        self.event_range = None
+
+    def close(self):
+        """Write the last chunk and the index. Returns a ChunkedArray to read the data."""
+        self.flush()
+        with open(os.path.join(self.directory, 'index.json'), mode='w') as outfile:
+            json.dump(dict(field_names=self.field_names,
+                           field_types=self.field_types or ['f8'] * len(self.field_names),
+                           chunks=self.chunks), outfile)
+        return ChunkedArray(self.directory)
+
+
+def _is_numeric(values):
+    """Return whether values (an array) can be converted to floats"""
+    if values.dtype.kind in 'fiub':
+        return True
+    try:
+        values.astype(np.float64)
+    except ValueError:
+        return False
+    return True
+
+
+class ChunkedArray(object):
+    """Lazy handle to rows written by ChunkedArrayWriter (e.g. by DataExtractor.get_data with output_dir).
+    Chunks are only read (memory-mapped) when you ask for them.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json')) as infile:
+            index = json.load(infile)
+        self.field_names = index['field_names']
+        self.field_types = index.get('field_types', ['f8'] * len(self.field_names))
+        self.chunks = index['chunks']
+
+    def __repr__(self):
+        return 'ChunkedArray(%s: %d rows in %d chunks)' % (self.directory, len(self), len(self.chunks))
+
+    def __len__(self):
+        return sum([c['n_rows'] for c in self.chunks])
+
+    @property
+    def run_numbers(self):
+        return sorted(set([c['run_number'] for c in self.chunks]))
+
+    def chunk(self, i):
+        """Return the i-th chunk as a memory-mapped structured array"""
+        return np.load(os.path.join(self.directory, self.chunks[i]['filename']), mmap_mode='r')
+
+    def __iter__(self):
+        for i in range(len(self.chunks)):
+            yield self.chunk(i)
+
+    def read(self, run_number=None, event_range=None):
+        """Return structured array with the rows of run_number (default: all runs)
+        with event numbers in event_range = (first, last) (inclusive, default all events).
+        Only the chunks that can contain such rows are read. For example, for the rows of events 100 to 199
+        of run 6386:
+            rows = DataExtractor().get_data(datasets, output_dir='peaks').read(6386, (100, 199))
+        """
+        result = []
+        for i, c in enumerate(self.chunks):
+            if run_number is not None and c['run_number'] != run_number:
+                continue
+            if event_range is not None and (c['last_event'] < event_range[0] or c['first_event'] > event_range[1]):
+                continue
+            data = self.chunk(i)
+            if event_range is not None:
+                data = data[(data['event_number'] >= event_range[0]) & (data['event_number'] <= event_range[1])]
+            result.append(np.array(data))
+        if not len(result):
+            return np.zeros(0, dtype=list(zip(self.field_names, self.field_types)))
+        # String fields are as wide as the longest string in their chunk
+        dtype = [(name, max([r.dtype[name] for r in result], key=lambda t: t.itemsize)) for name in self.field_names]
+        return np.concatenate([r.astype(dtype) for r in result])
+
+    def to_dataframe(self, run_number=None, event_range=None):
+        """Return pandas DataFrame of read(run_number, event_range)"""
+        import pandas as pd
+        return pd.DataFrame(self.read(run_number=run_number, event_range=event_range))
+
+
 class DataExtractor():
     """This class is meant for extracting properties that are *not* on the event level, such as peak or hit properties.
     For more information, check the docs of DataExtractor.get_data().
@@ -73,17 +226,18 @@ class DataExtractor():
             "DataExtractor is deprecated, please switch to multi-row minitrees instead.",
             DeprecationWarning)
         self.data = []
+        self.writer = None
 
     def loop_body(self, event):
         """Function that extracts data from each event and adds array with that data to the data list.
         """
         # Check if event passes event cut
-        if eval(self.event_cut_string):
+        if self.event_cut(event):
             event_entry = np.array([getattr(event, field) for field in self.event_fields])
 
             for peak in event.peaks:
                 # Check if peak passes the cut
-                if eval(self.peak_cut_string):
+                if self.peak_cut(peak, event):
                     # Get peak information, which is stored in _temp_data
                     _temp_data = []
                     for field in self.peak_fields:
@@ -132,7 +286,10 @@ class DataExtractor():
                         # We should actually never reach this since the checking has been done before
                         raise ValueError(
                             "Enter either 'peak' of 'hit' for level!")
-                    self.data.append(entry)
+                    if self.writer is None:
+                        self.data.append(entry)
+                    else:
+                        self.writer.append(entry, event.event_number)
         # Check if user-defined event number limit is reached
         if event.event_number >= self.stop_after:
             print("User-defined limit of %d events reached, stopping..." % self.stop_after)
@@ -141,13 +298,18 @@ class DataExtractor():
 
     def get_data(self, dataset, level='peak', event_fields=['event_number'],
                  peak_fields=['area', 'hit_time_std'], hit_fields=[], event_cuts=[],
-                 peak_cuts=[], stop_after=np.inf, added_branches=[]):
+                 peak_cuts=[], stop_after=np.inf, added_branches=[], output_dir=None, chunk_size=100000):
         """Extract peak or hit data from a dataset.
         Peak or hit can be toggled by specifying level = 'peak' or level = 'hit'.
         Example useage:
             d = DataExtractor.get_data(dataset=run_name,level='peak',event_fields = ['event_number'],
                 peak_fields=['area'],event_cuts=['event_number > 5', 'event_number < 10'],
                 peak_cuts=['area > 100', 'type = "s1"'],stop_after=10000,added_branches= ['peak.type'])
+
+        If output_dir is given, the rows are written to .npy files of chunk_size rows in output_dir while we go,
+        rather than kept in memory, and you get a ChunkedArray to read them by run and event range.
+        This keeps the memory use bounded for hit-level extraction from big datasets. event_number is then always
+        included in the event fields, and dataset can also be a list of datasets.
         """
         # Sanity checking
         if (level != 'peak') and (level != 'hit'):
@@ -158,26 +320,43 @@ class DataExtractor():
         branch_selection = make_branch_selection(level, event_fields, peak_fields, added_branches)
         self.event_cut_string = build_cut_string(event_cuts, 'event')
         self.peak_cut_string = build_cut_string(peak_cuts, 'peak')
+        # Compile the cuts once, rather than eval-ing the strings for every event and peak
+        namespace = dict(globals(), self=self)
+        self.event_cut = compile_cut(self.event_cut_string, 'event', namespace)
+        # Peak cuts can use the event too (e.g. peak.left > event.start_time)
+        self.peak_cut = compile_cut(self.peak_cut_string, 'peak, event', namespace)
         self.event_fields = event_fields
         self.peak_fields = peak_fields
         self.hit_fields = hit_fields
         self.stop_after = stop_after
         self.level = level
 
+        self.writer = None
+        if output_dir is not None:
+            if 'event_number' not in event_fields:
+                event_fields = self.event_fields = ['event_number'] + event_fields
+                branch_selection = ['event_number'] + branch_selection
+            self.writer = ChunkedArrayWriter(output_dir, self._field_names(), chunk_size=chunk_size)
+            for d in (dataset if isinstance(dataset, (list, tuple)) else [dataset]):
+                self.writer.start_run(hax.runs.get_run_number(d))
+                hax.paxroot.loop_over_dataset(d, self.loop_body, branch_selection=branch_selection)
+            return self.writer.close()
+
         hax.paxroot.loop_over_dataset(dataset, self.loop_body, branch_selection=branch_selection)
 
         # Now reshape data
         # list of arrays -> one array -> named array
         self.data = np.concatenate(self.data)
-        # Build list of strings with field names.
-        if level == 'hit':
-            # For the hit level, we have to be careful. For example, 'area' can be peak or hit area.
-            # How to solve this? Well, just add hit_ or peak_ before the property
-            field_names = (event_fields + ['peak_' + field for field in peak_fields] +
-                           ['hit_' + field for field in hit_fields])
-        if level == 'peak':
-            # For peak level no such problem exists (yet) so just keep normal names
-            field_names = event_fields + peak_fields
-        self.data = make_named_array(self.data, field_names)
+        self.data = make_named_array(self.data, self._field_names())
 
         return self.data
+
+    def _field_names(self):
+        """Return list of strings with field names."""
+        if self.level == 'hit':
+            # For the hit level, we have to be careful. For example, 'area' can be peak or hit area.
+            # How to solve this? Well, just add hit_ or peak_ before the property
+            return (self.event_fields + ['peak_' + field for field in self.peak_fields] +
+                    ['hit_' + field for field in self.hit_fields])
+        # For peak level no such problem exists (yet) so just keep normal names
+        return self.event_fields + self.peak_fields
@@ -0,0 +1,538 @@
+"""Sources of pax events: pax ROOT files, npz files, or synthetic events.
+
+Everything in hax that loops over events (treemakers, hax.paxroot.loop_over_dataset, ...) gets them from an
+EventSource. Which one is used is set by the event_source option:
+ - 'root': pax ROOT files (the default, needs pax and ROOT)
+ - 'npz': <run name>.npz files in main_data_paths, made e.g. by save_npz
+ - 'synthetic': randomly generated pax-like events, for the datasets listed by synthetic_datasets().
+   Use this to test or profile treemakers without pax or data.
+
+The npz and synthetic sources store events as flat arrays:
+ - 'event_number', 'start_time', ...: a value per event
+ - 'peaks:offsets': offsets of each event's peaks (length n_events + 1), see hax.jagged
+ - 'peaks.area', 'peaks.type', ...: a value per peak. Can be multidimensional, e.g. peaks.range_area_decile.
+ - 'peaks.reconstructed_positions:offsets': offsets of each peak's reconstructed positions (length n_peaks + 1),
+   'peaks.reconstructed_positions.x' etc.: a value per reconstructed position.
+ - 's1s:offsets', 's1s': a list of values (here peak indices) per event.
+Events are served as objects with the same attributes as the pax event class (as far as they are in the arrays).
+"""
+from collections import OrderedDict
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import hax
+from hax import jagged
+from hax.utils import find_file_in_folders
+
+log = logging.getLogger('hax.event_sources')
+
+
+def get_event_source(run_id):
+    """Return the EventSource for run_id, as set by the event_source option"""
+    source_type = hax.config.get('event_source', 'root')
+    if source_type not in EVENT_SOURCES:
+        raise ValueError("Unknown event_source %s, choose from %s" % (source_type, list(EVENT_SOURCES.keys())))
+    return EVENT_SOURCES[source_type](run_id)
+
+
+class EventSource(object):
+    """Base class for sources of pax events of a dataset. Use as a context manager, or call open and close.
+
+    Subclasses implement open, close, n_events, iter_events, read_entries and get_metadata.
+    """
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.run_name = hax.runs.get_run_name(run_id)
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        hax.profiling.add_bytes_read(self.bytes_read())
+        self.close()
+
+    def bytes_read(self):
+        """Return number of bytes read from disk since the source was opened"""
+        return 0
+
+    @property
+    def n_events(self):
+        raise NotImplementedError
+
+    def iter_events(self, event_list=None, branch_selection=None):
+        """Yield pax event objects for all events, or the events at entries in event_list.
+        :param branch_selection: list of branches to read. Sources for which reading is cheap may ignore this.
+        """
+        raise NotImplementedError
+
+    def read_entries(self, branches, start, stop):
+        """Return numpy structured array with the values of branches for entries start to stop.
+        See hax.paxroot.read_branches.
+        """
+        raise NotImplementedError
+
+    def get_metadata(self):
+        """Return the pax metadata dictionary of the dataset"""
+        raise NotImplementedError
+
+    def read_branches(self, branches, chunk_size=None, event_list=None, desc=''):
+        """Yield numpy structured arrays with the values of branches for chunks of chunk_size events.
+        See hax.paxroot.read_branches for details.
+        """
+        if chunk_size is None:
+            chunk_size = hax.config.get('columnar_chunk_size', 10000)
+        n_events = self.n_events
+        if event_list is None:
+            chunks = [(start, min(start + chunk_size, n_events), None)
+                      for start in range(0, n_events, chunk_size)]
+        else:
+            event_list = np.unique(np.asarray(event_list, dtype=np.int64))
+            chunks = [(wanted[0], wanted[-1] + 1, wanted)
+                      for wanted in np.split(event_list, np.arange(chunk_size, len(event_list), chunk_size))
+                      if len(wanted)]
+
+        progress = None
+        if hax.config.get('tqdm_on', True):
+            progress = tqdm(desc='Run %s: %s' % (self.run_id, desc),
+                            total=sum([stop - start if wanted is None else len(wanted)
+                                       for start, stop, wanted in chunks]))
+        for start, stop, wanted in chunks:
+            data = self.read_entries(branches, start, stop)
+            if wanted is not None:
+                data = data[wanted - start]
+            if progress is not None:
+                progress.update(len(data))
+            yield data
+        if progress is not None:
+            progress.close()
+
+
+class ROOTEventSource(EventSource):
+    """Events from the pax ROOT file of the dataset"""
+
+    def __init__(self, run_id):
+        EventSource.__init__(self, run_id)
+        self.filename = hax.paxroot.get_filename(run_id)
+        self.rootfile = None
+        self.tree = None
+
+    def open(self):
+        self.rootfile = hax.paxroot.open_pax_rootfile(self.run_id)
+        # If you get "'TObject' object has no attribute 'GetEntries'" here,
+        # we renamed the tree to T1 or TPax or something... or you're trying to load a Xerawdp root file!
+        self.tree = self.rootfile.Get('tree')
+
+    def close(self):
+        if self.rootfile is not None:
+            self.rootfile.Close()
+        self.rootfile = self.tree = None
+
+    @property
+    def n_events(self):
+        return self.tree.GetEntries()
+
+    def bytes_read(self):
+        if self.rootfile is None:
+            return 0
+        return self.rootfile.GetBytesRead()
+
+    def iter_events(self, event_list=None, branch_selection=None):
+        t = self.tree
+        # Activate the desired branches
+        if branch_selection:
+            t.SetBranchStatus("*", 0)
+            for bn in branch_selection:
+                t.SetBranchStatus(bn, 1)
+        if event_list is None:
+            event_list = range(t.GetEntries())
+        for event_i in event_list:
+            t.GetEntry(event_i)
+            yield t.events
+
+    def read_entries(self, branches, start, stop):
+        import root_numpy
+        return root_numpy.tree2array(self.tree, branches=branches, start=start, stop=stop)
+
+    def get_metadata(self):
+        return hax.paxroot._get_metadata(self.filename)
+
+
+class PaxObject(object):
+    """Event, peak, interaction etc. served by an ArrayEventSource. Has whatever attributes were in the arrays."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return 'PaxObject(%s)' % ', '.join(['%s=%r' % (k, v) for k, v in self.__dict__.items()
+                                            if not isinstance(v, list)])
+
+
+class ArrayEventSource(EventSource):
+    """Events from a dictionary of arrays, see the module docstring for the layout.
+    Subclasses must set self.arrays and self.metadata in open.
+    """
+    arrays = None
+    metadata = None
+
+    def close(self):
+        self.arrays = None
+        self._lists = None
+
+    @property
+    def n_events(self):
+        return len(self.arrays['event_number'])
+
+    def collections(self):
+        """Return list of names of jagged collections (e.g. peaks, peaks.reconstructed_positions, s1s)"""
+        return [k[:-len(':offsets')] for k in self.arrays.keys() if k.endswith(':offsets')]
+
+    def _as_list(self, key):
+        # Python lists of the values, so the event objects have python floats, strings etc. like PyROOT gives
+        if key not in self._lists:
+            self._lists[key] = self.arrays[key].tolist()
+        return self._lists[key]
+
+    def _build(self, collection, start, stop):
+        """Return list of objects (or values) in collection with flat indices start...stop"""
+        if collection in self.arrays:
+            return self._as_list(collection)[start:stop]
+        fields = [k[len(collection) + 1:] for k in self.arrays.keys()
+                  if k.startswith(collection + '.') and '.' not in k[len(collection) + 1:] and ':' not in k]
+        children = [c for c in self.collections()
+                    if c.startswith(collection + '.') and '.' not in c[len(collection) + 1:]]
+        values = {f: self._as_list(collection + '.' + f) for f in fields}
+        child_offsets = {c: self.arrays[c + ':offsets'] for c in children}
+        result = []
+        for i in range(start, stop):
+            obj = PaxObject(**{f: v[i] for f, v in values.items()})
+            for c, offsets in child_offsets.items():
+                setattr(obj, c.split('.')[-1], self._build(c, offsets[i], offsets[i + 1]))
+            result.append(obj)
+        return result
+
+    def iter_events(self, event_list=None, branch_selection=None):
+        self._lists = {}
+        event_fields = [k for k in self.arrays.keys() if '.' not in k and ':' not in k
+                        and k not in self.collections()]
+        top_collections = [c for c in self.collections() if '.' not in c]
+        if event_list is None:
+            event_list = range(self.n_events)
+        for event_i in event_list:
+            event = PaxObject(**{f: self._as_list(f)[event_i] for f in event_fields})
+            for c in top_collections:
+                offsets = self.arrays[c + ':offsets']
+                setattr(event, c, self._build(c, offsets[event_i], offsets[event_i + 1]))
+            yield event
+
+    def read_entries(self, branches, start, stop):
+        columns = OrderedDict()
+        for branch in branches:
+            # Allow branch names like peaks.range_area_decile[11] used for SetBranchStatus
+            name = branch.split('[')[0]
+            if '.' not in name and name in self.arrays and name not in self.collections():
+                columns[name] = self.arrays[name][start:stop]
+                continue
+            collection = name.rsplit('.', 1)[0]
+            if collection + ':offsets' not in self.arrays or name not in self.arrays or '.' in collection:
+                raise ValueError("Can't read branch %s from %s for columnar access" % (branch, self.run_name))
+            offsets = self.arrays[collection + ':offsets'][start:stop + 1]
+            per_event = np.empty(stop - start, dtype=object)
+            for i, values in enumerate(np.split(self.arrays[name][offsets[0]:offsets[-1]],
+                                                offsets[1:-1] - offsets[0])):
+                per_event[i] = values
+            columns[name] = per_event
+        result = np.zeros(stop - start, dtype=[(k, v.dtype, v.shape[1:]) for k, v in columns.items()])
+        for k, v in columns.items():
+            result[k] = v
+        return result
+
+    def get_metadata(self):
+        return self.metadata
+
+
+class NpzEventSource(ArrayEventSource):
+    """Events from <run name>.npz in main_data_paths (see save_npz)"""
+
+    def __init__(self, run_id):
+        EventSource.__init__(self, run_id)
+        self.filename = find_file_in_folders(self.run_name + '.npz', hax.config['main_data_paths'])
+        if not self.filename:
+            raise FileNotFoundError("Cannot find %s.npz in main_data_paths" % self.run_name)
+
+    def open(self):
+        with np.load(self.filename) as f:
+            self.arrays = OrderedDict([(k, f[k]) for k in f.files if k != 'metadata'])
+            self.metadata = json.loads(str(f['metadata']))
+
+    def bytes_read(self):
+        # We read the entire file on open
+        if self.arrays is None:
+            return 0
+        return os.path.getsize(self.filename)
+
+    def get_metadata(self):
+        if self.metadata is None:
+            with np.load(self.filename) as f:
+                return json.loads(str(f['metadata']))
+        return self.metadata
+
+
+class SyntheticEventSource(ArrayEventSource):
+    """Randomly generated pax-like events for one of the datasets in synthetic_datasets().
+    The events of each run are always the same (for the same synthetic_datasets option).
+    """
+
+    def __init__(self, run_id):
+        EventSource.__init__(self, run_id)
+        dsets = synthetic_datasets()
+        matching = dsets[dsets['name'] == self.run_name]
+        if not len(matching):
+            raise FileNotFoundError("%s is not one of the synthetic datasets" % self.run_name)
+        self.dataset_info = matching.iloc[0]
+
+    def open(self):
+        global _last_synthetic_run
+        options = _synthetic_options()
+        key = (options['n_events'], options['seed'], int(self.dataset_info['number']))
+        if _last_synthetic_run[0] != key:
+            _last_synthetic_run = (key, generate_events(n_events=options['n_events'],
+                                                        seed=(options['seed'], int(self.dataset_info['number'])),
+                                                        start_time=pd.Timestamp(self.dataset_info['start']).value))
+        self.arrays = _last_synthetic_run[1]
+        self.metadata = self.get_metadata()
+
+    def get_metadata(self):
+        return dict(file_builder_name='hax.event_sources.SyntheticEventSource',
+                    file_builder_version=_synthetic_options()['pax_version'],
+                    run_number=int(self.dataset_info['number']),
+                    dataset_name=self.run_name,
+                    configuration={})
+
+
+EVENT_SOURCES = {'root': ROOTEventSource, 'npz': NpzEventSource, 'synthetic': SyntheticEventSource}
+
+
+##
+# Synthetic events
+##
+
+# (n_events, seed, run number), arrays of the last synthetic run we generated.
+# Saves regenerating the events when making several minitrees for the same run.
+_last_synthetic_run = (None, None)
+
+
+def _synthetic_options():
+    options = dict(n_runs=10, n_events=1000, seed=0, first_run_number=1, pax_version='6.8.0')
+    options.update(hax.config.get('synthetic_datasets', {}))
+    return options
+
+
+def synthetic_datasets():
+    """Return DataFrame like hax.runs.datasets with the synthetic datasets (see the synthetic_datasets option).
+    Runs are one hour long, starting on 1 January 2017.
+    """
+    options = _synthetic_options()
+    numbers = options['first_run_number'] + np.arange(options['n_runs'])
+    start = pd.Timestamp('2017-01-01') + pd.to_timedelta(numbers - options['first_run_number'], unit='h')
+    return pd.DataFrame(OrderedDict([
+        ('name', [x.strftime('%y%m%d_%H%M') for x in start]),
+        ('number', numbers),
+        ('start', start.values),
+        ('end', (start + pd.Timedelta(hours=1)).values),
+        ('tags', ''),
+        ('reader__ini__name', 'synthetic'),
+        ('trigger__events_built', options['n_events']),
+        ('pax_version', options['pax_version']),
+        ('location', ''),
+        ('raw_data_subfolder', ''),
+        ('raw_data_found', False),
+        ('raw_data_used_local_path', ''),
+    ]))
+
+
+def generate_events(n_events=1000, seed=0, start_time=0, mean_n_peaks=10, event_rate=5):
+    """Return dictionary of arrays with n_events randomly generated pax-like events (see module docstring).
+    Peaks are s1s, s2s, lone_hits and unknowns in the tpc, and some veto peaks. Events with an S1 before
+    the largest S2 have an interaction made of those.
+    This is meant for testing and benchmarking, the distributions are only vaguely realistic.
+
+    :param seed: seed (or sequence of seeds) for the random generator
+    :param start_time: time (ns since unix epoch) of the start of the run
+    :param event_rate: mean event rate in Hz
+    """
+    rng = np.random.RandomState(seed)
+    a = OrderedDict()
+    event_length = int(1e6)     # ns
+    sample_duration = 10        # ns
+
+    a['event_number'] = np.arange(n_events, dtype=np.int64)
+    a['start_time'] = start_time + np.cumsum(
+        event_length + rng.exponential(1e9 / event_rate, n_events).astype(np.int64))
+    a['stop_time'] = a['start_time'] + event_length
+    a['n_pulses'] = rng.poisson(300, n_events).astype(np.int32)
+
+    # Peaks
+    offsets = jagged.offsets_from_counts(rng.poisson(mean_n_peaks, n_events))
+    a['peaks:offsets'] = offsets
+    n = offsets[-1]
+    event_i = jagged.event_index(offsets)
+    peak_type = rng.choice(np.array(['s1', 's2', 'lone_hit', 'unknown']), n, p=[0.25, 0.25, 0.4, 0.1])
+    detector = np.where(rng.rand(n) < 0.05, 'veto', 'tpc')
+    log_area = {'s1': np.log(50), 's2': np.log(5000), 'lone_hit': 0, 'unknown': np.log(20)}
+    area = np.exp(np.array([log_area[t] for t in peak_type]) + rng.normal(0, 1, n))
+    width = np.where(peak_type == 's2', 100, 10) * rng.uniform(0.5, 2, n)     # samples
+    # Peaks are sorted by left within the event
+    left = rng.randint(0, event_length // sample_duration, n)
+    left = left[np.lexsort((left, event_i))]
+    n_hits = np.maximum(1, rng.poisson(area / 1.5))
+    n_contributing_channels = np.minimum(n_hits, 248)
+    range_area_decile = np.sort(rng.uniform(0, 1, (n, 11)), axis=1) * (width * sample_duration)[:, np.newaxis]
+    range_area_decile[:, 0] = 0
+    a['peaks.area'] = area
+    a['peaks.type'] = peak_type
+    a['peaks.detector'] = detector
+    a['peaks.area_fraction_top'] = np.clip(np.where(peak_type == 's2', 0.6, 0.3) + rng.normal(0, 0.1, n), 0, 1)
+    a['peaks.left'] = left
+    a['peaks.right'] = left + width.astype(np.int64)
+    a['peaks.hit_time_mean'] = (left + width / 2) * sample_duration
+    a['peaks.center_time'] = a['peaks.hit_time_mean'].copy()
+    a['peaks.hit_time_std'] = width * sample_duration / 4
+    a['peaks.n_hits'] = n_hits
+    a['peaks.n_contributing_channels'] = n_contributing_channels
+    a['peaks.n_saturated_channels'] = np.where(area > 1e5, rng.poisson(5, n), 0)
+    a['peaks.tight_coincidence'] = np.minimum(n_contributing_channels, rng.poisson(n_contributing_channels))
+    a['peaks.largest_hit_channel'] = rng.randint(0, 254, n)
+    a['peaks.largest_hit_area'] = area * rng.uniform(0.05, 0.5, n)
+    a['peaks.range_area_decile'] = range_area_decile
+    a['peaks.area_decile_from_midpoint'] = range_area_decile - range_area_decile[:, 5:6]
+
+    # Reconstructed positions for each S2
+    algorithms = np.array(['PosRecTopPatternFit', 'PosRecNeuralNet', 'PosRecTopPatternFunctionFit'])
+    rp_counts = np.where(peak_type == 's2', len(algorithms), 0)
+    n_rp = rp_counts.sum()
+    rp_x, rp_y = _random_positions(rng, n_rp)
+    a['peaks.reconstructed_positions:offsets'] = jagged.offsets_from_counts(rp_counts)
+    a['peaks.reconstructed_positions.algorithm'] = np.tile(algorithms, n_rp // len(algorithms))
+    a['peaks.reconstructed_positions.x'] = rp_x
+    a['peaks.reconstructed_positions.y'] = rp_y
+    a['peaks.reconstructed_positions.goodness_of_fit'] = rng.exponential(50, n_rp)
+
+    # Peak indices of tpc S1s and S2s, largest first
+    tpc = detector == 'tpc'
+    peak_i = jagged.local_index(offsets)
+    for t in ('s1', 's2'):
+        is_t = tpc & (peak_type == t)
+        order = np.lexsort((-area[is_t], event_i[is_t]))
+        a[t + 's:offsets'] = jagged.offsets_from_counts(jagged.count_per_event(offsets, is_t))
+        a[t + 's'] = peak_i[is_t][order]
+
+    # Main interaction: largest S2, with the largest S1 before it
+    s2_i = jagged.argmax_per_event(area, offsets, tpc & (peak_type == 's2'))
+    s2_left = jagged.take(left, offsets, s2_i, fill=-1)
+    s1_i = jagged.argmax_per_event(area, offsets, tpc & (peak_type == 's1') & (left < s2_left[event_i]))
+    has_interaction = (s1_i >= 0) & (s2_i >= 0)
+    n_int = has_interaction.sum()
+    drift_time = (s2_left - jagged.take(left, offsets, s1_i, fill=-1))[has_interaction] * sample_duration
+    x, y = _random_positions(rng, n_int)
+    a['interactions:offsets'] = jagged.offsets_from_counts(has_interaction.astype(np.int64))
+    a['interactions.s1'] = s1_i[has_interaction]
+    a['interactions.s2'] = s2_i[has_interaction]
+    a['interactions.x'] = x
+    a['interactions.y'] = y
+    a['interactions.drift_time'] = drift_time.astype(np.float64)
+    a['interactions.z'] = -drift_time * 1.44e-4     # cm, for a drift velocity of 1.44 mm/us
+    a['interactions.r_correction'] = rng.normal(0, 0.5, n_int)
+    a['interactions.z_correction'] = rng.normal(0, 0.5, n_int)
+    a['interactions.s1_area_correction'] = rng.uniform(0.8, 1.2, n_int)
+    a['interactions.s2_area_correction'] = rng.uniform(0.8, 1.2, n_int)
+    a['interactions.s1_pattern_fit'] = rng.exponential(50, n_int)
+    a['interactions.xy_posrec_goodness_of_fit'] = rng.exponential(50, n_int)
+    a['interactions.s1_area_fraction_top_probability'] = rng.uniform(0, 1, n_int)
+    return a
+
+
+def _random_positions(rng, n, radius=47.9):
+    """Return x, y of n positions uniformly distributed in a circle of radius (cm)"""
+    r = radius * np.sqrt(rng.uniform(0, 1, n))
+    phi = rng.uniform(0, 2 * np.pi, n)
+    return r * np.cos(phi), r * np.sin(phi)
+
+
+##
+# Saving events to npz
+##
+
+# Attributes of the pax event class saved by save_npz, by default
+NPZ_FIELDS = {
+    '': ['event_number', 'start_time', 'stop_time', 'n_pulses'],
+    'peaks': ['area', 'type', 'detector', 'area_fraction_top', 'left', 'right', 'hit_time_mean', 'hit_time_std',
+              'center_time', 'n_hits', 'n_contributing_channels', 'n_saturated_channels', 'tight_coincidence',
+              'largest_hit_channel', 'largest_hit_area', 'range_area_decile', 'area_decile_from_midpoint'],
+    'peaks.reconstructed_positions': ['algorithm', 'x', 'y', 'goodness_of_fit'],
+    'interactions': ['s1', 's2', 'x', 'y', 'z', 'drift_time', 'r_correction', 'z_correction',
+                     's1_area_correction', 's2_area_correction', 's1_pattern_fit', 'xy_posrec_goodness_of_fit',
+                     's1_area_fraction_top_probability'],
+    's1s': None,
+    's2s': None,
+}
+
+
+def save_npz(run_id, filename=None, fields=None, event_list=None):
+    """Save events of run_id, read from the current event source (e.g. the pax root file), to an npz file
+    for the npz event source. Handy to make small test datasets that can be used without pax.
+
+    :param filename: file to write to, default <run name>.npz in the current directory
+    :param fields: dictionary {collection: list of attributes}, see NPZ_FIELDS (the default).
+                   Use '' for attributes of the event, and None for collections of plain values.
+    :param event_list: entry numbers of the events to save (default: all)
+    """
+    if fields is None:
+        fields = NPZ_FIELDS
+    columns = {}
+    counts = {}
+
+    def add(collection, objects):
+        counts.setdefault(collection, []).append(len(objects))
+        if fields[collection] is None:
+            columns.setdefault(collection, []).extend(list(objects))
+            return
+        for obj in objects:
+            for f in fields[collection]:
+                value = getattr(obj, f, float('nan'))
+                columns.setdefault(collection + '.' + f, []).append(
+                    value if isinstance(value, (int, float, str)) else list(value))
+            for child in fields:
+                if child.startswith(collection + '.') and '.' not in child[len(collection) + 1:]:
+                    add(child, getattr(obj, child.split('.')[-1]))
+
+    with get_event_source(run_id) as source:
+        for event in source.iter_events(event_list=event_list):
+            for f in fields['']:
+                columns.setdefault(f, []).append(getattr(event, f))
+            for collection in fields:
+                if collection and '.' not in collection:
+                    add(collection, getattr(event, collection))
+        metadata = source.get_metadata()
+
+    arrays = {k: np.array(v) for k, v in columns.items()}
+    for collection, c in counts.items():
+        arrays[collection + ':offsets'] = jagged.offsets_from_counts(np.array(c, dtype=np.int64))
+    if filename is None:
+        filename = hax.runs.get_run_name(run_id) + '.npz'
+    np.savez_compressed(filename, metadata=json.dumps(metadata), **arrays)
+    log.info("Saved %d events to %s" % (len(arrays['event_number']), os.path.abspath(filename)))
+    return filename
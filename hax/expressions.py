@@ -0,0 +1,359 @@
+"""Compile cut expressions once, rather than eval-ing strings for every event or peak.
+
+Cuts on pax objects (e.g. PeakExtractor.peak_cut_list) are strings like "peak.area > 100" or
+'peak.type == "s1"'. compile_cut turns such a string into a python function of the object, which is much faster
+than calling eval on the string for every object. compile_vectorized_cut turns it into a function of a dictionary
+of numpy arrays (e.g. the values of peaks.area for many peaks at once), returning a boolean array.
+
+Selections on dataframes are strings in the syntax of pandas.DataFrame.eval, e.g. "(cs1 < 80) & (s2 > 200)".
+compile_expression parses such a string once (and caches the result), computes subexpressions that occur
+several times only once, and evaluates it on only the columns it needs, with numexpr if it is installed.
+"""
+import ast
+import io
+import logging
+import tokenize
+
+import numpy as np
+
+log = logging.getLogger('hax.expressions')
+
+
+def compile_cut(cut_string, argument, namespace=None):
+    """Return function(argument) that evaluates cut_string, e.g. compile_cut('peak.area > 100', 'peak').
+    argument can also list several arguments, e.g. 'peak, event' for peak cuts that can use the event too.
+    :param namespace: dictionary of other names the cut string can use (e.g. np, units, self)
+    """
+    code = compile('lambda %s: (%s)' % (argument, cut_string), '<cut %s>' % cut_string, 'eval')
+    return eval(code, dict(namespace or {}))
+
+
+class CannotVectorize(Exception):
+    """Raised by compile_vectorized_cut if a cut can't be applied to arrays of values"""
+    pass
+
+
+def compile_vectorized_cut(cut_string, argument, namespace=None, other_arguments=()):
+    """Return (function(columns), list of attributes) for cut_string, a cut on objects called argument.
+    The function takes a dictionary mapping the attribute names used in the cut to numpy arrays with their
+    values for many objects, and returns a boolean array with whether each object passes the cut
+    (or a single boolean, if the cut does not depend on the object).
+
+    For example, compile_vectorized_cut('(peak.area > 100) & (peak.range_area_decile[5] < 1000)', 'peak')
+    returns a function of {'area': ..., 'range_area_decile': ...}. Array attributes are numpy arrays with
+    a row per object, so peak.range_area_decile[5] becomes columns['range_area_decile'][:, 5].
+    The comparison, arithmetic and boolean operators (and, or, not, &, |, ~) work as in the python cut.
+
+    Raises CannotVectorize if the cut uses something we can't apply to arrays,
+    e.g. a function call or attributes of attributes (peak.reconstructed_positions[0].x),
+    or any of other_arguments (e.g. 'event' in a peak cut).
+    """
+    tree = ast.parse(cut_string, mode='eval')
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in other_arguments:
+            raise CannotVectorize("Cut uses %s" % node.id)
+    transformer = _Vectorizer(argument)
+    tree = ast.fix_missing_locations(transformer.visit(tree))
+    tree = ast.Expression(body=ast.Lambda(
+        args=ast.arguments(posonlyargs=[], args=[ast.arg(arg='_columns')], vararg=None,
+                           kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]),
+        body=tree.body))
+    ast.fix_missing_locations(tree)
+    code = compile(tree, '<vectorized cut %s>' % cut_string, 'eval')
+    namespace = dict(namespace or {})
+    namespace['np'] = np
+    return eval(code, namespace), sorted(transformer.attributes)
+
+
+class _Vectorizer(ast.NodeTransformer):
+    """Rewrite a cut on an object into numpy operations on arrays of its attributes, see compile_vectorized_cut"""
+
+    def __init__(self, argument):
+        self.argument = argument
+        self.attributes = set()
+
+    def _column(self, node):
+        """Return the attribute name if node is argument.attribute, else None"""
+        if (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and
+                node.value.id == self.argument):
+            return node.attr
+        return None
+
+    def visit_Name(self, node):
+        if node.id == self.argument:
+            raise CannotVectorize("Cut uses %s itself, rather than its attributes" % self.argument)
+        return node
+
+    def visit_Attribute(self, node):
+        attribute = self._column(node)
+        if attribute is None:
+            if self._uses_argument(node):
+                raise CannotVectorize("Cut uses attributes of attributes of %s" % self.argument)
+            return node
+        self.attributes.add(attribute)
+        return ast.Subscript(value=ast.Name(id='_columns', ctx=ast.Load()),
+                             slice=ast.Constant(value=attribute), ctx=ast.Load())
+
+    def visit_Subscript(self, node):
+        if self._column(node.value) is None:
+            if self._uses_argument(node):
+                raise CannotVectorize("Cut indexes something derived from %s" % self.argument)
+            return node
+        # argument.attribute[i]: index i of each object's array
+        column = self.visit(node.value)
+        index = self.visit(node.slice)
+        return ast.Subscript(value=column,
+                             slice=ast.Tuple(elts=[ast.Slice(lower=None, upper=None, step=None), index],
+                                             ctx=ast.Load()),
+                             ctx=ast.Load())
+
+    def visit_Call(self, node):
+        if self._uses_argument(node):
+            raise CannotVectorize("Cut calls a function on attributes of %s" % self.argument)
+        return node
+
+    def visit_BoolOp(self, node):
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        values = [self.visit(v) for v in node.values]
+        result = values[0]
+        for v in values[1:]:
+            result = ast.BinOp(left=result, op=op, right=v)
+        return result
+
+    def visit_UnaryOp(self, node):
+        operand = self.visit(node.operand)
+        if isinstance(node.op, ast.Not):
+            return ast.Call(func=ast.Attribute(value=ast.Name(id='np', ctx=ast.Load()),
+                                               attr='logical_not', ctx=ast.Load()),
+                            args=[operand], keywords=[])
+        return ast.UnaryOp(op=node.op, operand=operand)
+
+    def visit_Compare(self, node):
+        # a < b < c means (a < b) & (b < c)
+        operands = [self.visit(node.left)] + [self.visit(c) for c in node.comparators]
+        for op in node.ops:
+            if isinstance(op, (ast.In, ast.NotIn, ast.Is, ast.IsNot)):
+                raise CannotVectorize("Cut uses %s, which can't be applied to arrays" % op.__class__.__name__)
+        comparisons = [ast.Compare(left=operands[i], ops=[op], comparators=[operands[i + 1]])
+                       for i, op in enumerate(node.ops)]
+        result = comparisons[0]
+        for c in comparisons[1:]:
+            result = ast.BinOp(left=result, op=ast.BitAnd(), right=c)
+        return result
+
+    def visit_IfExp(self, node):
+        raise CannotVectorize("Cut uses an if-expression")
+
+    def _uses_argument(self, node):
+        return any([isinstance(n, ast.Name) and n.id == self.argument for n in ast.walk(node)])
+
+
+##
+# Selections on dataframes
+##
+
+# Functions selection strings can use (those pandas.DataFrame.eval supports, which numexpr supports too)
+EXPRESSION_FUNCTIONS = ('sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2',
+                        'sinh', 'cosh', 'tanh', 'arcsinh', 'arccosh', 'arctanh',
+                        'exp', 'expm1', 'log', 'log10', 'log1p', 'sqrt', 'abs')
+
+# Compiled expressions by expression string
+_compiled_expressions = {}
+
+
+class CannotCompile(Exception):
+    """Raised by compile_expression for strings it can't compile, which we then leave to pandas.DataFrame.eval"""
+    pass
+
+
+class CompiledExpression(object):
+    """Expression on the columns of a dataframe, see compile_expression.
+    Subexpressions occurring several times in the expression are computed once, as temporary variables:
+    steps is a list of (variable name, expression string), the last of which is the result.
+    """
+
+    def __init__(self, expression_string, columns, steps):
+        self.expression_string = expression_string
+        self.columns = columns
+        self.steps = steps
+        self._code = [(name, compile(expr, '<expression %s>' % expression_string, 'eval'))
+                      for name, expr in steps]
+
+    def __repr__(self):
+        return 'CompiledExpression(%r)' % self.expression_string
+
+    def __call__(self, data, use_numexpr=None):
+        """Return numpy array with the value of the expression for each row of data
+        :param data: pandas DataFrame (or anything else that gives columns by data[name])
+        :param use_numexpr: whether to use numexpr (if installed). Defaults to the use_numexpr option.
+        """
+        n_rows = len(data)
+        values = {c: np.asarray(data[c]) for c in self.columns}
+        if use_numexpr is None:
+            import hax
+            use_numexpr = hax.config.get('use_numexpr', True)
+        numexpr = _get_numexpr() if use_numexpr else None
+        result = None
+        if numexpr is not None:
+            try:
+                result = self._evaluate_numexpr(numexpr, values)
+            except Exception as e:
+                # e.g. comparisons of strings or object columns, which numexpr does not do
+                log.debug("numexpr can't evaluate %s (%s), using numpy instead" % (self.expression_string, e))
+        if result is None:
+            result = self._evaluate_numpy(values)
+        result = np.asarray(result)
+        if result.ndim == 0:
+            # Expression doesn't depend on the data, e.g. 'True'
+            result = np.full(n_rows, result[()])
+        return result
+
+    def _evaluate_numexpr(self, numexpr, values):
+        values = dict(values)
+        for name, expr in self.steps:
+            values[name] = numexpr.evaluate(expr, local_dict=values, global_dict={})
+        return values[name]
+
+    def _evaluate_numpy(self, values):
+        values = dict(values)
+        with np.errstate(all='ignore'):
+            for name, code in self._code:
+                values[name] = eval(code, _NUMPY_NAMESPACE, values)
+        return values[name]
+
+
+_NUMPY_NAMESPACE = {f: getattr(np, f) for f in EXPRESSION_FUNCTIONS}
+_NUMPY_NAMESPACE['__builtins__'] = {}
+
+
+def _get_numexpr():
+    """Return the numexpr module, or None if it is not installed"""
+    try:
+        import numexpr
+    except ImportError:
+        return None
+    return numexpr
+
+
+def compile_expression(expression_string):
+    """Return CompiledExpression for expression_string, a string in the pandas.DataFrame.eval syntax.
+    Compiled expressions are cached, so compiling the same string again costs nothing.
+    Raises CannotCompile if the string uses something we don't support (e.g. @variables or backticks,
+    functions other than EXPRESSION_FUNCTIONS, 'in' or lists).
+    """
+    if expression_string in _compiled_expressions:
+        return _compiled_expressions[expression_string]
+    if '@' in expression_string or '`' in expression_string:
+        raise CannotCompile("%s uses local variables or backtick-quoted column names" % expression_string)
+    try:
+        tree = ast.parse(_replace_booleans(expression_string), mode='eval')
+    except (SyntaxError, tokenize.TokenError) as e:
+        raise CannotCompile("Can't parse %s: %s" % (expression_string, e))
+
+    # pandas.DataFrame.eval semantics: and/or/not are elementwise, chained comparisons too
+    tree = _Vectorizer(argument=None).visit(tree)
+
+    # Count how often each subexpression occurs, then hoist the repeated ones into temporary variables
+    counts = {}
+    for node in ast.walk(tree.body):
+        if isinstance(node, _HOISTABLE):
+            key = ast.dump(node)
+            counts[key] = counts.get(key, 0) + 1
+    eliminator = _SubexpressionEliminator(counts)
+    body = eliminator.visit(tree.body)
+    steps = eliminator.steps + [('_result', ast.unparse(ast.fix_missing_locations(body)))]
+
+    result = CompiledExpression(expression_string, sorted(eliminator.columns), steps)
+    _compiled_expressions[expression_string] = result
+    return result
+
+
+def expression_columns(expression_string):
+    """Return sorted list of the columns the expression_string (in pandas.DataFrame.eval syntax) uses"""
+    try:
+        return compile_expression(expression_string).columns
+    except CannotCompile:
+        # Best effort: all names in the string that aren't functions
+        return sorted(set([n.id for n in ast.walk(ast.parse(expression_string.replace('@', ''), mode='eval'))
+                           if isinstance(n, ast.Name) and n.id not in EXPRESSION_FUNCTIONS]))
+
+
+def evaluate(data, expression_string):
+    """Return numpy array with the value of expression_string (in pandas.DataFrame.eval syntax) for each row
+    of data. Falls back to data.eval if we can't compile the expression, or it uses names that aren't columns.
+    """
+    try:
+        expression = compile_expression(expression_string)
+    except CannotCompile as e:
+        log.debug(str(e))
+        return np.asarray(data.eval(expression_string))
+    if any([c not in data.columns for c in expression.columns]):
+        return np.asarray(data.eval(expression_string))
+    return expression(data)
+
+
+def _replace_booleans(expression_string):
+    """Replace & and | by 'and' and 'or', so they have the same (low) precedence as in pandas.DataFrame.eval.
+    E.g. 'cs1 > 3 & cs2 < 5' means '(cs1 > 3) & (cs2 < 5)', not 'cs1 > (3 & cs2) < 5'.
+    """
+    replacements = {'&': 'and', '|': 'or'}
+    tokens = [(tokenize.NAME, replacements[t.string]) if t.type == tokenize.OP and t.string in replacements
+              else (t.type, t.string)
+              for t in tokenize.generate_tokens(io.StringIO(expression_string.strip()).readline)]
+    return tokenize.untokenize(tokens)
+
+
+_HOISTABLE = (ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call)
+
+
+class _SubexpressionEliminator(ast.NodeTransformer):
+    """Replace subexpressions that occur more than once by temporary variables, computed once in self.steps.
+    Also records the columns (names that aren't functions) the expression uses.
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.steps = []
+        self.temporaries = {}
+        self.columns = set()
+
+    def visit_Name(self, node):
+        if node.id.startswith('_'):
+            raise CannotCompile("Column names starting with _ are not supported")
+        self.columns.add(node.id)
+        return node
+
+    def visit_Call(self, node):
+        if (isinstance(node.func, ast.Attribute) and node.func.attr == 'logical_not' and
+                isinstance(node.func.value, ast.Name) and node.func.value.id == 'np'):
+            # 'not x', see _Vectorizer.visit_UnaryOp
+            return self.visit(ast.UnaryOp(op=ast.Invert(), operand=node.args[0]))
+        if not (isinstance(node.func, ast.Name) and node.func.id in EXPRESSION_FUNCTIONS) or node.keywords:
+            raise CannotCompile("Unsupported function call %s" % ast.dump(node.func))
+        key = ast.dump(node)
+        if key in self.temporaries:
+            return ast.Name(id=self.temporaries[key], ctx=ast.Load())
+        node.args = [self.visit(a) for a in node.args]
+        return self._hoist(key, node)
+
+    def generic_visit(self, node):
+        if isinstance(node, (ast.BoolOp, ast.List, ast.Tuple, ast.Set, ast.Dict, ast.Subscript, ast.Attribute,
+                             ast.Lambda, ast.IfExp, ast.Starred)) or (
+                isinstance(node, ast.Compare) and
+                any([isinstance(op, (ast.In, ast.NotIn, ast.Is, ast.IsNot)) for op in node.ops])):
+            raise CannotCompile("Unsupported syntax %s" % node.__class__.__name__)
+        if not isinstance(node, _HOISTABLE):
+            return super().generic_visit(node)
+        key = ast.dump(node)
+        if key in self.temporaries:
+            return ast.Name(id=self.temporaries[key], ctx=ast.Load())
+        node = super().generic_visit(node)
+        return self._hoist(key, node)
+
+    def _hoist(self, key, node):
+        if self.counts.get(key, 0) < 2:
+            return node
+        name = '_t%d' % len(self.steps)
+        self.temporaries[key] = name
+        self.steps.append((name, ast.unparse(ast.fix_missing_locations(node))))
+        return ast.Name(id=name, ctx=ast.Load())
@@ -0,0 +1,352 @@
+"""Utilities for jagged arrays: a variable number of values (e.g. peaks or interactions) per event.
+
+We represent these as a flat array of values, plus an array of offsets of length n_events + 1:
+the values of event i are values[offsets[i]:offsets[i + 1]].
+Use flatten to get this representation from what root_numpy gives for branches like peaks.area
+(an object array containing an array for each event).
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+def flatten(x, dtype=None):
+    """Return (values, offsets) for x, a sequence (e.g. an object array) with an array of values for each event.
+    If the per-event arrays are multidimensional (e.g. peaks.range_area_decile), values will be too.
+    """
+    counts = np.fromiter((len(v) for v in x), dtype=np.int64, count=len(x))
+    offsets = offsets_from_counts(counts)
+    if offsets[-1]:
+        values = np.concatenate([np.asarray(v) for v in x if len(v)])
+    else:
+        values = np.zeros(0)
+    if dtype is not None:
+        values = values.astype(dtype)
+    return values, offsets
+
+
+def offsets_from_counts(counts):
+    """Return offsets array for a jagged array with counts values per event"""
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def counts(offsets):
+    """Return number of values in each event"""
+    return np.diff(offsets)
+
+
+def event_index(offsets):
+    """Return index of the event each value belongs to"""
+    return np.repeat(np.arange(len(offsets) - 1), counts(offsets))
+
+
+def local_index(offsets):
+    """Return index of each value within its event (e.g. the peak index in event.peaks)"""
+    return np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts(offsets))
+
+
+def as_str(values):
+    """Return values (e.g. peaks.type, peaks.detector) as an array of python strings, decoding bytes if needed"""
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        return values.astype(str)
+    if values.dtype.kind == 'O':
+        return np.array([v.decode() if isinstance(v, bytes) else str(v) for v in values], dtype=str)
+    return values
+
+
+def take(values, offsets, indices, fill=float('nan')):
+    """Return the value at index indices[i] within each event i, or fill if that index does not exist
+    (e.g. area of peaks[interactions[0].s1]). Pass indices = -1 for events where you want fill.
+    """
+    indices = np.asarray(indices)
+    valid = (indices >= 0) & (indices < counts(offsets))
+    result = np.full(len(offsets) - 1, fill, dtype=np.result_type(values.dtype, np.min_scalar_type(fill)))
+    result[valid] = values[offsets[:-1][valid] + indices[valid]]
+    return result
+
+
+def first(values, offsets, fill=float('nan')):
+    """Return the first value of each event, or fill for events without values"""
+    return take(values, offsets, np.zeros(len(offsets) - 1, dtype=np.int64), fill=fill)
+
+
+def count_per_event(offsets, mask=None):
+    """Return number of values in each event (for which mask is True)"""
+    if mask is None:
+        return counts(offsets)
+    return np.bincount(event_index(offsets)[mask], minlength=len(offsets) - 1)
+
+
+def sum_per_event(values, offsets, mask=None):
+    """Return sum of the values in each event (for which mask is True), 0 for events without values"""
+    ev = event_index(offsets)
+    if mask is not None:
+        ev, values = ev[mask], values[mask]
+    return np.bincount(ev, weights=values, minlength=len(offsets) - 1)
+
+
+def max_per_event(values, offsets, mask=None, fill=float('nan')):
+    """Return the maximum of fill and the values in each event (for which mask is True). NaN values are ignored,
+    so with the default fill=NaN, you get NaN for events without values.
+    """
+    ev = event_index(offsets)
+    if mask is not None:
+        ev, values = ev[mask], values[mask]
+    result = np.full(len(offsets) - 1, fill, dtype=np.float64)
+    np.fmax.at(result, ev, values)
+    return result
+
+
+def argmax_per_event(values, offsets, mask=None):
+    """Return index within the event of the first maximum value in each event (for which mask is True),
+    or -1 for events without values. NaN values are only taken if all values in the event are NaN.
+    """
+    ev = event_index(offsets)
+    position = np.arange(len(values))
+    if mask is not None:
+        ev, values, position = ev[mask], values[mask], position[mask]
+    result = np.full(len(offsets) - 1, -1, dtype=np.int64)
+    if not len(values):
+        return result
+    # Sort by event, then by decreasing value (NaN last), then by position; take the first entry of each event
+    order = np.lexsort((position, -values, ev))
+    ev, position = ev[order], position[order]
+    is_first = np.concatenate([[True], ev[1:] != ev[:-1]])
+    result[ev[is_first]] = position[is_first] - offsets[ev[is_first]]
+    return result
+
+
+def broadcast(event_values, offsets):
+    """Return the value of event_values for the event of each value, e.g. the event's s1 for every peak"""
+    return np.asarray(event_values)[event_index(offsets)]
+
+
+class JaggedTable(object):
+    """Table with a variable number of rows per event (e.g. a row per peak), stored as flat columns plus offsets.
+
+    :param event_columns: dictionary of arrays with a value per event. Must include run_number and event_number.
+    :param columns: dictionary of arrays with a value per row
+    :param offsets: the rows of event i are rows offsets[i]:offsets[i + 1]
+
+    Use to_dataframe to get the usual minitree layout (one row per row, with the event columns repeated).
+    """
+    # Order of the columns for to_dataframe (e.g. that of the DataFrame the table was made from), or None
+    column_order = None
+
+    def __init__(self, event_columns, columns, offsets):
+        self.event_columns = OrderedDict([(k, np.asarray(v)) for k, v in event_columns.items()])
+        self.columns = OrderedDict([(k, np.asarray(v)) for k, v in columns.items()])
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        for k in ('run_number', 'event_number'):
+            if k not in self.event_columns:
+                raise ValueError("JaggedTable needs a %s event column" % k)
+        if len(self.offsets) != self.n_events + 1:
+            raise ValueError("Need offsets for each of the %d events" % self.n_events)
+        for k, v in self.columns.items():
+            if len(v) != self.offsets[-1]:
+                raise ValueError("Column %s has %d values for %d rows" % (k, len(v), self.offsets[-1]))
+
+    def __repr__(self):
+        return 'JaggedTable(%d events, %d rows, columns %s)' % (self.n_events, len(self), list(self.columns))
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def n_events(self):
+        return len(self.event_columns['event_number'])
+
+    def counts(self):
+        """Return number of rows of each event"""
+        return counts(self.offsets)
+
+    def event_index(self):
+        """Return index of the event of each row"""
+        return event_index(self.offsets)
+
+    def _values(self, x):
+        return self.columns[x] if isinstance(x, str) else np.asarray(x)
+
+    def broadcast(self, event_values):
+        """Return value for each row of event_values (name of an event column, or array with a value per event)"""
+        if isinstance(event_values, str):
+            event_values = self.event_columns[event_values]
+        return broadcast(event_values, self.offsets)
+
+    def count_per_event(self, mask=None):
+        """Return number of rows (for which mask is True) in each event"""
+        return count_per_event(self.offsets, mask)
+
+    def sum_per_event(self, column, mask=None):
+        """Return the sum of column (name or array with a value per row) in each event"""
+        return sum_per_event(self._values(column), self.offsets, mask)
+
+    def max_per_event(self, column, mask=None):
+        """Return the maximum of column (name or array with a value per row) in each event, NaN if no rows"""
+        return max_per_event(self._values(column), self.offsets, mask)
+
+    def largest_per_event(self, by, columns=None, mask=None, fill=float('nan')):
+        """Return DataFrame with run_number, event_number and the values of columns of the row with the largest
+        value of by in each event (among rows for which mask is True). Events without such rows get fill.
+        :param columns: names of columns to include, default all
+        """
+        import pandas as pd
+        index = argmax_per_event(self._values(by), self.offsets, mask)
+        has_row = index >= 0
+        rows = self.offsets[:-1][has_row] + index[has_row]
+        result = pd.DataFrame(OrderedDict([(k, self.event_columns[k]) for k in ('run_number', 'event_number')]))
+        for k in (columns if columns is not None else self.columns.keys()):
+            values = self.columns[k]
+            if values.dtype.kind in 'fiub':
+                x = np.full(self.n_events, fill, dtype=np.result_type(values.dtype, np.min_scalar_type(fill)))
+            else:
+                x = np.full(self.n_events, fill, dtype=object)
+            x[has_row] = values[rows]
+            result[k] = x
+        return result
+
+    def select(self, mask):
+        """Return JaggedTable with only the rows for which mask is True (keeping all events)"""
+        mask = np.asarray(mask, dtype=np.bool_)
+        result = JaggedTable(self.event_columns,
+                             OrderedDict([(k, v[mask]) for k, v in self.columns.items()]),
+                             offsets_from_counts(self.count_per_event(mask)))
+        result.column_order = self.column_order
+        return result
+
+    def select_events(self, mask):
+        """Return JaggedTable with only the events for which mask is True"""
+        mask = np.asarray(mask, dtype=np.bool_)
+        row_mask = self.broadcast(mask)
+        result = JaggedTable(OrderedDict([(k, v[mask]) for k, v in self.event_columns.items()]),
+                             OrderedDict([(k, v[row_mask]) for k, v in self.columns.items()]),
+                             offsets_from_counts(self.counts()[mask]))
+        result.column_order = self.column_order
+        return result
+
+    def event_frame(self):
+        """Return DataFrame with the event columns"""
+        import pandas as pd
+        return pd.DataFrame(self.event_columns)
+
+    def to_dataframe(self):
+        """Return DataFrame with a row for each row, and the event columns repeated for each row"""
+        import pandas as pd
+        result = OrderedDict(self.columns)
+        ev = self.event_index()
+        for k, v in self.event_columns.items():
+            result[k] = v[ev]
+        if self.column_order is not None:
+            result = OrderedDict([(k, result[k]) for k in self.column_order])
+        return pd.DataFrame(result)
+
+    @classmethod
+    def from_dataframe(cls, data, event_numbers=None, run_number=None):
+        """Return JaggedTable from data, a DataFrame with a row per row and event_number and run_number columns
+        (e.g. made by a MultipleRowExtractor).
+        :param event_numbers: event numbers of all events, including those without rows.
+                              If not given, the table only has the events in data.
+        :param run_number: run number of the events, if data can be empty. Otherwise taken from data.
+        Rows are kept in their order within each event.
+        """
+        row_events = data['event_number'].values.astype(np.int64)
+        row_runs = data['run_number'].values.astype(np.int64)
+        if event_numbers is None:
+            keys = np.unique(np.stack([row_runs, row_events]), axis=1) if len(data) else np.zeros((2, 0), np.int64)
+            event_runs, event_numbers = keys
+        else:
+            event_numbers = np.asarray(event_numbers, dtype=np.int64)
+            if run_number is None:
+                if len(np.unique(row_runs)) > 1:
+                    raise ValueError("Pass event_numbers only for data from a single run")
+                run_number = row_runs[0] if len(row_runs) else -1
+            event_runs = np.full(len(event_numbers), run_number, dtype=np.int64)
+        # Position of each row's event among the events
+        event_order = np.lexsort((event_numbers, event_runs))
+        sorted_keys = event_runs[event_order] * (2 ** 32) + event_numbers[event_order]
+        row_keys = row_runs * (2 ** 32) + row_events
+        positions = np.searchsorted(sorted_keys, row_keys)
+        if len(row_keys) and (np.any(positions >= len(sorted_keys)) or
+                              np.any(sorted_keys[np.clip(positions, 0, len(sorted_keys) - 1)] != row_keys)):
+            raise ValueError("data has rows for events not in event_numbers")
+        positions = event_order[positions]
+        row_order = np.argsort(positions, kind='stable')
+        columns = OrderedDict([(k, data[k].values[row_order]) for k in data.columns
+                               if k not in ('event_number', 'run_number')])
+        result = cls(OrderedDict([('run_number', event_runs), ('event_number', event_numbers)]),
+                     columns,
+                     offsets_from_counts(np.bincount(positions, minlength=len(event_numbers))))
+        result.column_order = list(data.columns)
+        return result
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Return JaggedTable with the events of all tables (which must have the same columns)"""
+        tables = list(tables)
+        if not len(tables):
+            raise ValueError("Need at least one table to concatenate")
+        result = cls(OrderedDict([(k, np.concatenate([t.event_columns[k] for t in tables]))
+                                  for k in tables[0].event_columns]),
+                     OrderedDict([(k, np.concatenate([t.columns[k] for t in tables]))
+                                  for k in tables[0].columns]),
+                     offsets_from_counts(np.concatenate([t.counts() for t in tables])))
+        result.column_order = tables[0].column_order
+        return result
+
+    def save(self, filename, **extra):
+        """Save to an npz file. Extra arrays (e.g. metadata) can be passed as keyword arguments."""
+        arrays = OrderedDict()
+        arrays['event_offsets'] = self.offsets
+        for k, v in self.event_columns.items():
+            arrays['event:' + k] = v
+        for k, v in self.columns.items():
+            arrays['row:' + k] = _storable(k, v)
+        if self.column_order is not None:
+            arrays['column_order'] = np.array(self.column_order, dtype=str)
+        arrays.update(extra)
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a JaggedTable from an npz file made by save"""
+        with np.load(filename) as f:
+            result = cls(OrderedDict([(k[len('event:'):], f[k]) for k in f.files if k.startswith('event:')]),
+                         OrderedDict([(k[len('row:'):], _unstack(f[k])) for k in f.files if k.startswith('row:')]),
+                         f['event_offsets'])
+            if 'column_order' in f.files:
+                result.column_order = f['column_order'].tolist()
+        return result
+
+
+def _storable(name, values):
+    """Return values of column name as an array np.load can load without unpickling.
+    Object columns must hold strings (e.g. peak types) or arrays of the same shape (e.g. range_area_decile),
+    which we stack into a multidimensional array.
+    """
+    if values.dtype.kind != 'O':
+        return values
+    if all(isinstance(v, (str, bytes)) for v in values):
+        return as_str(values)
+    if all(np.ndim(v) > 0 for v in values):
+        shapes = set(np.shape(v) for v in values)
+        if len(shapes) <= 1:
+            if not shapes:
+                return np.zeros((0, 0))
+            return np.stack([np.asarray(v) for v in values])
+    raise ValueError("Cannot store column %s: it must have numbers, strings or arrays of the same shape "
+                     "in every row" % name)
+
+
+def _unstack(values):
+    """Return values loaded from a column saved by _storable, with a per-row array for multidimensional ones"""
+    if values.ndim <= 1:
+        return values
+    result = np.empty(len(values), dtype=object)
+    result[:] = list(values)
+    return result
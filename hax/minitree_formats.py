@@ -5,15 +5,30 @@ import warnings
 import numpy as np
 import pandas as pd
 
-try:
-    import ROOT
-    import root_numpy
-except ImportError as e:
-    warnings.warn("Error importing ROOT-related libraries: %s. "
-                  "If you try to use ROOT-related functions, hax will crash!" % e)
-
+from hax.jagged import JaggedTable
 from hax.utils import save_pickles, load_pickles
 
+# ROOT and root_numpy are only imported when you first use a ROOT minitree, see _import_root.
+# Importing ROOT takes a few seconds, which jobs reading only pickled minitrees shouldn't have to pay.
+ROOT = None
+root_numpy = None
+
+
+def _import_root():
+    global ROOT, root_numpy
+    if ROOT is not None:
+        return
+    try:
+        # numba must be imported before ROOT, otherwise their LLVM versions clash
+        import numba  # noqa
+        import ROOT as _ROOT
+        import root_numpy as _root_numpy
+    except ImportError as e:
+        warnings.warn("Error importing ROOT-related libraries: %s. "
+                      "If you try to use ROOT-related functions, hax will crash!" % e)
+        return
+    ROOT, root_numpy = _ROOT, _root_numpy
+
 
 def get_format(path, treemaker=None):
     _, ext = os.path.splitext(path)
@@ -45,6 +60,7 @@ class PickleFormat(MinitreeDataFormat):
 class ROOTFormat(MinitreeDataFormat):
     def load_metadata(self):
         # This is NOT the same as paxroot.get_metadata, that's for pax ROOT files...
+        _import_root()
         minitree_f = ROOT.TFile(self.path)
 
         metadata_object = minitree_f.Get('metadata')
@@ -59,9 +75,11 @@ class ROOTFormat(MinitreeDataFormat):
         return minitree_metadata
 
     def load_data(self):
+        _import_root()
         return pd.DataFrame.from_records(root_numpy.root2array(self.path).view(np.recarray))
 
     def save_data(self, metadata, data):
+        _import_root()
         if self.treemaker.uses_arrays:
             # Activate Joey's array saving code
             dataframe_to_root(data, self.path, treename=self.treemaker.__name__, mode='recreate')
@@ -85,7 +103,28 @@ class ROOTFormat(MinitreeDataFormat):
         minitree_f.Close()
 
 
-MINITREE_FORMATS = {'.root': ROOTFormat, '.pklz': PickleFormat}
+class JaggedFormat(MinitreeDataFormat):
+    """Minitrees with a variable number of rows per event (from treemakers with jagged = True), stored as flat
+    columns plus event offsets in an npz file, see hax.jagged.JaggedTable.
+    """
+
+    def load_metadata(self):
+        with np.load(self.path) as f:
+            return json.loads(str(f['metadata']))
+
+    def load_jagged(self):
+        return JaggedTable.load(self.path)
+
+    def load_data(self):
+        return self.load_jagged().to_dataframe()
+
+    def save_data(self, metadata, data):
+        if isinstance(data, pd.DataFrame):
+            data = JaggedTable.from_dataframe(data)
+        data.save(self.path, metadata=np.array(json.dumps(metadata)))
+
+
+MINITREE_FORMATS = {'.root': ROOTFormat, '.pklz': PickleFormat, '.npz': JaggedFormat}
 
 
 ##
@@ -106,6 +145,7 @@ def is_array_field(test_dataframe, test_field):
 
 
 def dataframe_to_root(dataframe, root_filename, treename='tree', mode='recreate'):
+    _import_root()
     branches = {}
     branch_types = {}
 
@@ -1,26 +1,41 @@
 """Make small flat root trees with one entry per event from the pax root files.
 """
+import ast
+from collections import OrderedDict
+from collections.abc import Mapping
 from datetime import datetime
 from distutils.version import LooseVersion
 from glob import glob
-import inspect
+import importlib
+import importlib.util
+import json
 import logging
 import os
+import shutil
+import time
 
 import numpy as np
 import pandas as pd
 
 import hax
 from hax import runs, cuts
-from .paxroot import loop_over_dataset, function_results_datasets
 from .utils import find_file_in_folders, get_user_id
 from .minitree_formats import get_format
 
 log = logging.getLogger('hax.minitrees')
 
-# update_treemakers() will update this to contain all treemakers included
-# with hax
-TREEMAKERS = {}
+# update_treemakers() will set hax.minitrees.TREEMAKERS to contain all treemakers included
+# with hax. This happens on first access after hax.init(), see hax.get_lazy_attribute.
+lazy_attributes = {'TREEMAKERS': ('treemakers', lambda: TreeMakerRegistry())}
+
+# hax.profiling.BuildStats of the minitrees made or loaded by the last call to load or load_single_dataset
+last_stats = []
+
+
+def __getattr__(name):
+    if name in lazy_attributes:
+        return hax.get_lazy_attribute('minitrees', name)
+    raise AttributeError("module 'hax.minitrees' has no attribute '%s'" % name)
 
 
 class TreeMaker(object):
@@ -34,6 +49,10 @@ class TreeMaker(object):
     (interval with which this occurs is controlled by the cache_size attribute).
     At the end of data extraction, the various dataframes are concatenated.
 
+    When the minitree will be saved, the dataframes are also periodically saved to a checkpoint directory
+    next to the minitree file (see the minitree_checkpoint_interval option). If the extraction is interrupted,
+    the next attempt to make the minitree resumes from the last checkpoint.
+
     You must instantiate a new treemaker for every extraction.
     """
     cache_size = 5000
@@ -59,6 +78,28 @@ class TreeMaker(object):
     # Flag if loading MC
     mc_data = False
 
+    # Set to False if extract_data keeps state from one event to the next. Then an extraction resumed
+    # from a checkpoint would give different results, so we always start from scratch.
+    resumable = True
+
+    # Set to True to store the minitree as flat columns plus event offsets (see hax.jagged.JaggedTable) in an
+    # .npz file, rather than in the preferred minitree format. Use this for treemakers that make a variable number
+    # of rows per event (e.g. MultipleRowExtractors making a row per peak).
+    # You can then get the minitree as a JaggedTable with load_jagged.
+    jagged = False
+
+    # Directory for checkpoints of this extraction, or None to not make checkpoints.
+    # Set by load_single_minitree if the minitree will be saved.
+    checkpoint_path = None
+
+    # Names of the treemakers whose minitrees this treemaker loads (with load_dependencies) to make its own.
+    # minitrees.load and load_single_dataset load these first (once per run, even if several treemakers need them).
+    depends_on = tuple()
+
+    # Mapping treemaker name -> minitree of the run we're extracting from, used by load_dependencies.
+    # Set by load_single_minitree. If None, load_dependencies loads the minitrees itself.
+    dependency_frames = None
+
     def __init__(self):
         # Support for string arguments
         if isinstance(self.branch_selection, str):
@@ -73,12 +114,44 @@ class TreeMaker(object):
 
         self.cache = []
         self.data = []
+        self.stats = hax.profiling.BuildStats(self.__class__.__name__)
+        self.checkpoint = None
+        # Event numbers of the events we visited (only kept for jagged treemakers)
+        self.visited = []
 
     def extract_data(self, event):
         raise NotImplementedError()
 
+    def load_dependencies(self, dataset):
+        """Return OrderedDict treemaker name -> minitree of dataset, for the treemakers in depends_on"""
+        frames = self.dependency_frames
+        if frames is None:
+            frames = RunMinitrees(dataset)
+        return OrderedDict([(name, frames[name]) for name in self.depends_on])
+
+    @staticmethod
+    def merge_frames(frames):
+        """Return the inner join (on run and event number) of the dataframes in frames, like load_single_dataset"""
+        frames = list(frames.values()) if isinstance(frames, Mapping) else list(frames)
+        result = frames[0]
+        for frame in frames[1:]:
+            result = _merge_minitrees(result, frame)
+        return result
+
+    def _timed_extract_data(self, event):
+        """Return extract_data(event), keeping track of the time spent (and profiling it if requested)"""
+        stats = self.stats
+        t0 = time.perf_counter()
+        if stats.should_profile(stats.n_events):
+            result = stats.run_profiled(self.extract_data, event)
+        else:
+            result = self.extract_data(event)
+        stats.n_events += 1
+        stats.times['extract'] += time.perf_counter() - t0
+        return result
+
     def process_event(self, event):
-        result = self.extract_data(event)
+        result = self._timed_extract_data(event)
         if not isinstance(result, dict):
             raise ValueError("TreeMakers must always extract dictionary")
         # Add the run and event number to the result. This is required to make joins succeed later on.
@@ -87,29 +160,123 @@ class TreeMaker(object):
         self.cache.append(result)
         self.check_cache()
 
-    def get_data(self, dataset, event_list=None):
-        """Return data extracted from running over dataset"""
+    def set_run_info(self, dataset):
+        """Set the attributes with information about the dataset we're about to extract data from"""
         self.mc_data = runs.is_mc(dataset)[0]
         self.run_name = runs.get_run_name(dataset)
         self.run_number = runs.get_run_number(dataset)
         self.run_start = runs.get_run_start(dataset)
-        loop_over_dataset(dataset, self.process_event,
-                          event_lists=event_list,
-                          branch_selection=self.branch_selection,
-                          desc='Making %s minitree' % self.__class__.__name__)
+        self.stats.run_name = self.run_name
+
+    def get_data(self, dataset, event_list=None):
+        """Return data extracted from running over dataset"""
+        self.set_run_info(dataset)
+        event_function = self.process_event
+        if event_list is None:
+            event_list = self.start_checkpoints(dataset)
+            if self.checkpoint is not None:
+                event_function = self._process_event_and_checkpoint
+        times = self.stats.times
+        t0 = time.perf_counter()
+        busy_before = times['extract'] + times['cache'] + times['save']
+        hax.paxroot.loop_over_dataset(dataset, event_function,
+                                      event_lists=event_list,
+                                      branch_selection=self.branch_selection,
+                                      desc='Making %s minitree' % self.__class__.__name__)
+        # Whatever time in the event loop was not spent in extract_data, on the cache or on checkpoints,
+        # was spent getting events
+        busy = times['extract'] + times['cache'] + times['save'] - busy_before
+        self.stats.add_time('io', time.perf_counter() - t0 - busy)
         self.check_cache(force_empty=True)
         if not len(self.data):
             log.warning("Not a single row was extracted from dataset %s!" % dataset)
             return pd.DataFrame([], columns=['event_number', 'run_number'])
         else:
             hax.log.debug("Extraction completed, now concatenating data")
-            return pd.concat(self.data, ignore_index=True)
+            t0 = time.perf_counter()
+            result = pd.concat(self.data, ignore_index=True)
+            self.stats.add_time('cache', time.perf_counter() - t0)
+            return result
 
     def check_cache(self, force_empty=False):
         if not len(self.cache) or (len(self.cache) < self.cache_size and not force_empty):
             return
+        t0 = time.perf_counter()
         self.data.append(pd.DataFrame(self.cache))
         self.cache = []
+        self.stats.add_time('cache', time.perf_counter() - t0)
+
+    def _process_event_and_checkpoint(self, event):
+        self.process_event(event)
+        self.checkpoint['n_entries'] += 1
+        if len(self.data) >= self.checkpoint['n_frames'] + hax.config['minitree_checkpoint_interval']:
+            self.save_checkpoint()
+
+    def start_checkpoints(self, dataset):
+        """Start making checkpoints of the extraction from dataset in self.checkpoint_path (if it is set).
+        If there is a checkpoint of an earlier, interrupted extraction with the same settings, load its data
+        into self.data and return the entries of the events still to process. Otherwise return None (all events).
+        """
+        if (self.checkpoint_path is None or not self.resumable or
+                not hax.config.get('minitree_checkpoint_interval', 0)):
+            return None
+        with hax.event_sources.get_event_source(dataset) as source:
+            n_events = source.n_events
+        self.checkpoint = dict(treemaker=self.__class__.__name__,
+                               version=self.__version__,
+                               run_name=self.run_name,
+                               n_events=n_events,
+                               cache_size=self.cache_size,
+                               columnar=bool(getattr(self, 'columnar', False)),
+                               chunk_size=getattr(self, 'chunk_size', None),
+                               n_entries=0,
+                               n_frames=0)
+        progress_file = os.path.join(self.checkpoint_path, 'progress.json')
+        if os.path.exists(progress_file):
+            with open(progress_file) as infile:
+                progress = json.load(infile)
+            if all([progress.get(k) == v for k, v in self.checkpoint.items() if k not in ('n_entries', 'n_frames')]):
+                log.info("Resuming %s minitree of %s from checkpoint at entry %d" % (
+                    self.__class__.__name__, self.run_name, progress['n_entries']))
+                self.data = [pd.read_pickle(self._checkpoint_frame_file(i)) for i in range(progress['n_frames'])]
+                if self.jagged:
+                    self.visited = [np.load(os.path.join(self.checkpoint_path, 'visited.npy'))]
+                self.checkpoint.update(progress)
+            else:
+                log.warning("Ignoring checkpoint in %s: it was made with different settings" % self.checkpoint_path)
+                self.remove_checkpoint()
+        os.makedirs(self.checkpoint_path, exist_ok=True)
+        if not self.checkpoint['n_entries']:
+            return None
+        return np.arange(self.checkpoint['n_entries'], n_events)
+
+    def _checkpoint_frame_file(self, i):
+        return os.path.join(self.checkpoint_path, 'frame_%06d.pkl' % i)
+
+    def save_checkpoint(self):
+        """Save the dataframes made since the last checkpoint, then the progress"""
+        t0 = time.perf_counter()
+        for i in range(self.checkpoint['n_frames'], len(self.data)):
+            self.data[i].to_pickle(self._checkpoint_frame_file(i))
+        self.checkpoint['n_frames'] = len(self.data)
+        if self.jagged:
+            np.save(os.path.join(self.checkpoint_path, 'visited.npy'), np.hstack(self.visited).astype(np.int64))
+        # Write the progress to a temporary file first, so an interruption can't leave a corrupt progress file
+        progress_file = os.path.join(self.checkpoint_path, 'progress.json')
+        with open(progress_file + '.tmp', mode='w') as outfile:
+            json.dump(self.checkpoint, outfile)
+        os.replace(progress_file + '.tmp', progress_file)
+        self.stats.add_time('save', time.perf_counter() - t0)
+
+    def jagged_table(self, data):
+        """Return hax.jagged.JaggedTable of data (returned by get_data), including the events without rows"""
+        visited = np.hstack(self.visited) if len(self.visited) else None
+        return hax.jagged.JaggedTable.from_dataframe(data, event_numbers=visited, run_number=self.run_number)
+
+    def remove_checkpoint(self):
+        """Remove the checkpoint directory (if any), e.g. after the minitree has been saved"""
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            shutil.rmtree(self.checkpoint_path)
 
 
 class MultipleRowExtractor(TreeMaker):
@@ -121,7 +288,7 @@ class MultipleRowExtractor(TreeMaker):
     """
 
     def process_event(self, event):
-        result = self.extract_data(event)
+        result = self._timed_extract_data(event)
         if not isinstance(result, (list, tuple)):
             raise TypeError("MultipleRowExtractor treemakers must extract "
                             "a list of dictionaries, not a %s" % type(result))
@@ -130,35 +297,328 @@ class MultipleRowExtractor(TreeMaker):
             result[i]['run_number'] = self.run_number
             result[i]['event_number'] = event.event_number
         assert len(result) == 0 or isinstance(result[0], dict)
+        if self.jagged:
+            self.visited.append(event.event_number)
         self.cache.extend(result)
         self.check_cache()
 
 
+class VectorTreeMaker(TreeMaker):
+    """Base class for treemakers that extract data for many events at once, from numpy arrays.
+
+    Instead of calling extract_data on every event (which is a PyROOT object, so every attribute access is slow),
+    we read columnar_branches for chunks of chunk_size events with hax.paxroot.read_branches, then call
+    extract_batch(arrays). arrays is a numpy structured array with a row per event and a field per branch;
+    branches with a value per peak/interaction are object arrays of per-event arrays (see hax.jagged).
+    extract_batch must return a dictionary (or DataFrame) of columns with one value per event.
+    If row_per_event is False, extract_batch can return any number of rows per event (e.g. one per peak),
+    and must include the event_number column itself.
+
+    You can still implement extract_data: it is used if columnar is False (e.g. to compare the results),
+    or if columnar is None (default) and the columnar_treemakers option is False.
+
+    If you're seeing this as the documentation of an actual TreeMaker, somebody forgot to add documentation
+    for their treemaker.
+    """
+    columnar = None
+
+    # Branches to read with root_numpy. If not given, we use branch_selection.
+    columnar_branches = None
+
+    # Number of events to read at once. If not given, we use the columnar_chunk_size option.
+    chunk_size = None
+
+    # Whether extract_batch returns exactly one row per event
+    row_per_event = True
+
+    def __init__(self):
+        TreeMaker.__init__(self)
+        if self.columnar is None:
+            self.columnar = hax.config.get('columnar_treemakers', True) and not self._extract_data_is_newer()
+        if self.columnar_branches is None:
+            self.columnar_branches = self.branch_selection
+        self.columnar_branches = list(self.columnar_branches)
+        if 'event_number' not in self.columnar_branches:
+            self.columnar_branches += ['event_number']
+
+    def extract_batch(self, arrays):
+        raise NotImplementedError()
+
+    def _extract_data_is_newer(self):
+        """Return if extract_data was overridden in a subclass of the class that defines extract_batch,
+        e.g. if you subclassed Basics and changed only extract_data. We shouldn't use the columnar path then.
+        """
+        mro = type(self).__mro__
+        defines = [[klass for klass in mro if method_name in klass.__dict__][0]
+                   for method_name in ('extract_data', 'extract_batch')]
+        return mro.index(defines[0]) < mro.index(defines[1])
+
+    def get_data(self, dataset, event_list=None):
+        """Return data extracted from running over dataset"""
+        if not self.columnar:
+            return TreeMaker.get_data(self, dataset, event_list=event_list)
+        self.set_run_info(dataset)
+        stats = self.stats
+        if event_list is None:
+            event_list = self.start_checkpoints(dataset)
+        chunks = hax.paxroot.read_branches(dataset, self.columnar_branches,
+                                           chunk_size=self.chunk_size,
+                                           event_list=event_list,
+                                           desc='Making %s minitree' % self.__class__.__name__)
+        for chunk_i, arrays in enumerate(stats.timed(chunks, 'io')):
+            t0 = time.perf_counter()
+            if stats.should_profile(chunk_i):
+                result = stats.run_profiled(self.extract_batch, arrays)
+            else:
+                result = self.extract_batch(arrays)
+            t1 = time.perf_counter()
+            result = pd.DataFrame(result)
+            stats.add_time('extract', t1 - t0)
+            stats.add_time('cache', time.perf_counter() - t1)
+            stats.n_events += len(arrays)
+            if self.row_per_event:
+                if len(result) != len(arrays):
+                    raise ValueError("extract_batch of %s returned %d rows for %d events" % (
+                        self.__class__.__name__, len(result), len(arrays)))
+                # Add the run and event number to the result. This is required to make joins succeed later on.
+                result['event_number'] = arrays['event_number']
+            elif 'event_number' not in result.columns:
+                raise ValueError("extract_batch of %s must return the event_number of each row" % (
+                    self.__class__.__name__))
+            result['run_number'] = self.run_number
+            self.data.append(result)
+            if self.jagged:
+                self.visited.append(arrays['event_number'])
+            if self.checkpoint is not None:
+                self.checkpoint['n_entries'] += len(arrays)
+                if len(self.data) >= self.checkpoint['n_frames'] + hax.config['minitree_checkpoint_interval']:
+                    self.save_checkpoint()
+        if not len(self.data):
+            log.warning("Not a single row was extracted from dataset %s!" % dataset)
+            return pd.DataFrame([], columns=['event_number', 'run_number'])
+        hax.log.debug("Extraction completed, now concatenating data")
+        t0 = time.perf_counter()
+        result = pd.concat(self.data, ignore_index=True)
+        stats.add_time('cache', time.perf_counter() - t0)
+        return result
+
+
+class DerivedTreeMaker(TreeMaker):
+    """Base class for treemakers that compute their minitree from other minitrees, without looping over events.
+
+    List the treemakers whose minitrees you need in depends_on, and implement compute(frames).
+    frames is a dictionary mapping each of these treemaker names to its minitree (a pandas DataFrame).
+    compute must return a DataFrame (or dictionary of columns) with an event_number column;
+    we add the run_number column if it doesn't.
+
+    If you're seeing this as the documentation of an actual TreeMaker, somebody forgot to add documentation
+    for their treemaker.
+    """
+
+    def compute(self, frames):
+        raise NotImplementedError()
+
+    def get_data(self, dataset, event_list=None):
+        """Return data computed from the minitrees of depends_on for dataset"""
+        self.set_run_info(dataset)
+        frames = self.load_dependencies(dataset)
+        t0 = time.perf_counter()
+        result = pd.DataFrame(self.compute(frames))
+        self.stats.add_time('extract', time.perf_counter() - t0)
+        if 'event_number' not in result.columns:
+            raise ValueError("compute of %s must return the event_number of each row" % self.__class__.__name__)
+        if 'run_number' not in result.columns:
+            result['run_number'] = self.run_number
+        self.stats.n_events += len(result)
+
+        # Support for event list
+        if event_list is not None:
+            result = result[np.in1d(result['event_number'].values, event_list)]
+        return result
+
+
 def update_treemakers():
-    """Update the list of treemakers hax knows. Called on hax init, you should never have to call this yourself!"""
+    """Update the list of treemakers hax knows. Called on hax init, you should never have to call this yourself!
+    This does not import any treemaker modules, see TreeMakerRegistry.
+    """
     global TREEMAKERS
-    TREEMAKERS = {}
-    for module_filename in glob(os.path.join(hax.hax_dir + '/treemakers/*.py')):
+    # Fill the registry before setting TREEMAKERS, so other threads never see it half-filled
+    registry = TreeMakerRegistry()
+    for module_filename in sorted(glob(os.path.join(hax.hax_dir + '/treemakers/*.py'))):
         module_name = os.path.splitext(os.path.basename(module_filename))[0]
         if module_name.startswith('_'):
             continue
+        registry.add_module('hax.treemakers.%s' % module_name, module_filename)
+
+    # Treemakers from other packages, registered through entry points in the 'hax.treemakers' group. E.g. in setup.py:
+    #    entry_points={'hax.treemakers': ['MyTreeMaker = mypackage.treemakers:MyTreeMaker',   # A single treemaker
+    #                                     'mypackage = mypackage.treemakers']}                # All in this module
+    for entry_point in _treemaker_entry_points():
+        registry.add_entry_point(entry_point)
+    TREEMAKERS = registry
 
-        # Import the module, after which we can do hax.treemakers.blah
-        __import__('hax.treemakers.%s' % module_name, globals=globals())
-
-        # Now get all the treemakers defined in the module
-        for tm_name, tm in inspect.getmembers(
-            getattr(
-                hax.treemakers, module_name), lambda x: isinstance(
-                x, type) and issubclass(
-                x, TreeMaker)):
-            if tm_name == 'TreeMaker':
-                # This one is the base class; we get it because we did from ...
-                # import TreeMaker at the top of the file
-                continue
-            if tm_name in TREEMAKERS:
-                raise ValueError("Two treemakers named %s!" % tm_name)
-            TREEMAKERS[tm_name] = tm
+
+class TreeMakerRegistry(Mapping):
+    """Mapping of treemaker name -> treemaker class, used for hax.minitrees.TREEMAKERS.
+
+    Treemakers are found without importing their modules: we parse the module source, and take every class
+    that (directly or through other classes in the scanned modules) derives from TreeMaker or MultipleRowExtractor.
+    A treemaker's module is only imported when you first get its class from the registry.
+    Checking if a name is in the registry, listing the names, or getting the versions (if the class sets __version__
+    to a string literal, see versions()) does not import anything.
+    """
+    # Names of the base classes in hax.minitrees which make a class a treemaker
+    base_classes = ('TreeMaker', 'MultipleRowExtractor', 'VectorTreeMaker', 'DerivedTreeMaker')
+
+    def __init__(self):
+        # name -> dict with module, class_name, version (None if not known without importing), entry_point
+        self.entries = OrderedDict()
+        self.classes = {}
+
+    def add(self, name, module, class_name=None, version=None, entry_point=None):
+        """Register treemaker name, which is class class_name (default: name) in the module module"""
+        if name in self.entries:
+            raise ValueError("Two treemakers named %s!" % name)
+        self.entries[name] = dict(module=module, class_name=name if class_name is None else class_name,
+                                  version=version, entry_point=entry_point)
+
+    def add_module(self, module, filename):
+        """Register all treemakers defined in the python module module, whose source is in filename"""
+        for class_name, version in scan_treemaker_source(filename, self.base_classes):
+            self.add(class_name, module, version=version)
+
+    def add_entry_point(self, entry_point):
+        """Register the treemaker(s) from an entry point: either module:class, or a module with treemakers"""
+        target = _entry_point_target(entry_point)
+        if ':' in target:
+            self.add(entry_point.name, target.split(':')[0], entry_point=entry_point)
+            return
+        # Find the module's source without importing it
+        spec = importlib.util.find_spec(target)
+        if spec is None or not spec.has_location:
+            raise ValueError("Can't find source of treemaker module %s (entry point %s)" % (target, entry_point.name))
+        self.add_module(target, spec.origin)
+
+    def __getitem__(self, name):
+        if name not in self.classes:
+            entry = self.entries[name]
+            log.debug("Importing %s for treemaker %s" % (entry['module'], name))
+            if entry['entry_point'] is not None:
+                tm = entry['entry_point'].load()
+            else:
+                tm = getattr(importlib.import_module(entry['module']), entry['class_name'])
+            if not (isinstance(tm, type) and issubclass(tm, TreeMaker)):
+                raise ValueError("Treemaker %s from %s is not a TreeMaker child class, but a %s" % (
+                    name, entry['module'], type(tm)))
+            self.classes[name] = tm
+        return self.classes[name]
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def versions(self):
+        """Return dictionary treemaker name -> version. Only imports the treemakers whose version can't be
+        determined from the source (because __version__ is inherited or computed).
+        """
+        return {name: (entry['version'] if entry['version'] is not None
+                       else getattr(self[name], '__version__', None))
+                for name, entry in self.entries.items()}
+
+    def summary(self):
+        """Return a DataFrame with name, module, version and whether it has been imported of each treemaker"""
+        return pd.DataFrame([dict(name=name, module=entry['module'], version=entry['version'],
+                                  imported=name in self.classes)
+                             for name, entry in self.entries.items()],
+                            columns=['name', 'module', 'version', 'imported'])
+
+
+# Results of scan_treemaker_source, by (filename, modification time, base_classes)
+_source_scan_cache = {}
+
+
+def scan_treemaker_source(filename, base_classes=TreeMakerRegistry.base_classes):
+    """Return list of (class name, __version__) of treemakers defined in the python source file filename,
+    without importing it. Treemakers are classes deriving (possibly through other classes in the file)
+    from one of base_classes. __version__ is None unless the class body assigns it a string literal.
+    """
+    key = (os.path.abspath(filename), os.path.getmtime(filename), tuple(base_classes))
+    if key in _source_scan_cache:
+        return _source_scan_cache[key]
+
+    with open(filename, mode='rb') as f:
+        tree = ast.parse(f.read(), filename=filename)
+
+    classes = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        # Base classes can be referred to as Name or module.Name (e.g. hax.minitrees.TreeMaker)
+        bases = [b.id if isinstance(b, ast.Name) else b.attr
+                 for b in node.bases if isinstance(b, (ast.Name, ast.Attribute))]
+        version = None
+        for statement in node.body:
+            if (isinstance(statement, ast.Assign) and len(statement.targets) == 1 and
+                    isinstance(statement.targets[0], ast.Name) and statement.targets[0].id == '__version__'):
+                try:
+                    version = ast.literal_eval(statement.value)
+                except ValueError:
+                    version = None
+                if not isinstance(version, str):
+                    version = None
+        classes.append((node.name, bases, version))
+
+    # Find the treemaker classes, including those deriving from other treemakers in this file
+    treemaker_names = set(base_classes)
+    found_new = True
+    while found_new:
+        found_new = False
+        for class_name, bases, version in classes:
+            if class_name not in treemaker_names and treemaker_names.intersection(bases):
+                treemaker_names.add(class_name)
+                found_new = True
+    result = [(class_name, version) for class_name, bases, version in classes
+              if class_name in treemaker_names and class_name not in base_classes]
+
+    _source_scan_cache[key] = result
+    return result
+
+
+def _treemaker_entry_points():
+    """Return the entry points in the 'hax.treemakers' group of all installed packages"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points('hax.treemakers'))
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group='hax.treemakers'))
+    return list(eps.get('hax.treemakers', []))
+
+
+def _entry_point_target(entry_point):
+    """Return 'module' or 'module:attribute' which the entry point refers to"""
+    if hasattr(entry_point, 'value'):
+        # importlib.metadata
+        return entry_point.value.replace(' ', '')
+    # pkg_resources
+    if entry_point.attrs:
+        return '%s:%s' % (entry_point.module_name, '.'.join(entry_point.attrs))
+    return entry_point.module_name
+
+
+def _includes_corrections(treemakers):
+    """Return if the Corrections treemaker (by name or class) is in the list treemakers.
+    Checks by name, so we don't have to import the corrections treemaker module just for this.
+    """
+    return any(tm == 'Corrections' or (isinstance(tm, type) and tm.__name__ == 'Corrections')
+               for tm in treemakers)
 
 
 def _minitree_filename(run_name, treemaker_name, extension):
@@ -182,7 +642,7 @@ def check(run_id, treemaker, force_reload=False):
     """
     run_name = runs.get_run_name(run_id)
     treemaker_name, treemaker = get_treemaker_name_and_class(treemaker)
-    preferred_format = hax.config['preferred_minitree_format']
+    preferred_format = 'npz' if treemaker.jagged else hax.config['preferred_minitree_format']
 
     # If we need to remake the minitree, where would we place it?
     minitree_filename = _minitree_filename(
@@ -291,7 +751,9 @@ def load_single_minitree(run_id,
                          force_reload=False,
                          return_metadata=False,
                          save_file=None,
-                         event_list=None):
+                         event_list=None,
+                         jagged=False,
+                         dependency_frames=None):
     """Return pandas DataFrame resulting from running treemaker on run_id (name or number)
 
     :param run_id: name or number of the run to load
@@ -306,6 +768,12 @@ def load_single_minitree(run_id,
 
     :param event_list: List of event numbers to visit. Forces save_file=False, force_reload=True.
 
+    :param jagged: return a hax.jagged.JaggedTable instead (only for treemakers with jagged = True)
+
+    :param dependency_frames: mapping treemaker name -> minitree of run_id (e.g. a RunMinitrees), from which
+                              the treemaker gets the minitrees in its depends_on if we have to make the minitree.
+                              By default, these are loaded with load_single_minitree.
+
     :returns: pandas.DataFrame
     """
     if save_file is None:
@@ -316,9 +784,27 @@ def load_single_minitree(run_id,
 
     treemaker, already_made, minitree_path = check(
         run_id, treemaker, force_reload=force_reload)
+    if jagged and not treemaker.jagged:
+        raise ValueError("Treemaker %s does not make jagged minitrees" % treemaker.__name__)
 
     if already_made:
-        return get_format(minitree_path).load_data()
+        stats = hax.profiling.BuildStats(treemaker.__name__, runs.get_run_name(run_id))
+        stats.loaded_from_disk = True
+        stats.start()
+        t0 = time.perf_counter()
+        minitree_format = get_format(minitree_path)
+        if jagged and hasattr(minitree_format, 'load_jagged'):
+            data = minitree_format.load_jagged()
+        else:
+            data = minitree_format.load_data()
+            if jagged:
+                # Minitree made before the treemaker was jagged, events without rows are lost
+                data = hax.jagged.JaggedTable.from_dataframe(data)
+        stats.add_time('load', time.perf_counter() - t0)
+        stats.n_rows = len(data)
+        stats.finish()
+        hax.profiling.record(stats)
+        return data
 
     if not hax.config['make_minitrees'] and not treemaker.never_store:
         # The user didn't want me to make a new minitree :-(
@@ -327,26 +813,48 @@ def load_single_minitree(run_id,
             (run_id, treemaker.__name__))
 
     # We have to make the minitree file
-    # This will raise FileNotFoundError if the root file is not found
-    skimmed_data = treemaker().get_data(run_id, event_list=event_list)
-
-    log.debug(
-        "Retrieved %s minitree data for dataset %s" %
-        (treemaker.__name__, run_id))
-
-    metadata_dict = dict(
-        version=treemaker.__version__,
-        extra=treemaker.extra_metadata,
-        pax_version=hax.paxroot.get_metadata(run_id)['file_builder_version'],
-        hax_version=hax.__version__,
-        created_by=get_user_id(),
-        event_list=event_list,
-        documentation=treemaker.__doc__,
-        timestamp=str(
-            datetime.now()))
-
+    tm = treemaker()
+    tm.dependency_frames = dependency_frames
     if save_file and not treemaker.never_store:
-        get_format(minitree_path, treemaker).save_data(metadata_dict, skimmed_data)
+        tm.checkpoint_path = minitree_path + '.checkpoint'
+    stats = tm.stats
+    stats.run_name = runs.get_run_name(run_id)
+    stats.start()
+    try:
+        # This will raise FileNotFoundError if the root file is not found
+        skimmed_data = tm.get_data(run_id, event_list=event_list)
+        stats.n_rows = len(skimmed_data)
+
+        log.debug(
+            "Retrieved %s minitree data for dataset %s" %
+            (treemaker.__name__, run_id))
+
+        metadata_dict = dict(
+            version=treemaker.__version__,
+            extra=treemaker.extra_metadata,
+            pax_version=hax.paxroot.get_metadata(run_id)['file_builder_version'],
+            hax_version=hax.__version__,
+            created_by=get_user_id(),
+            event_list=event_list,
+            documentation=treemaker.__doc__,
+            timestamp=str(
+                datetime.now()))
+
+        if treemaker.jagged and (jagged or save_file):
+            table = tm.jagged_table(skimmed_data)
+            if jagged:
+                skimmed_data = table
+
+        if save_file and not treemaker.never_store:
+            t0 = time.perf_counter()
+            get_format(minitree_path, treemaker).save_data(metadata_dict, table if treemaker.jagged else skimmed_data)
+            tm.remove_checkpoint()
+            stats.add_time('save', time.perf_counter() - t0)
+    except Exception:
+        stats.finish(log_stats=False)
+        raise
+    stats.finish()
+    hax.profiling.record(stats)
 
     if return_metadata:
         return metadata_dict, skimmed_data
@@ -354,6 +862,86 @@ def load_single_minitree(run_id,
     return skimmed_data
 
 
+def load_jagged(datasets, treemaker, force_reload=False):
+    """Return hax.jagged.JaggedTable with the minitrees of treemaker (which must have jagged = True)
+    for one or several datasets. Unlike load, this keeps the flat layout: peak properties are flat arrays,
+    with event offsets, rather than rows with the event columns repeated.
+
+    :param datasets: name or number of a dataset, or list of these
+
+    :param treemaker: treemaker class or name
+
+    :param force_reload: always remake the minitrees, never load them from disk.
+    """
+    if isinstance(datasets, (str, int, np.integer)):
+        datasets = [datasets]
+    return hax.jagged.JaggedTable.concatenate([
+        load_single_minitree(dataset, treemaker, force_reload=force_reload, jagged=True)
+        for dataset in datasets])
+
+
+class RunMinitrees(Mapping):
+    """Mapping treemaker name -> minitree of run_id. Each minitree is loaded (or made) the first time you ask for it,
+    and kept: however many treemakers depend on a minitree, it is loaded only once.
+    Treemakers made to get a minitree get their dependencies from here too.
+
+    :param force_reload: names of treemakers whose minitrees should be remade rather than loaded from disk
+
+    :param treemakers: treemaker classes to use for these names, rather than those in TREEMAKERS
+    """
+
+    def __init__(self, run_id, force_reload=(), treemakers=()):
+        self.run_id = run_id
+        self.force_reload = force_reload
+        self.treemakers = dict([get_treemaker_name_and_class(tm) for tm in treemakers])
+        self.frames = OrderedDict()
+        # hax.profiling.BuildStats of the minitrees we loaded
+        self.stats = OrderedDict()
+
+    def __getitem__(self, name):
+        if name not in self.frames:
+            with hax.profiling.collect_stats() as stats:
+                self.frames[name] = load_single_minitree(self.run_id, self.treemakers.get(name, name),
+                                                         force_reload=name in self.force_reload,
+                                                         dependency_frames=self)
+            # The minitree finished last; the others were loaded by its treemaker
+            self.stats[name] = stats[-1]
+        return self.frames[name]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+
+def dependency_graph(treemakers):
+    """Return OrderedDict treemaker name -> tuple of names of the treemakers it depends on (see TreeMaker.depends_on),
+    for treemakers and the treemakers they depend on (directly or indirectly).
+    Every treemaker comes after the treemakers it depends on. Raises ValueError if the dependencies are circular.
+
+    :param treemakers: list of treemaker classes / names
+    """
+    graph = OrderedDict()
+    path = []
+
+    def visit(treemaker):
+        name, treemaker = get_treemaker_name_and_class(treemaker)
+        if name in graph:
+            return name
+        if name in path:
+            raise ValueError("Circular treemaker dependencies: %s" % ' -> '.join(path[path.index(name):] + [name]))
+        path.append(name)
+        dependencies = tuple(visit(d) for d in treemaker.depends_on)
+        path.pop()
+        graph[name] = dependencies
+        return name
+
+    for tm in treemakers:
+        visit(tm)
+    return graph
+
+
 def load_single_dataset(run_id, treemakers, preselection=None, force_reload=False, event_list=None):
     """Run multiple treemakers on a single run
 
@@ -371,37 +959,65 @@ def load_single_dataset(run_id, treemakers, preselection=None, force_reload=Fals
     :param event_list: List of event numbers to visit. Disables load from / save to file.
 
     """
+    with hax.profiling.collect_stats() as stats:
+        result, history = _load_single_dataset(run_id, treemakers, preselection=preselection,
+                                               force_reload=force_reload, event_list=event_list)
+    if not hax.profiling.is_active():
+        # Not called by a treemaker (which loads other minitrees) but by the user
+        last_stats[:] = stats
+    return result, history
+
+
+def _load_single_dataset(run_id, treemakers, preselection=None, force_reload=False, event_list=None):
+    """Return (dataframe, cut history) of treemakers for run_id, see load_single_dataset"""
     if isinstance(treemakers, (type, str)):
         treemakers = [treemakers]
     if isinstance(preselection, str):
         preselection = [preselection]
     if preselection is None:
         preselection = []
-    dataframes = []
 
-    for treemaker in treemakers:
+    treemaker_names = [get_treemaker_name_and_class(tm)[0] for tm in treemakers]
+    graph = dependency_graph(treemakers)
+    minitrees = RunMinitrees(run_id, force_reload=treemaker_names if force_reload else (), treemakers=treemakers)
+    dataframes = OrderedDict()
+    # Minitrees that other treemakers depend on are loaded (or made) only once, before the minitrees that need them.
+    # We go from dependents to dependencies: so a dependency which also has to be loaded for an event list is only
+    # loaded for all events if a dependent needed it.
+    for name in reversed(graph):
+        if name not in treemaker_names:
+            continue
         try:
-            dataset_frame = load_single_minitree(
-                run_id, treemaker, force_reload=force_reload, event_list=event_list)
+            if event_list is None or name in minitrees.frames:
+                dataframes[name] = minitrees[name]
+            else:
+                with hax.profiling.collect_stats() as stats:
+                    dataframes[name] = load_single_minitree(run_id, minitrees.treemakers[name],
+                                                            event_list=event_list, dependency_frames=minitrees)
+                minitrees.stats[name] = stats[-1]
         except NoMinitreeAvailable as e:
             log.debug(str(e))
             return pd.DataFrame([], columns=['event_number', 'run_number']), []
-        dataframes.append(dataset_frame)
+        if event_list is not None and name in minitrees.frames:
+            # Loaded for all events, since another treemaker depends on it
+            df = dataframes[name]
+            dataframes[name] = df[np.in1d(df['event_number'].values, event_list)]
 
     # Merge mini-trees of all types by inner join
     # (propagating "cuts" applied by skipping rows in MultipleRowExtractor)
     if not len(dataframes):
         raise RuntimeError("No data was extracted? What's going on??")
-    result = dataframes[0]
-    for i in range(1, len(dataframes)):
-        result = _merge_minitrees(result, dataframes[i])
+    result = dataframes[treemaker_names[0]]
+    for name in treemaker_names[1:]:
+        t0 = time.perf_counter()
+        result = _merge_minitrees(result, dataframes[name])
+        minitrees.stats[name].add_time('merge', time.perf_counter() - t0)
 
     # Apply the unblinding selection if required.
     # Normally this is already done by minitrees.load, but perhaps someone calls
     # load_single_dataset_directly.
     if (hax.unblinding.unblinding_selection not in preselection and
-        ('Corrections' in treemakers or
-         hax.treemakers.corrections.Corrections in treemakers) and
+        _includes_corrections(treemakers) and
             hax.unblinding.is_blind(run_id)):
         preselection = [hax.unblinding.unblinding_selection] + preselection
 
@@ -412,6 +1028,13 @@ def load_single_dataset(run_id, treemakers, preselection=None, force_reload=Fals
     return result, cuts._get_history(result)
 
 
+def _load_single_dataset_with_stats(*args, **kwargs):
+    """Return load_single_dataset(*args, **kwargs) + (stats of the minitrees loaded,), without changing last_stats"""
+    with hax.profiling.collect_stats() as stats:
+        result = _load_single_dataset(*args, **kwargs)
+    return result + (stats,)
+
+
 def _merge_minitrees(mt1, mt2):
     """Returns merger of minitree dataframes mt1 and mt2, which have the same """
     # To avoid creation of duplicate columns (which will get _x and _y suffixes),
@@ -446,7 +1069,9 @@ def load(datasets=None,
 
     :param force_reload: if True, will force mini-trees to be re-made whether they are outdated or not.
 
-    :param delayed:  Instead of computing a pandas DataFrame, return a dask DataFrame (default False)
+    :param delayed:  Instead of computing a pandas DataFrame, return a dask DataFrame (default False).
+                     Cuts on it track their passthrough counts lazily: use hax.cuts.compute to compute the
+                     dataframe and its cut history in one pass.
 
     :param num_workers: Number of dask workers to use in computation (if delayed=False)
 
@@ -495,9 +1120,8 @@ def load(datasets=None,
 
     # If the blinding cut is required for any of the datasets, apply it to all of them.
     # This avoids crashing or paradoxical cut histories.
-    if (hax.unblinding.unblinding_selection not in preselection and (
-            'Corrections' in treemakers or hax.treemakers.corrections.Corrections in treemakers)):
-        is_blind = [hax.unblinding.is_blind(run_id) for run_id in datasets]
+    if (hax.unblinding.unblinding_selection not in preselection and _includes_corrections(treemakers)):
+        is_blind = hax.unblinding.is_blind_many(datasets)
         if any(is_blind):
             if not all(is_blind):
                 log.warning(
@@ -505,24 +1129,38 @@ def load(datasets=None,
                     "The blinding cut will be applied to all data you're loading.")
             preselection = [hax.unblinding.unblinding_selection] + preselection
 
+    del last_stats[:]
     partial_results = []
     partial_histories = []
-    for dataset in datasets:
-        mashup = dask.delayed(load_single_dataset)(
+    partial_stats = []
+    # One task per dataset: it loads each minitree of the dataset once, after those it depends on
+    # (see load_single_dataset). Minitrees of different datasets never depend on each other.
+    for i, dataset in enumerate(datasets):
+        mashup = dask.delayed(_load_single_dataset_with_stats)(
             dataset, treemakers, preselection, force_reload=force_reload, event_list=event_list)
+        if i == 0:
+            # We need the first dataset to know the columns of the dataframe. Load it here, and put the result
+            # in the graph, so its minitrees aren't loaded a second time.
+            first = mashup.compute()
+            meta = first[0]
+            last_stats[:] = first[2]
+            mashup = dask.delayed(first, traverse=False)
         partial_results.append(dask.delayed(lambda x: x[0])(mashup))
         partial_histories.append(dask.delayed(lambda x: x[1])(mashup))
+        partial_stats.append(dask.delayed(lambda x: x[2])(mashup))
 
-    result = dask.dataframe.from_delayed(
-        partial_results, meta=partial_results[0].compute())
+    result = dask.dataframe.from_delayed(partial_results, meta=meta)
 
     if not delayed:
         # Dask doesn't seem to want to descend into the lists beyond the first.
         # So we mash things into one list before calling compute, then split it
         # again
-        mashedup_result = dask.compute(*([result] + partial_histories),
+        mashedup_result = dask.compute(*([result] + partial_histories + partial_stats),
                                        num_workers=num_workers, **compute_options)
         result = mashedup_result[0]
+        partial_histories = mashedup_result[1:len(datasets) + 1]
+        # The minitrees may have been made in other processes, so we collect their stats here
+        last_stats[:] = [s for stats_list in mashedup_result[len(datasets) + 1:] for s in stats_list]
 
         if 'index' in result.columns:
             # Clean up index, remove 'index' column
@@ -536,14 +1174,14 @@ def load(datasets=None,
         # Combine the histories of partial results.
         # For unavailable minitrees, the histories will be empty: filter these
         # empty histories out
-        partial_histories = mashedup_result[1:]
         partial_histories = [x for x in partial_histories if len(x)]
         if len(partial_histories):
             cuts.record_combined_histories(result, partial_histories)
 
     else:
-        # Magic for tracking of cut histories while using dask.dataframe here...
-        pass
+        # The passthrough counts of the preselection are computed together with the dataframe,
+        # see cuts.compute
+        result.cut_history = cuts.DelayedCutHistory(partial_histories, preselection)
 
     if cache_file:
         save_cache_file(result, cache_file)
@@ -555,11 +1193,11 @@ def function_over_events(function, dataframe, branch_selection=None, **kwargs):
     """Generator which yields `function(event, **kwargs)` of each processed data event in dataframe
     """
     for run_number, events in pd.groupby(dataframe, 'run_number'):
-        yield from function_results_datasets(run_number,
-                                             function,
-                                             events.event_number.values,
-                                             branch_selection=branch_selection,
-                                             kwargs=kwargs)
+        yield from hax.paxroot.function_results_datasets(run_number,
+                                                         function,
+                                                         events.event_number.values,
+                                                         branch_selection=branch_selection,
+                                                         kwargs=kwargs)
 
 
 def extend(data, treemakers):
@@ -609,9 +1247,9 @@ def save_cache_file(data, cache_file, **kwargs):
 def get_treemaker_name_and_class(tm):
     """Return (name, class) of treemaker name or class tm"""
     if isinstance(tm, str):
-        if tm not in TREEMAKERS:
+        if tm not in hax.minitrees.TREEMAKERS:
             raise ValueError("No TreeMaker named %s known to hax!" % tm)
-        tm_name, tm_class = tm, TREEMAKERS[tm]
+        tm_name, tm_class = tm, hax.minitrees.TREEMAKERS[tm]
     elif isinstance(tm, type) and issubclass(tm, TreeMaker):
         tm_name, tm_class = tm.__name__, tm
     else:
@@ -7,10 +7,12 @@ import json
 import warnings
 
 from tqdm import tqdm
-from pax.exceptions import MaybeOldFormatException
 
 try:
+    # numba must be imported before ROOT, otherwise their LLVM versions clash
+    import numba  # noqa
     import ROOT
+    from pax.exceptions import MaybeOldFormatException
     from pax.plugins.io.ROOTClass import load_event_class, load_pax_event_class_from_root, ShutUpROOT
 except ImportError as e:
     warnings.warn("Error importing ROOT-related libraries: %s. "
@@ -23,6 +25,10 @@ from hax.utils import find_file_in_folders
 
 log = logging.getLogger('hax.paxroot')
 
+# Cache of metadata dictionaries read from pax root files, keyed by (filename, modification time)
+# Reading the metadata means opening the root file, which is slow if you do it for thousands of runs.
+_metadata_cache = {}
+
 
 def get_filename(run_id):
     try:
@@ -63,18 +69,29 @@ def _open_pax_rootfile(filename, load_class=True):
 
 
 def get_metadata(run_id):
-    """Returns the metadata dictionary stored in the pax root file for run_id.
+    """Returns the metadata dictionary stored in the pax root file for run_id
+    (or given by the event source, if you're not using pax root files, see hax.event_sources).
     """
-    return _get_metadata(get_filename(run_id))
+    return hax.event_sources.get_event_source(run_id).get_metadata()
 
 
 def _get_metadata(filename):
+    if os.path.exists(filename):
+        cache_key = (os.path.abspath(filename), os.path.getmtime(filename))
+        if cache_key in _metadata_cache:
+            return _metadata_cache[cache_key]
+    else:
+        cache_key = None
+
     # Suppress warning about classes not being loaded (we're doing that on purpose)
     with ShutUpROOT():
         f = _open_pax_rootfile(filename, load_class=False)
     metadata = f.Get('pax_metadata').GetTitle()
     metadata = json.loads(metadata)
     f.Close()
+
+    if cache_key is not None:
+        _metadata_cache[cache_key] = metadata
     return metadata
 
 
@@ -118,43 +135,47 @@ def function_results_datasets(datasets_names,
             event_lists = [event_lists]
 
     for dset_i, run_id in enumerate(datasets_names):
-        rootfile = open_pax_rootfile(run_id)
-        # If you get "'TObject' object has no attribute 'GetEntries'" here,
-        # we renamed the tree to T1 or TPax or something... or you're trying to load a Xerawdp root file!
-        t = rootfile.Get('tree')
-
         if branch_selection == 'basic':
             branch_selection = hax.config['basic_branches']
 
-        # Activate the desired branches
-        if branch_selection:
-            t.SetBranchStatus("*", 0)
-            for bn in branch_selection:
-                t.SetBranchStatus(bn, 1)
-
-        try:
-            if event_lists is None:
-                # Visit all events
-                n_events = t.GetEntries()
-                source = range(n_events)
-            else:
-                # Visit only the desired events
-                source = event_lists[dset_i]
-                n_events = len(source)
-            if hax.config.get('tqdm_on', True):
-                source = tqdm(source,
-                              desc='Run %s: %s' % (run_id, desc),
-                              total=n_events)
-            for event_i in source:
-                t.GetEntry(event_i)
-                event = t.events
-                yield event_function(event, **kwargs)
-
-        except StopEventLoop:
-            rootfile.Close()
-        except Exception as e:
-            rootfile.Close()
-            raise e
+        with hax.event_sources.get_event_source(run_id) as source:
+            try:
+                if event_lists is None:
+                    # Visit all events
+                    event_list = None
+                    n_events = source.n_events
+                else:
+                    # Visit only the desired events
+                    event_list = event_lists[dset_i]
+                    n_events = len(event_list)
+                events = source.iter_events(event_list=event_list, branch_selection=branch_selection)
+                if hax.config.get('tqdm_on', True):
+                    events = tqdm(events,
+                                  desc='Run %s: %s' % (run_id, desc),
+                                  total=n_events)
+                for event in events:
+                    yield event_function(event, **kwargs)
+
+            except StopEventLoop:
+                pass
+
+
+def read_branches(run_id, branches, chunk_size=None, event_list=None, desc=''):
+    """Returns a generator which yields numpy structured arrays with the values of branches for chunks of events
+    in the pax root file of run_id. This is the columnar alternative to function_results_datasets:
+    the data is read by root_numpy in large chunks, rather than one event at a time through PyROOT.
+
+    Branches with a value per peak, interaction etc. (e.g. peaks.area) are returned as object arrays,
+    with an array of values for each event. See hax.jagged for functions to work with these.
+
+    :param branches: list of branch names to read, e.g. ['event_number', 'peaks.area']
+    :param chunk_size: number of events to read at once. Defaults to the columnar_chunk_size option.
+    :param event_list: entry numbers of the events to read (default: all events). For each chunk,
+                       we read all events between the first and last desired event, then select the desired ones.
+    :param desc: Description used in the tqdm progressbar
+    """
+    with hax.event_sources.get_event_source(run_id) as source:
+        yield from source.read_branches(branches, chunk_size=chunk_size, event_list=event_list, desc=desc)
 
 
 def loop_over_datasets(*args, **kwargs):
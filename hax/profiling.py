@@ -0,0 +1,230 @@
+"""Instrumentation of minitree building: time spent per stage, event rate, memory use and bytes read.
+
+hax.minitrees.load_single_minitree records a BuildStats for every minitree it makes or loads (see collect_stats).
+The BuildStats of the last load or load_single_dataset call are in hax.minitrees.last_stats.
+Set the minitree_stats_log option to also append them to a file, as one JSON object per line.
+
+Set the profile_extract_data option to n to run extract_data (or extract_batch for columnar treemakers)
+in cProfile for every n-th event (or chunk). Use BuildStats.profile() to look at the results.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import cProfile
+import json
+import logging
+import os
+import pstats
+import socket
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import hax
+
+log = logging.getLogger('hax.profiling')
+
+# Stages of making a minitree we keep time of:
+#  - io: getting events from the event source (for pax ROOT files, mostly TTree::GetEntry)
+#  - extract: the treemaker's extract_data / extract_batch
+#  - cache: converting extracted rows into dataframes, and concatenating these
+#  - load: loading an existing minitree from disk
+#  - merge: merging the minitree with the others loaded for the same run (in load_single_dataset)
+#  - save: saving the minitree to disk
+STAGES = ('io', 'extract', 'cache', 'load', 'merge', 'save')
+
+# Per thread (minitrees of different runs can be made in parallel threads, e.g. by dask):
+#  - active: BuildStats of the minitrees being made. Minitrees can load other minitrees,
+#    so this is a stack: the last one is the minitree made by the innermost treemaker.
+#  - collectors: lists to which record adds BuildStats, see collect_stats.
+_local = threading.local()
+
+
+def _thread_state():
+    if not hasattr(_local, 'active'):
+        _local.active = []
+        _local.collectors = []
+    return _local
+
+
+class BuildStats(object):
+    """Statistics of making (or loading) the minitree of one treemaker for one run"""
+
+    def __init__(self, treemaker, run_name=None):
+        self.treemaker = treemaker
+        self.run_name = run_name
+        self.loaded_from_disk = False
+        self.n_events = 0
+        self.n_rows = 0
+        self.times = OrderedDict([(stage, 0.) for stage in STAGES])
+        self.wall_time = 0.
+        self.bytes_read = 0
+        self.peak_rss = None
+        self.profile_every = int(hax.config.get('profile_extract_data', 0) or 0)
+        self.profile_stats = {}
+        self.n_profiled = 0
+        self.timestamp = None
+        self._t_start = None
+
+    def __repr__(self):
+        return 'BuildStats(%s, %s: %d events, %0.2f s)' % (self.treemaker, self.run_name,
+                                                           self.n_events, self.wall_time)
+
+    def start(self):
+        """Start the wall clock, and attribute bytes read by event sources to this minitree until finish"""
+        self.timestamp = str(datetime.now())
+        self._t_start = time.time()
+        _thread_state().active.append(self)
+
+    def finish(self, log_stats=True):
+        """Stop the wall clock, record the peak memory use and log the stats (if minitree_stats_log is set).
+        :param log_stats: if False, don't log the stats (e.g. if making the minitree failed)
+        """
+        self.wall_time += time.time() - self._t_start
+        active = _thread_state().active
+        if self in active:
+            active.remove(self)
+        self.peak_rss = peak_rss()
+        filename = hax.config.get('minitree_stats_log')
+        if filename and log_stats:
+            with open(filename, mode='a') as outfile:
+                outfile.write(json.dumps(self.as_dict()) + '\n')
+
+    def add_time(self, stage, seconds):
+        self.times[stage] += seconds
+
+    def timed(self, iterable, stage='io'):
+        """Yield the items of iterable, adding the time spent getting them to stage"""
+        iterator = iter(iterable)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.times[stage] += time.perf_counter() - t0
+            yield item
+
+    @property
+    def events_per_second(self):
+        if not self.n_events or not self.wall_time:
+            return float('nan')
+        return self.n_events / self.wall_time
+
+    def should_profile(self, i):
+        """Return whether to profile the i-th call of extract_data (or extract_batch)"""
+        return self.profile_every > 0 and i % self.profile_every == 0
+
+    def run_profiled(self, f, *args):
+        """Return f(*args), run in cProfile. The results are added to the profile of this minitree."""
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(f, *args)
+        finally:
+            profiler.create_stats()
+            self.n_profiled += 1
+            self._add_profile(profiler.stats)
+
+    def _add_profile(self, new_stats):
+        for func, (cc, nc, tt, ct, callers) in new_stats.items():
+            if func not in self.profile_stats:
+                self.profile_stats[func] = (cc, nc, tt, ct, dict(callers))
+                continue
+            old_cc, old_nc, old_tt, old_ct, old_callers = self.profile_stats[func]
+            self.profile_stats[func] = (old_cc + cc, old_nc + nc, old_tt + tt, old_ct + ct,
+                                        pstats.add_callers(old_callers, callers))
+
+    def profile(self):
+        """Return pstats.Stats of the profiled extract_data calls, or None if nothing was profiled.
+        For example, stats.profile().sort_stats('cumulative').print_stats(20)
+        """
+        if not self.profile_stats:
+            return None
+        return pstats.Stats(_ProfileData(self.profile_stats))
+
+    def as_dict(self):
+        """Return the statistics as a dictionary (without the profile), e.g. for putting in a DataFrame"""
+        result = OrderedDict([('treemaker', self.treemaker),
+                              ('run_name', self.run_name),
+                              ('loaded_from_disk', self.loaded_from_disk),
+                              ('n_events', self.n_events),
+                              ('n_rows', self.n_rows),
+                              ('wall_time', self.wall_time),
+                              ('events_per_second', self.events_per_second)])
+        for stage, seconds in self.times.items():
+            result['time_' + stage] = seconds
+        result.update([('peak_rss', self.peak_rss),
+                       ('bytes_read', self.bytes_read),
+                       ('n_profiled', self.n_profiled),
+                       ('host', socket.gethostname()),
+                       ('pid', os.getpid()),
+                       ('timestamp', self.timestamp)])
+        return result
+
+
+class _ProfileData(object):
+    """Profile results in the form pstats.Stats accepts (anything with a create_stats method and stats)"""
+
+    def __init__(self, stats):
+        self.stats = dict(stats)
+
+    def create_stats(self):
+        pass
+
+
+def add_bytes_read(n_bytes):
+    """Attribute n_bytes read from disk to the minitree currently being made in this thread (if any)"""
+    active = _thread_state().active
+    if active:
+        active[-1].bytes_read += n_bytes
+
+
+def is_active():
+    """Return whether a minitree is currently being made in this thread (i.e. we are inside a treemaker)"""
+    return len(_thread_state().active) > 0
+
+
+def record(stats):
+    """Add BuildStats stats to the lists of all collect_stats blocks this thread is in"""
+    for collected in _thread_state().collectors:
+        collected.append(stats)
+
+
+@contextmanager
+def collect_stats():
+    """Context manager giving a list, to which the BuildStats recorded in this thread inside the with block
+    are added (in the order the minitrees were finished). For example:
+        with hax.profiling.collect_stats() as stats:
+            hax.minitrees.load_single_minitree(run, 'Basics')
+    """
+    collectors = _thread_state().collectors
+    collected = []
+    collectors.append(collected)
+    try:
+        yield collected
+    finally:
+        # with blocks in a thread are nested, so ours is the innermost
+        collectors.pop()
+
+
+def peak_rss():
+    """Return peak resident memory use of this process so far in bytes, or None if we can't tell"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if os.uname().sysname == 'Darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def stats_frame(stats_list):
+    """Return a DataFrame with a row for each BuildStats in stats_list (e.g. hax.minitrees.last_stats)"""
+    import pandas as pd
+    return pd.DataFrame([s.as_dict() for s in stats_list])
@@ -8,7 +8,6 @@ import os
 import fnmatch
 import re
 import pandas as pd
-import pymongo
 import numpy as np
 
 import hax
@@ -16,14 +15,21 @@ from hax.utils import flatten_dict
 
 log = logging.getLogger('hax.runs')
 
-# This will hold the dataframe containing dataset info
-# DO NOT import this directly (from hax.runs import datasets), you will
-# just get None!
-datasets = None
+# hax.runs.datasets will hold the dataframe containing dataset info,
+# hax.runs.corrections_docs the correction documents from the runs database.
+# These are loaded on first access after hax.init(), see hax.get_lazy_attribute.
+# DO NOT import these directly (from hax.runs import datasets), you will
+# not see later updates!
+lazy_attributes = {'datasets': ('datasets', lambda: None),
+                   'corrections_docs': ('corrections', dict)}
 
 rundb_client = None
 
-corrections_docs = {}
+
+def __getattr__(name):
+    if name in lazy_attributes:
+        return hax.get_lazy_attribute('runs', name)
+    raise AttributeError("module 'hax.runs' has no attribute '%s'" % name)
 
 
 def get_rundb_password():
@@ -41,6 +47,7 @@ def get_rundb_database():
     """Return the pymongo handle to the runs db database. You can use this to access other collections."""
     global rundb_client
     if rundb_client is None:
+        import pymongo
         # Connect to the runs database
         rundb_client = pymongo.MongoClient(hax.config['runs_url'].format(password=get_rundb_password()))
     return(rundb_client[hax.config['runs_database']])
@@ -61,12 +68,19 @@ def update_datasets(query=None):
 
     version_policy = hax.config['pax_version_policy']
 
-    if not hax.config.get('use_runs_db', True):
+    synthetic = hax.config.get('event_source', 'root') == 'synthetic'
+
+    if not hax.config.get('use_runs_db', True) and not synthetic:
         hax.log.info("Not looking for datasets in runs, db since you put use_runs_db = False")
         return
 
-    if experiment == 'XENON100':
+    if synthetic:
+        # The synthetic event source makes up its own datasets, see hax.event_sources
+        datasets = hax.event_sources.synthetic_datasets()
+
+    elif experiment == 'XENON100':
         # Fetch runs information from static csv files in runs info
+        datasets = None
         for rundbfile in glob(os.path.join(hax.config['runs_info_dir'], '*.csv')):
             tpc, run = os.path.splitext(os.path.basename(rundbfile))[0].split('_')
             dsets = pd.read_csv(rundbfile)
@@ -240,7 +254,7 @@ def get_run_info(run_id, projection_query=None):
         if multi_run_mode or single_field_mode:
             raise NotImplementedError(
                 "For XENON100, only single-run, full run info queries are supported")
-        return datasets[np.in1d(datasets['name'], run_names)].iloc[0].to_dict()
+        return hax.runs.datasets[np.in1d(hax.runs.datasets['name'], run_names)].iloc[0].to_dict()
 
     elif hax.config['experiment'] == 'XENON1T':
         collection = get_rundb_collection()
@@ -270,7 +284,7 @@ get_dataset_info = get_run_info    # Synonym
 
 def datasets_query(query):
     """Return names of datasets matching query"""
-    return datasets.query(query)['name'].values
+    return hax.runs.datasets.query(query)['name'].values
 
 
 def get_run_name(run_id):
@@ -299,7 +313,7 @@ def get_run_start(run_id):
         qid = '"%s"' % run_id
 
     try:
-        return datasets.query('%s == %s' % (field, qid))['start'].values[0]
+        return hax.runs.datasets.query('%s == %s' % (field, qid))['start'].values[0]
 
     except Exception as e:
         print("Didn't find a start time for run %s: %s" % (str(run_id), str(e)))
@@ -341,7 +355,7 @@ def get_run_number(run_id):
         # We can't find the file, so can't check if it is MC data. Assume it's ordinary data
         pass
 
-    matching_runs = datasets.query('name == "%s"' % run_id)['number']
+    matching_runs = hax.runs.datasets.query('name == "%s"' % run_id)['number']
 
     if not len(matching_runs):
         raise ValueError("Could not find run number: no run named %s in database." % run_id)
@@ -444,6 +458,7 @@ def load_corrections():
     """
 
     global corrections_docs
+    corrections_docs = {}
 
     for correction in hax.config['corrections']:
         db = get_rundb_database()
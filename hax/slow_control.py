@@ -1,17 +1,46 @@
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
+import re
+import shutil
+import time
 from datetime import datetime
 import requests
+import requests.adapters
 import logging
 
 import numpy as np
 import pandas as pd
 
 import hax
-from hax.utils import human_to_utc_datetime, utc_timestamp
+from hax.utils import human_to_utc_datetime, utc_timestamp, save_pickles, load_pickles
 
 log = logging.getLogger('hax.slow_control')
 sc_variables = None
 
+# Columns of sc_variables in which get_sc_name looks for exact matches, in order of priority
+sc_exact_match_columns = ['Historian_name', 'SC_Name', 'Pid_identifier']
+
+# Lookup tables built by init_sc_interface: {column: {value: [row indices]}} for the exact-match columns,
+# {word: set of row indices} for the words in the descriptions, and a sorted list of (suffix, word)
+# for all suffixes of these words, to find the words starting with, ending with or containing a string.
+sc_lookup = {}
+sc_description_tokens = {}
+sc_token_suffixes = []
+
+# Results of get_sc_name, so repeated lookups of the same moniker are free
+_sc_name_cache = {}
+
+# Historian names of the PMT bias voltages, filled on first use by get_pmt_data_last_measured
+n_pmts = 254
+pmt_tagnames = None
+
+# requests.Session shared by all slow control queries, so connections to the web API are reused
+_session = None
+_session_pool_size = None
+
 
 def get_sc_api_key():
     """Return the slow control API key, if we know it"""
@@ -27,7 +56,7 @@ def get_sc_api_key():
 
 def init_sc_interface():
     """Initialize the slow control interface access and list of variables"""
-    global sc_variables
+    global sc_variables, sc_lookup, sc_description_tokens, sc_token_suffixes, _sc_name_cache, pmt_tagnames
 
     sc_variables = pd.read_csv(hax.config['sc_variable_list'])
 
@@ -36,6 +65,43 @@ def init_sc_interface():
     sc_variables['Description'] = [x.lower() if not isinstance(
         x, float) else '' for x in sc_variables['Description'].values]
 
+    # Build hash tables {value: [row indices]} for the exact-match columns
+    sc_lookup = {}
+    for key in sc_exact_match_columns:
+        sc_lookup[key] = defaultdict(list)
+        for row_i, value in enumerate(sc_variables[key].values):
+            if isinstance(value, str):
+                sc_lookup[key][value].append(row_i)
+
+    # Build an index {token: set of row indices} of the words in the descriptions, for fast fuzzy search
+    sc_description_tokens = defaultdict(set)
+    for row_i, description in enumerate(sc_variables['Description'].values):
+        for token in _tokenize(description):
+            sc_description_tokens[token].add(row_i)
+    sc_token_suffixes = sorted((token[i:], token) for token in sc_description_tokens for i in range(len(token)))
+
+    _sc_name_cache = {}
+    pmt_tagnames = None
+
+
+def _tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def get_sc_session():
+    """Return the requests.Session used for querying the slow control web API.
+    Its connection pool is large enough for sc_max_concurrent_requests simultaneous queries.
+    """
+    global _session, _session_pool_size
+    pool_size = hax.config.get('sc_max_concurrent_requests', 8)
+    if _session is None or _session_pool_size != pool_size:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session_pool_size = pool_size
+    return _session
+
 
 class UnknownSlowControlMonikerException(Exception):
     pass
@@ -49,25 +115,87 @@ def get_sc_name(name, column='Historian_name'):
     """Return slow control historian name of name.  You can pass
     a historian name, sc name, pid identifier, or description. For a full table, see hax.
     """
+    hax.require('slow_control')
+    cache_key = (name, column)
+    if cache_key not in _sc_name_cache:
+        _sc_name_cache[cache_key] = sc_variables[column].values[_find_sc_row(name)]
+    return _sc_name_cache[cache_key]
+
+
+def get_sc_names(names, column='Historian_name', errors='raise'):
+    """Return list of slow control historian names (or another column) of each of the names in the list names.
+    See get_sc_name for what kind of names you can pass.
+
+    :param errors: 'raise' (default) to raise an exception for unknown or ambiguous names,
+                   'ignore' to return them unchanged.
+    """
+    hax.require('slow_control')
+    values = sc_variables[column].values
+    # Find the rows of the names we haven't looked up yet (once per distinct name), then take them all at once
+    for name in set([name for name in names if (name, column) not in _sc_name_cache]):
+        try:
+            _sc_name_cache[(name, column)] = values[_find_sc_row(name)]
+        except (UnknownSlowControlMonikerException, AmbiguousSlowControlMonikerException):
+            if errors != 'ignore':
+                raise
+    return [_sc_name_cache.get((name, column), name) for name in names]
+
+
+def _find_sc_row(name):
+    """Return the row index in sc_variables of the variable with moniker name"""
     # Find out what variable we need to query. Try all possible slow control
     # abbreviations/codes/etc
-    for key in ['Historian_name', 'SC_Name', 'Pid_identifier', 'Description']:
-        if key == 'Description':
-            # For descriptions, we do an even fuzzier matching: look for descriptions which contain the passed string
-            # We lowered all descriptions to become case-insensitive
-            mask = np.array([name.lower() in x for x in sc_variables[key]])
-            q = sc_variables[mask]
-        else:
-            q = sc_variables[sc_variables[key] == name]
-        if len(q) == 1:
-            return q.iloc[0][column]
-        elif len(q) > 1:
+    for key in sc_exact_match_columns:
+        rows = sc_lookup[key].get(name, [])
+        if len(rows) == 1:
+            return rows[0]
+        elif len(rows) > 1:
             raise AmbiguousSlowControlMonikerException("'%s' has multiple mathching %ss: %s" %
-                                                       (name, key, str(q[key].values)))
+                                                       (name, key, str(sc_variables[key].values[rows])))
+
+    # For descriptions, we do an even fuzzier matching: look for descriptions which contain the passed string
+    # We lowered all descriptions to become case-insensitive
+    query = name.lower()
+    descriptions = sc_variables['Description'].values
+    # Each word in the query is part of a word in any description containing the query: the whole word if it has
+    # non-word characters on both sides in the query, its end or start if it has them only after or before it.
+    # We only have to check the descriptions that have words like that for each of the query's words.
+    words = list(re.finditer(r'\w+', query))
+    if len(words):
+        candidates = None
+        for m in words:
+            rows = _rows_with_word(m.group(), starts=m.start() > 0, ends=m.end() < len(query))
+            candidates = rows if candidates is None else candidates & rows
+        rows = sorted([row_i for row_i in candidates if query in descriptions[row_i]])
+    else:
+        rows = np.where([query in x for x in descriptions])[0]
+
+    if len(rows) == 1:
+        return rows[0]
+    elif len(rows) > 1:
+        raise AmbiguousSlowControlMonikerException("'%s' has multiple mathching %ss: %s" %
+                                                   (name, 'Description', str(descriptions[rows])))
     raise UnknownSlowControlMonikerException(
         "Don't known any slow control moniker matching %s" % name)
 
 
+def _rows_with_word(word, starts, ends):
+    """Return set of rows of sc_variables whose descriptions have a word containing word,
+    which must be at the start (if starts) and/or end (if ends) of the description word.
+    """
+    if starts and ends:
+        return set(sc_description_tokens.get(word, set()))
+    rows = set()
+    # The suffixes starting with word are a contiguous range of sc_token_suffixes
+    i = bisect_left(sc_token_suffixes, (word,))
+    while i < len(sc_token_suffixes) and sc_token_suffixes[i][0].startswith(word):
+        suffix, token = sc_token_suffixes[i]
+        if (not starts or suffix == token) and (not ends or suffix == word):
+            rows |= sc_description_tokens[token]
+        i += 1
+    return rows
+
+
 def get_pmt_data_last_measured(run):
     """
     Retrieve PMT information for a run from the historian database
@@ -85,21 +213,19 @@ def get_pmt_data_last_measured(run):
         "api_key": get_sc_api_key(),
     }
 
-    r = requests.get(hax.config['sc_api_url'].replace('GetSCData', 'getLastMeasuredPMTValues'), params=params)
+    r = get_sc_session().get(hax.config['sc_api_url'].replace('GetSCData', 'getLastMeasuredPMTValues'),
+                             params=params)
     # If there is an error, raise here instead of giving weird error later
     r.raise_for_status()
 
-    response = r.json()
+    # Index the response by tag name, then look up each PMT's tag name in it
+    values = {entry['tagname']: entry['value'] for entry in r.json()}
 
-    answer = {}
+    global pmt_tagnames
+    if pmt_tagnames is None:
+        pmt_tagnames = get_sc_names(['PMT %03d' % x for x in range(n_pmts)])
 
-    for x in range(254):
-        tagname = get_sc_name('PMT %03d' % x)
-        for entry in response:
-            if tagname == entry['tagname']:
-                answer[x] = entry['value']
-
-    return answer
+    return {x: values[tagname] for x, tagname in enumerate(pmt_tagnames) if tagname in values}
 
 
 def get_sc_data(names, run=None, start=None, end=None, url=None):
@@ -116,35 +242,102 @@ def get_sc_data(names, run=None, start=None, end=None, url=None):
 
     :return: pandas Series of the values, with index the time in UTC. If you requested multiple names, pandas DataFrame
     """
-    c = hax.config
-
     if isinstance(names, (list, tuple)):
         # Get multiple values, return in a single dataframe. I hope the variables all have the same time resolution,
-        # otherwise you get NaNs...
-        df = pd.DataFrame([get_sc_data(name, run=run, start=start, end=end) for name in names]).T
-        df.columns = names
-        return df
-    name = names
+        # otherwise you get NaNs... (use get_sc_data_many if you want the values aligned on a common time index)
+        return get_sc_data_many(names, run=run, start=start, end=end, url=url, how='outer')
 
-    try:
-        name = get_sc_name(name)
-    except UnknownSlowControlMonikerException:
-        log.warning("Slow control moniker %s not known, trying to query the API anyway..." % name)
+    start, end = _get_time_range(run, start, end)
+    return _get_single_sc_data(names, start, end, url=url)
+
+
+def get_sc_data_many(names, run=None, start=None, end=None, url=None, how='asof', resample=None, max_workers=None):
+    """Retrieve the data of several slow control variables at once, with concurrent queries to the historian database.
+
+    :param names: list of names of slow control variables; see get_historian_name.
 
-    # Find out the start and end time
+    :param run: run number/name to return data for. If passed, start/end is ignored.
+
+    :param start: Start of time range: a string in arbitrary format (thanks to parsedatetime), a datetime,
+                  or a unix timestamp in seconds.
+
+    :param end: End of time range, same options as start.
+
+    :param how: how to put the variables on a common time index (the union of all measurement times). Can be:
+      - 'asof' (default): each variable takes its last measured value at or before each time
+      - 'interpolate': linear interpolation in time between measurements of each variable
+      - 'outer': no alignment, NaN wherever a variable has no measurement at exactly that time
+
+    :param resample: pandas offset alias (e.g. '1min'). If given, each variable is first averaged in bins of this
+                     size, and the common time index is the bin start times.
+
+    :param max_workers: maximum number of simultaneous queries. Defaults to the sc_max_concurrent_requests option.
+
+    :return: pandas DataFrame with one column per variable (named as in names), with index the time in UTC.
+    """
+    if how not in ('asof', 'interpolate', 'outer'):
+        raise ValueError("how must be 'asof', 'interpolate' or 'outer', not %s" % how)
+    if max_workers is None:
+        max_workers = hax.config.get('sc_max_concurrent_requests', 8)
+
+    start, end = _get_time_range(run, start, end)
+    unique_names = list(OrderedDict.fromkeys(names))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_names)))) as executor:
+        results = list(executor.map(lambda name: _get_single_sc_data(name, start, end, url=url), unique_names))
+    series = dict(zip(unique_names, results))
+
+    if resample is not None:
+        series = {name: s.resample(resample).mean() for name, s in series.items()}
+
+    df = pd.concat([series[name] for name in names], axis=1, sort=True)
+    df.columns = names
+    if how == 'asof':
+        df = df.ffill()
+    elif how == 'interpolate':
+        df = df.interpolate(method='time', limit_area='inside')
+    return df
+
+
+def _get_time_range(run=None, start=None, end=None):
+    """Return (start, end) unix timestamps in seconds for the run run, or between times start and end.
+    start and end can be human-readable strings, datetimes, or unix timestamps in seconds.
+    """
     if run is not None:
         q = hax.runs.datasets.query('number == %d' % hax.runs.get_run_number(run)).iloc[0]
         start = q.start
         end = q.end
-    else:
-        start = human_to_utc_datetime(start)
-        end = human_to_utc_datetime(end)
+    result = []
+    for t in (start, end):
+        if isinstance(t, str):
+            t = human_to_utc_datetime(t)
+        if not isinstance(t, (int, float, np.number)):
+            t = utc_timestamp(t)
+        result.append(int(t))
+    return tuple(result)
+
+
+def _get_single_sc_data(name, start, end, url=None):
+    """Return pandas Series with values of the slow control variable name between unix timestamps start and end"""
+    try:
+        name = get_sc_name(name)
+    except UnknownSlowControlMonikerException:
+        log.warning("Slow control moniker %s not known, trying to query the API anyway..." % name)
+
+    if url is None and hax.config.get('sc_cache_dir'):
+        return get_sc_cache().get(name, start, end, fetch=_query_sc_api)
+    return _query_sc_api(name, start, end, url=url)
+
 
+def _query_sc_api(name, start, end, url=None):
+    """Return pandas Series with the values of the slow control variable name between the unix timestamps
+    start and end (in seconds, both inclusive), straight from the historian web API.
+    """
+    c = hax.config
     params = {
         "name": name,
         "QueryType": "lab",
-        "StartDateUnix": int(utc_timestamp(start)),
-        "EndDateUnix": int(utc_timestamp(end)),
+        "StartDateUnix": start,
+        "EndDateUnix": end,
         "username": c['sc_api_username'],
         "api_key": get_sc_api_key(),
     }
@@ -155,8 +348,7 @@ def get_sc_data(names, run=None, start=None, end=None, url=None):
     if url is None:
         url = c['sc_api_url']
 
-    r = requests.get(url,
-                     params=params)
+    r = get_sc_session().get(url, params=params)
     # If there is an error, raise here instead of giving weird error later
     r.raise_for_status()
 
@@ -168,7 +360,153 @@ def get_sc_data(names, run=None, start=None, end=None, url=None):
         dates.append(datetime.utcfromtimestamp(entry['timestampseconds']))
         values.append(entry['value'])
 
-    return pd.Series(values, index=dates)
+    return pd.Series(values, index=pd.DatetimeIndex(dates))
+
+
+##
+# On-disk cache of slow control time series
+##
+
+class SlowControlCache(object):
+    """Persistent cache of slow control time series.
+
+    Each variable gets its own directory in cache_dir. The values are stored in blocks of block_seconds
+    (aligned to the unix epoch) as compressed pickles, so a query only has to read the blocks it overlaps.
+    Next to the blocks, an index file keeps the list of [start, end] intervals (unix seconds, inclusive)
+    that have been fetched already. Overlapping and adjacent intervals are coalesced, so repeated or
+    partially overlapping queries only go to the web API for the parts we don't have yet.
+    """
+    index_filename = 'intervals.json'
+
+    def __init__(self, cache_dir, block_seconds=86400):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.block_seconds = int(block_seconds)
+
+    def get(self, name, start, end, fetch):
+        """Return pandas Series of the values of name between unix timestamps start and end (inclusive).
+        fetch(name, start, end) is called to get the data for any part of the interval that is not yet cached.
+        """
+        start, end = int(start), int(end)
+        for missing_start, missing_end in self.missing_intervals(name, start, end):
+            log.debug("Fetching slow control data for %s in [%d, %d]" % (name, missing_start, missing_end))
+            self.store(name, missing_start, missing_end, fetch(name, missing_start, missing_end))
+        return self.read(name, start, end)
+
+    def missing_intervals(self, name, start, end):
+        """Return list of [start, end] intervals inside [start, end] that are not yet in the cache"""
+        result = []
+        for covered_start, covered_end in self.covered_intervals(name):
+            if covered_end < start:
+                continue
+            if covered_start > end:
+                break
+            if covered_start > start:
+                result.append([start, covered_start - 1])
+            start = max(start, covered_end + 1)
+            if start > end:
+                return result
+        result.append([start, end])
+        return result
+
+    def covered_intervals(self, name):
+        """Return sorted list of coalesced [start, end] intervals for which name is in the cache"""
+        index_path = os.path.join(self._variable_dir(name), self.index_filename)
+        if not os.path.exists(index_path):
+            return []
+        with open(index_path) as infile:
+            return json.load(infile)
+
+    def store(self, name, start, end, data):
+        """Add the pandas Series data, containing all values of name between start and end, to the cache."""
+        variable_dir = self._variable_dir(name)
+        if not os.path.exists(variable_dir):
+            os.makedirs(variable_dir)
+
+        # Write the values to their blocks, merging with what's already there
+        data = data.sort_index()
+        seconds = _to_unix_seconds(data.index)
+        blocks = seconds // self.block_seconds * self.block_seconds
+        for block_start in np.unique(blocks):
+            block_data = data[blocks == block_start]
+            old_data = self._read_block(name, block_start)
+            if old_data is not None:
+                block_data = pd.concat([old_data, block_data])
+                block_data = block_data[~block_data.index.duplicated(keep='last')].sort_index()
+            save_pickles(self._block_path(name, block_start), block_data)
+
+        # Don't mark the future as covered: the slow control system hasn't measured it yet.
+        end = min(end, int(time.time()))
+        if end < start:
+            return
+        intervals = coalesce_intervals(self.covered_intervals(name) + [[start, end]])
+        with open(os.path.join(variable_dir, self.index_filename), mode='w') as outfile:
+            json.dump(intervals, outfile)
+
+    def read(self, name, start, end):
+        """Return pandas Series with the cached values of name between start and end"""
+        first_block = start // self.block_seconds * self.block_seconds
+        pieces = []
+        for block_start in range(first_block, end + 1, self.block_seconds):
+            block_data = self._read_block(name, block_start)
+            if block_data is not None:
+                pieces.append(block_data)
+        if not len(pieces):
+            return pd.Series([], index=pd.DatetimeIndex([]), dtype=np.float64)
+        data = pd.concat(pieces)
+        seconds = _to_unix_seconds(data.index)
+        return data[(seconds >= start) & (seconds <= end)]
+
+    def clear(self, name=None):
+        """Remove the cached data of name, or of all variables if name is None"""
+        path = self.cache_dir if name is None else self._variable_dir(name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    def _variable_dir(self, name):
+        # Historian names contain dots, which are fine, but be safe with anything else
+        safe_name = re.sub(r'[^\w.\-]', '_', name)
+        return os.path.join(self.cache_dir, safe_name)
+
+    def _block_path(self, name, block_start):
+        return os.path.join(self._variable_dir(name), '%d.pklz' % block_start)
+
+    def _read_block(self, name, block_start):
+        path = self._block_path(name, block_start)
+        if not os.path.exists(path):
+            return None
+        return load_pickles(path)[0]
+
+
+def coalesce_intervals(intervals):
+    """Return sorted list of inclusive [start, end] intervals (of integer seconds),
+    with overlapping or adjacent intervals (like [0, 10] and [11, 20]) merged
+    """
+    result = []
+    for start, end in sorted(intervals):
+        if len(result) and start <= result[-1][1] + 1:
+            result[-1][1] = max(result[-1][1], end)
+        else:
+            result.append([start, end])
+    return result
+
+
+def _to_unix_seconds(index):
+    """Convert a pandas DatetimeIndex (naive, UTC) to an array of integer unix timestamps in seconds"""
+    return pd.DatetimeIndex(index).values.astype('datetime64[s]').astype(np.int64)
+
+
+_sc_cache = None
+
+
+def get_sc_cache():
+    """Return the SlowControlCache using the cache directory from the hax configuration"""
+    global _sc_cache
+    cache_dir = hax.config['sc_cache_dir']
+    block_seconds = hax.config.get('sc_cache_block_seconds', 86400)
+    if (_sc_cache is None or _sc_cache.cache_dir != os.path.expanduser(cache_dir) or
+            _sc_cache.block_seconds != block_seconds):
+        _sc_cache = SlowControlCache(cache_dir, block_seconds)
+    return _sc_cache
 
 
 # Alias for convenience
@@ -0,0 +1,11 @@
+"""Treemakers included with hax.
+The modules are only imported when you first use one of their treemakers, see hax.minitrees.TreeMakerRegistry.
+"""
+import importlib
+import os
+
+
+def __getattr__(name):
+    if not name.startswith('_') and os.path.exists(os.path.join(os.path.dirname(__file__), name + '.py')):
+        return importlib.import_module('hax.treemakers.' + name)
+    raise AttributeError("module 'hax.treemakers' has no attribute '%s'" % name)
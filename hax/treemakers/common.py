@@ -1,10 +1,13 @@
 """Standard variables for most analyses
 """
-from hax.minitrees import TreeMaker
-from collections import defaultdict
+from hax.minitrees import TreeMaker, VectorTreeMaker
+from hax import jagged
+from collections import defaultdict, OrderedDict
 
+import numpy as np
 
-class Fundamentals(TreeMaker):
+
+class Fundamentals(VectorTreeMaker):
     """Simple minitree containing basic information about every event, regardless of its contents.
     This minitree is always loaded whether you like it or not :-)
 
@@ -22,6 +25,10 @@ class Fundamentals(TreeMaker):
         return dict(event_time=event.start_time,
                     event_duration=event.stop_time - event.start_time)
 
+    def extract_batch(self, arrays):
+        return OrderedDict([('event_time', arrays['start_time']),
+                            ('event_duration', arrays['stop_time'] - arrays['start_time'])])
+
 
 class Extended(TreeMaker):
     """Extra information, mainly motivated by cuts used for the first science run.
@@ -187,7 +194,7 @@ def get_largest_indices(peaks, exclude_indices=tuple()):
     return largest_indices
 
 
-class Basics(TreeMaker):
+class Basics(VectorTreeMaker):
     """Basic information needed in most (standard) analyses, mostly on the main interaction.
 
     Provides:
@@ -217,6 +224,11 @@ class Basics(TreeMaker):
 
     """
     __version__ = '0.3'
+    columnar_branches = ['event_number',
+                         'peaks.area', 'peaks.type', 'peaks.detector', 'peaks.area_fraction_top',
+                         'peaks.range_area_decile',
+                         'interactions.s1', 'interactions.s2',
+                         'interactions.x', 'interactions.y', 'interactions.z', 'interactions.drift_time']
 
     def extract_data(self, event):
         event_data = dict()
@@ -261,6 +273,41 @@ class Basics(TreeMaker):
 
         return event_data
 
+    def extract_batch(self, arrays):
+        area, offsets = jagged.flatten(arrays['peaks.area'], dtype=np.float64)
+        peak_type = jagged.as_str(jagged.flatten(arrays['peaks.type'])[0])
+        detector = jagged.as_str(jagged.flatten(arrays['peaks.detector'])[0])
+        area_fraction_top = jagged.flatten(arrays['peaks.area_fraction_top'], dtype=np.float64)[0]
+        range_area_decile = jagged.flatten(arrays['peaks.range_area_decile'], dtype=np.float64)[0].reshape(-1, 11)
+
+        # Main interaction: the first one in each event, if any
+        s1_i, s2_i = [jagged.first(*jagged.flatten(arrays['interactions.%s' % x], dtype=np.int64), fill=-1)
+                      for x in ('s1', 's2')]
+        event_data = OrderedDict()
+        for prefix, peak_i in (('s1', s1_i), ('s2', s2_i)):
+            event_data[prefix] = jagged.take(area, offsets, peak_i)
+        for prefix, peak_i in (('s1', s1_i), ('s2', s2_i)):
+            event_data[prefix + '_area_fraction_top'] = jagged.take(area_fraction_top, offsets, peak_i)
+        for prefix, peak_i in (('s1', s1_i), ('s2', s2_i)):
+            event_data[prefix + '_range_50p_area'] = jagged.take(range_area_decile[:, 5], offsets, peak_i)
+        for field, name in (('x', 'x_pax'), ('y', 'y_pax'), ('z', 'z'), ('drift_time', 'drift_time')):
+            event_data[name] = jagged.first(*jagged.flatten(arrays['interactions.' + field], dtype=np.float64))
+
+        # Largest peaks of each type not in the main interaction; see get_largest_indices.
+        # Peaks must have positive area to count, hence fill=0.
+        peak_i = jagged.local_index(offsets)
+        event_i = jagged.event_index(offsets)
+        other = (peak_i != s1_i[event_i]) & (peak_i != s2_i[event_i])
+        tpc = detector == 'tpc'
+        for name, selection in (('largest_other_s1', tpc & (peak_type == 's1')),
+                                ('largest_other_s2', tpc & (peak_type == 's2')),
+                                ('largest_veto', (detector == 'veto') & (peak_type != 'lone_hit')),
+                                ('largest_unknown', tpc & (peak_type == 'unknown')),
+                                ('largest_coincidence', tpc & (peak_type == 'coincidence'))):
+            event_data[name] = jagged.max_per_event(area, offsets, other & selection, fill=0)
+
+        return event_data
+
 
 class LargestPeakProperties(TreeMaker):
     """Largest peak properties for each type and for all peaks.
@@ -325,7 +372,7 @@ class LargestPeakProperties(TreeMaker):
         return result
 
 
-class TotalProperties(TreeMaker):
+class TotalProperties(VectorTreeMaker):
     """Aggregate properties of signals in the entire event
 
     Provides:
@@ -361,3 +408,22 @@ class TotalProperties(TreeMaker):
             result['area_before_main_s2'] = 0
 
         return result
+
+    def extract_batch(self, arrays):
+        area, offsets = jagged.flatten(arrays['peaks.area'], dtype=np.float64)
+        peak_type = jagged.as_str(jagged.flatten(arrays['peaks.type'])[0])
+        tpc = jagged.as_str(jagged.flatten(arrays['peaks.detector'])[0]) == 'tpc'
+        left = jagged.flatten(arrays['peaks.left'], dtype=np.float64)[0]
+
+        # Left of the main S2, NaN if there is no interaction (so no peak is before it)
+        s2_i = jagged.first(*jagged.flatten(arrays['interactions.s2'], dtype=np.int64), fill=-1)
+        main_s2_left = jagged.take(left, offsets, s2_i)
+
+        result = OrderedDict()
+        result['n_pulses'] = arrays['n_pulses']
+        result['n_peaks'] = jagged.counts(offsets)
+        result['n_true_peaks'] = jagged.count_per_event(offsets, peak_type != 'lone_hit')
+        result['total_peak_area'] = jagged.sum_per_event(area, offsets, tpc)
+        result['area_before_main_s2'] = jagged.sum_per_event(
+            area, offsets, tpc & (left < main_s2_left[jagged.event_index(offsets)]))
+        return result
@@ -0,0 +1,89 @@
+"""Slow control (detector conditions) information for each event
+"""
+import numpy as np
+import pandas as pd
+
+import hax
+from hax.minitrees import DerivedTreeMaker
+
+
+class SlowControlTreeMaker(DerivedTreeMaker):
+    """Base class for treemakers that attach slow control values to every event.
+
+    Subclasses set sc_variables to a dictionary {column name: slow control moniker} (see
+    hax.slow_control.get_sc_name for the monikers you can use). If sc_variables is None, the
+    slow_control_treemaker_variables option from the hax configuration is used.
+
+    Each variable is fetched once per run (through the slow control cache), for the run's time range plus
+    time_margin seconds on either side. The values are then attached to all events at once, without looping over
+    the events in the pax root file:
+     - interpolation = 'asof': the last value measured at or before the event time
+     - interpolation = 'linear': linear interpolation between the measurements around the event time
+    Events without a measurement before (or, for 'linear', after) them get NaN.
+    """
+    __version__ = '0.1.0'
+    pax_version_independent = True
+    # Values are computed quickly from Fundamentals and the (cached) slow control data
+    never_store = True
+    depends_on = ('Fundamentals',)
+
+    sc_variables = None
+    interpolation = 'asof'
+    time_margin = 3600
+
+    def __init__(self):
+        DerivedTreeMaker.__init__(self)
+        if self.sc_variables is None:
+            self.sc_variables = hax.config['slow_control_treemaker_variables']
+        if self.interpolation not in ('asof', 'linear'):
+            raise ValueError("interpolation must be 'asof' or 'linear', not %s" % self.interpolation)
+
+    def compute(self, frames):
+        events = frames['Fundamentals']
+        result = pd.DataFrame(dict(event_number=events['event_number'].values,
+                                   run_number=events['run_number'].values))
+        if not len(events) or not len(self.sc_variables):
+            return result
+        event_times = events['event_time'].values.astype(np.int64)
+
+        # Fetch all the variables for this run's time range in one go
+        start, end = hax.slow_control._get_time_range(run=self.run_name)
+        column_names = list(self.sc_variables.keys())
+        sc_data = hax.slow_control.get_sc_data_many([self.sc_variables[k] for k in column_names],
+                                                    start=start - self.time_margin,
+                                                    end=end + self.time_margin,
+                                                    how='outer')
+        sc_data.columns = column_names
+
+        for column_name in column_names:
+            values = sc_data[column_name].dropna()
+            result[column_name] = self.values_at(pd.DatetimeIndex(values.index).values.astype('datetime64[ns]')
+                                                 .astype(np.int64),
+                                                 values.values.astype(np.float64),
+                                                 event_times)
+        return result
+
+    def values_at(self, times, values, event_times):
+        """Return the values measured at times (ns since the unix epoch) at each of the event_times"""
+        if not len(times):
+            return np.full(len(event_times), float('nan'))
+        if self.interpolation == 'linear':
+            return np.interp(event_times, times, values, left=float('nan'), right=float('nan'))
+        # As-of: index of the last measurement at or before each event
+        i = np.searchsorted(times, event_times, side='right') - 1
+        return np.where(i >= 0, values[np.clip(i, 0, None)], float('nan'))
+
+
+class SlowControl(SlowControlTreeMaker):
+    """Slow control values at the time of each event, for the variables in the slow_control_treemaker_variables option
+    of the hax configuration. By default these are:
+
+    Provides:
+     - cathode_voltage: Heinzinger (cathode) monitor voltage in kV
+     - anode_voltage: Anode voltage
+     - detector_pressure: Detector pressure (cryostat) in bar
+     - cryostat_bottom_temperature: Cryostat bottom temperature (LXe) in degrees Celsius
+
+    Each value is the last measurement at or before the start of the event.
+    """
+    __version__ = '0.1.0'
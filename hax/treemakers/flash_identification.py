@@ -1,9 +1,9 @@
 import numpy as np
+import pandas as pd
 import hax
-import pytz
 
 
-class FlashIdentification(hax.minitrees.TreeMaker):
+class FlashIdentification(hax.minitrees.DerivedTreeMaker):
     """
     Identification of flashes during a dataset. Therefore it will extract trigger data checking for typical
     flashing properties. It will provide additional information for each event:
@@ -12,11 +12,15 @@ class FlashIdentification(hax.minitrees.TreeMaker):
     - flashing_width (in seconds)
     - inside_flash: Events that are within the flash and should be cut in any case
     - nearest_flash: to set a time window around a flash which can be simply adjusted by a cut (in nseconds)
+
+    The event times come from the Fundamentals minitree, so this never loops over the events in the root file.
     """
-    __version__ = '0.1'
+    __version__ = '0.2'
     pax_version_independent = True
+    depends_on = ('Fundamentals',)
 
-    def get_data(self, dataset, event_list=None):
+    def find_flash(self, dataset):
+        """Set flash properties (NaN if there is no flash) from the trigger data of dataset"""
         # Use 'all' pulses
         trigger_data = hax.trigger_data.get_trigger_data(dataset, select_data_types='count_of_all_pulses')
         self.transposed = trigger_data.T
@@ -24,33 +28,21 @@ class FlashIdentification(hax.minitrees.TreeMaker):
         # Get BUSY_ON (channel id 255)
         self.BUSY_data = self.transposed[255]
 
-        time_window = []
-        window_biggest = []
-
-        # Check in BUSY_ON channel if there where an increase "typical" for flashes and get the time-window in seconds
-        for t in range(0, len(self.BUSY_data)):
-            if self.BUSY_data[t] > 20:
-                time_window.append(t)
-            else:
-                if len(time_window) <= 1:   # Ignore spikes
-                    time_window = []
-                else:
-                    if len(time_window) > len(window_biggest):
-                        window_biggest = time_window
-                        time_window = []
-                    else:
-                        time_window = []
         self.flash_time_BUSY = np.nan
         self.flash_width = np.nan
         self.flash_time_highest_trig = np.nan
         self.flashing_PMT = np.nan
         self.flash_amplitude = np.nan
         self.flash_time_BUSY_first = np.nan
+
+        # Check in BUSY_ON channel if there where an increase "typical" for flashes and get the time-window in seconds
+        start, length = longest_window(self.BUSY_data > 20)
+
         # the thresholds are chosen to only select real flashes
         # get the time information from BUSY-channel
-        if len(window_biggest) > 3:
-            self.flash_time_BUSY = window_biggest[-1]
-            self.flash_width = len(window_biggest)
+        if length > 3:
+            self.flash_time_BUSY = start + length - 1
+            self.flash_width = length
 
             # check if there was also a "large" increase in one of the PMT channels
             self.flash_time_highest_trig = int(np.argmax(trigger_data)/len(self.transposed))
@@ -68,29 +60,50 @@ class FlashIdentification(hax.minitrees.TreeMaker):
                 self.flash_time_BUSY = np.nan
                 self.flash_width = np.nan
                 self.flash_time_highest_trig = np.nan
-        # We need the run start time to find the time in run later
-        self.run_start = hax.runs.get_run_info(dataset, 'start').replace(tzinfo=pytz.utc).timestamp()
 
-        return hax.minitrees.TreeMaker.get_data(self, dataset, event_list)
+    def compute(self, frames):
+        self.find_flash(self.run_name)
+        event_time = frames['Fundamentals']['event_time'].values
+        n_events = len(event_time)
 
-    def extract_data(self, event):
-        ret = {"inside_flash": False}
-        ret["nearest_flash"] = np.nan
-        ret["flashing_PMT"] = self.flashing_PMT
-        ret["flashing_time"] = np.nan
-        ret["flashing_width"] = np.nan
+        result = dict(inside_flash=np.zeros(n_events, dtype=np.bool_),
+                      nearest_flash=np.full(n_events, np.nan),
+                      flashing_PMT=np.full(n_events, self.flashing_PMT),
+                      flashing_time=np.full(n_events, np.nan),
+                      flashing_width=np.full(n_events, np.nan))
 
         if ~np.isnan(self.flashing_PMT):
-            ret["flashing_time"] = int(self.run_start)/1e9 + self.flash_time_highest_trig
-            ret["flashing_width"] = self.flash_width
-
-            time_in_run_ns = int(event.start_time) - int(self.run_start)
+            # We need the run start time (in ns since the unix epoch) to find the time in run
+            run_start = pd.Timestamp(self.run_start).value
+            result['flashing_time'][:] = run_start/1e9 + self.flash_time_highest_trig
+            result['flashing_width'] = np.full(n_events, self.flash_width)
+
+            time_in_run_ns = event_time.astype(np.int64) - run_start
+            inside_flash = ((time_in_run_ns >= int((self.flash_time_highest_trig - self.flash_width)*1e9)) &
+                            (time_in_run_ns < int(self.flash_time_highest_trig*1e9)))
+            result['inside_flash'] = inside_flash
+
+            nearest_flash = time_in_run_ns - int(self.flash_time_highest_trig*1e9)
+            if np.any(inside_flash):
+                result['nearest_flash'] = np.where(inside_flash, np.nan, nearest_flash)
+            else:
+                result['nearest_flash'] = nearest_flash
 
-            if time_in_run_ns in range(int((self.flash_time_highest_trig - self.flash_width)*1e9),
-                                       int(self.flash_time_highest_trig*1e9)):
-                ret["inside_flash"] = True
+        result['event_number'] = frames['Fundamentals']['event_number'].values
+        return result
 
-            if not ret["inside_flash"]:
-                ret["nearest_flash"] = time_in_run_ns - int(self.flash_time_highest_trig*1e9)
 
-        return ret
+def longest_window(above_threshold):
+    """Return (start, length) of the first longest run of consecutive True values in above_threshold
+    which ends before the end of the array. Runs of a single value are ignored. Returns (0, 0) if there is none.
+    """
+    edges = np.diff(np.concatenate([[0], np.asarray(above_threshold, dtype=np.int8), [0]]))
+    starts = np.where(edges == 1)[0]
+    ends = np.where(edges == -1)[0]
+    # A window still open at the end of the data is not a complete window
+    closed = ends < len(above_threshold)
+    starts, lengths = starts[closed], (ends - starts)[closed]
+    if not len(lengths) or lengths.max() <= 1:
+        return 0, 0
+    i = np.argmax(lengths)
+    return starts[i], lengths[i]
@@ -3,15 +3,29 @@
 Treemakers used for analyses such as the single-electron shape in time
 and stability.
 """
+from collections import OrderedDict
+import logging
+
 import hax
-from hax.minitrees import MultipleRowExtractor
+from hax import jagged
+from hax.expressions import compile_cut, compile_vectorized_cut, CannotVectorize
+from hax.minitrees import MultipleRowExtractor, VectorTreeMaker
 import numpy as np
 from pax import units
 
+log = logging.getLogger('hax.treemakers.peak_treemakers')
+
 
-class PeakExtractor(MultipleRowExtractor):
+class PeakExtractor(VectorTreeMaker, MultipleRowExtractor):
     """Base class for reading peak data in minitrees. For more information, check out example 10 in hax/examples.
+
+    If possible, the peak data is read in chunks of events with root_numpy and the cuts are applied to arrays
+    of peak properties at once (see VectorTreeMaker). This is not possible if you extract x or y, use cuts
+    we can't apply to arrays (e.g. function calls), set stop_after or override extract_data: then we loop
+    over events and peaks.
     """
+    row_per_event = False
+    jagged = True
 
     # Default branch selection is EVERYTHING in peaks, overwrite for speed increase
     # Don't forget to include branches used in cuts
@@ -27,12 +41,43 @@ class PeakExtractor(MultipleRowExtractor):
     peaktypes = dict(lone_hit=0, s1=1, s2=2, unknown=3)
     detectors = dict(tpc=0, veto=1, sum_wv=2, busy_on=3, busy_off=4)
 
+    # Attributes of the peak the special fields are computed from
+    field_attributes = dict(range_50p_area='range_area_decile', rise_time='area_decile_from_midpoint')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.event_cut_string = self.build_cut_string(
             self.event_cut_list, 'event')
         self.peak_cut_string = self.build_cut_string(
             self.peak_cut_list, 'peak')
+        # Compile the cuts once, rather than eval-ing the strings for every event and peak
+        namespace = dict(globals(), self=self)
+        self.event_cut = compile_cut(self.event_cut_string, 'event', namespace)
+        # Peak cuts can use the event too (e.g. peak.left > event.start_time)
+        self.peak_cut = compile_cut(self.peak_cut_string, 'peak, event', namespace)
+        if self.columnar:
+            self.columnar = self.setup_columnar(namespace)
+
+    def setup_columnar(self, namespace):
+        """Compile the cuts to functions of arrays and set the branches to read for the columnar path.
+        Returns whether the columnar path can be used.
+        """
+        if self.stop_after != np.inf or 'x' in self.peak_fields or 'y' in self.peak_fields:
+            return False
+        try:
+            self.vectorized_event_cut, self.event_attributes = compile_vectorized_cut(
+                self.event_cut_string, 'event', namespace)
+            self.vectorized_peak_cut, peak_attributes = compile_vectorized_cut(
+                self.peak_cut_string, 'peak', namespace, other_arguments=('event',))
+        except CannotVectorize as e:
+            log.debug("Not using columnar path for %s: %s" % (self.__class__.__name__, e))
+            return False
+        peak_attributes += [self.field_attributes.get(field, field) for field in self.peak_fields]
+        # We need at least one peak branch to know how many peaks each event has
+        self.peak_attributes = sorted(set(peak_attributes)) or ['area']
+        self.columnar_branches = (['event_number'] + [a for a in self.event_attributes if a != 'event_number'] +
+                                  ['peaks.' + a for a in self.peak_attributes])
+        return True
 
     def build_cut_string(self, cut_list, obj):
         '''
@@ -59,10 +104,10 @@ class PeakExtractor(MultipleRowExtractor):
 
         peak_data = []
         # Check if event passes cut
-        if eval(self.build_cut_string(self.event_cut_list, 'event')):
+        if self.event_cut(event):
             # Loop over peaks and check if peak passes cut
             for peak in event.peaks:
-                if eval(self.peak_cut_string):
+                if self.peak_cut(peak, event):
                     # Loop over properties and add them to _current_peak one by one
                     _current_peak = {}
                     for field in self.peak_fields:
@@ -99,6 +144,49 @@ class PeakExtractor(MultipleRowExtractor):
             # If event does not pass cut return empty list
             return []
 
+    def extract_batch(self, arrays):
+        n_events = len(arrays)
+        peaks = OrderedDict()
+        for attribute in self.peak_attributes:
+            values, offsets = jagged.flatten(arrays['peaks.' + attribute])
+            peaks[attribute] = jagged.as_str(values)
+        event_i = jagged.event_index(offsets)
+
+        event_passes = self.vectorized_event_cut({a: jagged.as_str(arrays[a]) for a in self.event_attributes})
+        event_passes = np.broadcast_to(event_passes, n_events)
+        passes = np.broadcast_to(self.vectorized_peak_cut(peaks), len(event_i)) & event_passes[event_i]
+
+        result = OrderedDict()
+        for field in self.peak_fields:
+            # Deal with special cases
+            if field == 'range_50p_area':
+                x = peaks['range_area_decile'][:, 5]
+            elif field == 'rise_time':
+                x = -peaks['area_decile_from_midpoint'][:, 1]
+            elif field == 'type':
+                x = self.codes(peaks['type'], self.peaktypes)
+            elif field == 'detector':
+                x = self.codes(peaks['detector'], self.detectors)
+            else:
+                x = peaks[field]
+            x = x[passes]
+            # Give the same types as the event loop, which gets python floats and ints
+            if x.dtype.kind == 'f':
+                x = x.astype(np.float64)
+            elif x.dtype.kind in 'iu':
+                x = x.astype(np.int64)
+            if x.ndim > 1:
+                x = list(x)
+            result[field] = x
+        result['event_number'] = arrays['event_number'][event_i[passes]].astype(np.int64)
+        return result
+
+    @staticmethod
+    def codes(strings, code_dict):
+        """Return array of code_dict[s] for each s in strings, or -1 if s is not in code_dict"""
+        unique, inverse = np.unique(strings, return_inverse=True)
+        return np.array([code_dict.get(s, -1) for s in unique], dtype=np.int64)[inverse]
+
 
 class IsolatedPeaks(MultipleRowExtractor):  # pylint: disable=unused-variable
     """Returns one row per peak isolated in time
@@ -106,6 +194,7 @@ class IsolatedPeaks(MultipleRowExtractor):  # pylint: disable=unused-variable
     Specifically returns properties of each individual peak.
     """
     __version__ = '0.1.2'
+    jagged = True
     extra_branches = ['peaks.left', 'peaks.right', 'peaks.n_hits',
                       'peaks.n_contributing_channels',
                       'peaks.reconstructed_positions*', 'peaks.area_decile_from_midpoint*']
@@ -46,6 +46,7 @@ class PositionReconstruction(TreeMaker):
        - s2_pattern_fit_nn: s2 pattern fit using nn position
     """
     __version__ = '1.1'
+    depends_on = ('Corrections', 'Fundamentals')
     extra_branches = ['peaks.area_per_channel[260]',
                       'peaks.hits_per_channel[260]',
                       'peaks.n_saturated_per_channel[260]',
@@ -119,7 +120,10 @@ class PositionReconstruction(TreeMaker):
 
     def get_data(self, dataset, event_list=None):
         # If we do switch to new NN later get rid of this stuff and directly use those positions!
-        data, _ = hax.minitrees.load_single_dataset(dataset, ['Corrections', 'Fundamentals'])
+        data = self.merge_frames(self.load_dependencies(dataset))
+        # Like load_single_dataset, leave out blinded events
+        if hax.unblinding.is_blind(dataset):
+            data = hax.cuts.eval_selection(data, hax.unblinding.unblinding_selection, quiet=True)
         self.x = data.x_3d_nn.values
         self.y = data.y_3d_nn.values
         self.z = data.z_3d_nn.values
@@ -1,8 +1,7 @@
-import numpy as np
 import hax
 
 
-class PreviousEventBasics(hax.minitrees.TreeMaker):
+class PreviousEventBasics(hax.minitrees.DerivedTreeMaker):
     """Basic information about the previous event.
 
     This minitree provides all columns in Basics, with a 'previous_' prefix.
@@ -15,10 +14,11 @@ class PreviousEventBasics(hax.minitrees.TreeMaker):
     """
     __version__ = '0.0.1'
     never_store = True
+    depends_on = ('Basics',)
 
-    def get_data(self, dataset, event_list=None):
-        # Load Basics for this dataset and shift it by 1
-        data = hax.minitrees.load_single_minitree(dataset, 'Basics')
+    def compute(self, frames):
+        # Shift Basics for this dataset by 1
+        data = frames['Basics']
         df = data.shift(1)
 
         # Add previous_ prefix to all columns
@@ -27,9 +27,4 @@ class PreviousEventBasics(hax.minitrees.TreeMaker):
         # Add (unshifted) event number and run number, to support merging
         df['event_number'] = data['event_number']
         df['run_number'] = data['run_number']
-
-        # Support for event list (lame)
-        if event_list is not None:
-            df = df[np.in1d(df['event_number'].values, event_list)]
-
         return df
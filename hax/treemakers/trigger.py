@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import logging
+
 import numpy as np
 import pandas as pd
 from pax.datastructure import TriggerSignal
@@ -6,6 +9,8 @@ import hax
 from hax.minitrees import TreeMaker
 from hax.trigger_data import get_aqm_pulses
 
+log = logging.getLogger('hax.treemakers.trigger')
+
 
 class LargestTriggeringSignal(TreeMaker):
     """Information on the largest trigger signal with the trigger flag set in the event
@@ -27,7 +32,7 @@ class LargestTriggeringSignal(TreeMaker):
         return {"trigger_" + k: getattr(ts, k) for k in [a[0] for a in TriggerSignal.get_fields_data(TriggerSignal())]}
 
 
-class Proximity(hax.minitrees.TreeMaker):
+class Proximity(hax.minitrees.DerivedTreeMaker):
     """Information on the proximity of other events and acquisition monitor signals (e.g. busy and muon veto trigger)
         Provides:
          - previous_x: Time (in ns) between the time center of the event and the previous x (see below for various x).
@@ -46,8 +51,9 @@ class Proximity(hax.minitrees.TreeMaker):
          - All the information about the muon_veto_trigger are calculated with respect to the TPC trigger and
          - not to the middle of the event.
     """
-    __version__ = '0.1.0'
+    __version__ = '0.1.1'
     pax_version_independent = False          # Now that we include S2 area it's not
+    depends_on = ('Fundamentals', 'TotalProperties', 'LargestPeakProperties')
 
     aqm_labels = [
         'muon_veto_trigger',
@@ -60,19 +66,18 @@ class Proximity(hax.minitrees.TreeMaker):
 
     def bad_mv_triggers(self, aqm_pulses, min_time=500):
         """
-        get me the indices of the sync signal in the MV_trigger sent to the TPC
+        get me the indices of the muon veto triggers that are within min_time of a sync signal sent to the TPC
         """
-        indices_mv = list()
-
-        for tsync in aqm_pulses['mv_sync']:
-            # This dict will have the info of the unwanted MV_triggers sent to TPC
-            # maybe there is a better way to save those!!!
-            list_times = dict()
-            for j, tmvt in enumerate(aqm_pulses['muon_veto_trigger']):
-                list_times[j] = np.abs(tsync - tmvt)
-            # these are the indices of the MV_trigger that needs to be taken away
-            indices_mv.extend([key for key, value in list_times.items() if value < min_time])
-        return indices_mv
+        mv_times = aqm_pulses['muon_veto_trigger']
+        sync_times = np.sort(aqm_pulses['mv_sync'])
+        if not len(mv_times) or not len(sync_times):
+            return np.zeros(0, dtype=np.int64)
+        # Distance to the nearest sync signal: the first one at or after, or the last one before, each trigger
+        i = np.searchsorted(sync_times, mv_times)
+        after = sync_times[np.clip(i, 0, len(sync_times) - 1)]
+        before = sync_times[np.clip(i - 1, 0, len(sync_times) - 1)]
+        distance = np.minimum(np.abs(after - mv_times), np.abs(mv_times - before))
+        return np.where(distance < min_time)[0]
 
     def select_physical_pulses(self, aqm_pulses, ap_time=20000):
         """
@@ -81,22 +86,20 @@ class Proximity(hax.minitrees.TreeMaker):
         # lets get rid of the trigger that comes from the mv_sync signal
         mask = np.ones(aqm_pulses["muon_veto_trigger"].shape, dtype=bool)
         mask[self.bad_mv_triggers(aqm_pulses)] = False
-        list_indicies = list()
-        for l, times in enumerate(np.diff(aqm_pulses["muon_veto_trigger"][mask])):
-            if times < ap_time:  # get rid of pulses that comes within 20mu sec.
-                list_indicies.append(l+1)
+        times = aqm_pulses["muon_veto_trigger"][mask]
 
-        aqm_pulses["muon_veto_trigger"] = np.delete(aqm_pulses["muon_veto_trigger"][mask], list_indicies)
+        # get rid of pulses that come within 20 mu sec. of the previous one
+        keep = np.ones(len(times), dtype=bool)
+        keep[1:] = ~(np.diff(times) < ap_time)
+        aqm_pulses["muon_veto_trigger"] = times[keep]
 
         return aqm_pulses
 
-    def get_data(self, dataset, event_list=None):
-        aqm_pulses = self.select_physical_pulses(get_aqm_pulses(dataset))
+    def compute(self, frames):
+        aqm_pulses = self.select_physical_pulses(get_aqm_pulses(self.run_name))
 
-        # Load the fundamentals and totalproperties minitree
-        # Yes, minitrees loading other minitrees, the fun has begun :-)
-        event_data = hax.minitrees.load_single_dataset(
-            dataset, ['Fundamentals', 'TotalProperties', 'LargestPeakProperties'])[0]
+        # Yes, minitrees computed from other minitrees, the fun has begun :-)
+        event_data = self.merge_frames(frames)
         # Note integer division here, not optional: float arithmetic is too inprecise
         # (fortuately our digitizer sampling resolution is an even number of nanoseconds...)
         event_data['center_time'] = event_data.event_time + event_data.event_duration // 2
@@ -110,116 +113,249 @@ class Proximity(hax.minitrees.TreeMaker):
                              )
         self.s2s = event_data.s2_area.values
 
-        # super() does not play nice with dask computations, for some reason
-        return hax.minitrees.TreeMaker.get_data(self, dataset, event_list)
+        if not len(event_data):
+            log.warning("Not a single row was extracted from dataset %s!" % self.run_name)
+            return pd.DataFrame([], columns=['event_number', 'run_number'])
 
-    def extract_data(self, event):
-        # Again, integer division is not optional here!
-        t = (event.start_time + event.stop_time) // 2
-        result = dict()
+        return self.compute_proximity(event_data.event_number.values,
+                                      event_data.center_time.values,
+                                      event_data.event_duration.values)
 
+    def compute_proximity(self, event_numbers, t, event_duration):
+        """Return DataFrame with the proximity information for events with event_numbers, center times t
+        and durations event_duration, using self.search_these and self.s2s (set in compute).
+        The columns have the same values and types as we got from looping over events (pandas makes a column
+        of values and the int placeholder for 'not found' floats, unless all values are the placeholder).
+        """
+        t = t.astype(np.int64)
+        result = OrderedDict()
         for label, x in self.search_these:
             # we want to use for the MV the time with respect to the trigger in the TPC
             if label == "muon_veto_trigger":
-                t_corr = np.int64(event.stop_time - event.start_time) // 2 - np.int64(10**6)
+                t_corr = event_duration.astype(np.int64) // 2 - np.int64(10**6)
             else:
-                t_corr = np.int64(0)
-
-            prev = 'previous_%s' % label
-            nxt = 'next_%s' % label
+                t_corr = np.zeros(len(t), dtype=np.int64)
 
             # Find the first object (at or) after t
             if label == 'event':
-                i = event.event_number
+                i = event_numbers.astype(np.int64)
             else:
                 # Index in x of the first value >= t
                 i = np.searchsorted(x, t)
 
-            if i == 0:
-                # ~- int(np.inf).... 100th Birthday
-                result[prev] = 368395560000000000
-                if label == 'event':
-                    result['previous_s2_area'] = 368395560000000000
-            else:
-                result[prev] = t - x[i - 1]
-                if label == 'event':
-                    result['previous_s2_area'] = self.s2s[i - 1]
+            # i == 0 means no previous object: ~- int(np.inf).... 100th Birthday
+            prev = _ProximityColumn(t - _take(x, i - 1, i > 0), i == 0)
+            if label == 'event':
+                prev_s2 = _ProximityColumn(_take(self.s2s, i - 1, i > 0), i == 0)
 
             # Check if the sought-after object is exactly at t
             # This is always true if label == 'event', only very rarely for aqm signals.
             # (but then we don't want to advance the 'next' index, it's important that the signal
             #  is right in the center!)
-            if i != len(x) and x[i] == t and label not in self.aqm_labels:
+            if label not in self.aqm_labels:
+                at_t = (i != len(x)) & (_take(x, i, i != len(x)) == t)
                 # The real 'next' is one further:
-                i += 1
+                i = i + at_t
             else:
-                assert label != 'event'
+                at_t = np.zeros(len(t), dtype=np.bool_)
+            assert label != 'event' or at_t.all()
 
-            if i == len(x):
-                result[nxt] = 368395560000000000
-                if label == 'event':
-                    result['next_s2_area'] = 368395560000000000
-            else:
-                result[nxt] = x[i] - t
-                if label == 'event':
-                    result['next_s2_area'] = self.s2s[i]
+            nxt = _ProximityColumn(_take(x, i, i != len(x)) - t, i == len(x))
+
+            result['previous_%s' % label] = prev.values()
+            if label == 'event':
+                result['previous_s2_area'] = prev_s2.values()
+            result['next_%s' % label] = nxt.values()
+            if label == 'event':
+                next_s2 = _ProximityColumn(_take(self.s2s, i, i != len(x)), i == len(x))
+                result['next_s2_area'] = next_s2.values()
 
             # Include the 'nearest' variable. This is negative if the nearest sought-after object
             # is in the past.
-            tnr = 'nearest_' + label
-            if result[nxt] > result[prev]:
-                result[tnr] = - result[prev] + t_corr
-            else:
-                result[tnr] = result[nxt] + t_corr
+            nearest = _ProximityColumn.where(nxt.compare_values() > prev.compare_values(),
+                                             prev.apply(lambda v: -v + t_corr),
+                                             nxt.apply(lambda v: v + t_corr))
+            result['nearest_' + label] = nearest.values()
 
         # Need special logic for nearest s2 area
-        if result['nearest_event'] == result['previous_event']:
-            result['nearest_s2_area'] = result['previous_s2_area']
-        else:
-            result['nearest_s2_area'] = result['next_s2_area']
+        result['nearest_s2_area'] = _ProximityColumn.where(result['nearest_event'] == result['previous_event'],
+                                                           prev_s2, next_s2).values()
 
-        return result
+        result['event_number'] = event_numbers
+        result['run_number'] = self.run_number
+        return pd.DataFrame(result)
 
 
-class TailCut(hax.minitrees.TreeMaker):
-    __version__ = '0.0.3'
+# Placeholder for previous/next objects that do not exist
+NOT_FOUND = 368395560000000000
+
+
+def _take(x, i, valid):
+    """Return x[i] where valid, and zero elsewhere (also if x is empty)"""
+    if not len(x):
+        return np.zeros(len(i), dtype=x.dtype)
+    return x[np.where(valid, i, 0)]
+
+
+class _ProximityColumn(object):
+    """Values of a Proximity column, some of which are (derived from) the int placeholder NOT_FOUND.
+    :param found_values: values for the objects that were found (dtype following from the data)
+    :param not_found: boolean array, True where there was no object
+    :param not_found_values: int64 values where not_found. Defaults to NOT_FOUND.
+    """
+
+    def __init__(self, found_values, not_found, not_found_values=None):
+        self.found_values = found_values
+        self.not_found = not_found
+        if not_found_values is None:
+            not_found_values = np.full(len(not_found), NOT_FOUND, dtype=np.int64)
+        self.not_found_values = not_found_values
+
+    def apply(self, f):
+        """Return new column with f applied to the values (and separately, in integers, to the placeholders)"""
+        return _ProximityColumn(f(self.found_values), self.not_found, f(self.not_found_values))
+
+    @staticmethod
+    def where(condition, a, b):
+        return _ProximityColumn(np.where(condition, a.found_values, b.found_values),
+                                np.where(condition, a.not_found, b.not_found),
+                                np.where(condition, a.not_found_values, b.not_found_values))
+
+    def compare_values(self):
+        """Return values for comparisons: placeholders as they are, compared to the found values (in their dtype)"""
+        return np.where(self.not_found, self.not_found_values, self.found_values)
+
+    def values(self):
+        if self.not_found.all():
+            return self.not_found_values
+        if self.found_values.dtype.kind == 'f':
+            # Like pandas converting a column of floats and ints
+            return np.where(self.not_found, self.not_found_values.astype(np.float64), self.found_values)
+        return np.where(self.not_found, self.not_found_values, self.found_values)
+
+
+class TailCut(hax.minitrees.DerivedTreeMaker):
+    """Largest S2 area over time difference between the event and a previous event, for the tail (photoionization,
+    delayed electrons) cut.
+    Provides:
+     - s2_over_tdiff: largest s2_area / (t - t_previous) of the previous events, 0 if there are none.
+       t is the center time of the event (in ns), s2_area the area of its largest S2 (0 if it has none).
+     - tailcut_set_by: how many events back the event setting s2_over_tdiff is (0 if there are no previous events)
+     - s2_area_tailcut_set_by: the s2_area of that event
+
+    The previous events are the last tailcut_look_back events or, if the tailcut_time_window option is set,
+    the events in the last tailcut_time_window ns. With the tailcut_across_runs option, the events at the end
+    of the previous run count too, if it ended shortly before this one: we then also load (or make) the
+    Fundamentals and LargestPeakProperties minitrees of the previous run.
+    """
+    __version__ = '0.2.0'
     never_store = True
+    depends_on = ('Fundamentals', 'LargestPeakProperties')
 
-    def get_data(self, dataset, event_list=None):
-        look_back = 100
-        # Load Fundamentals and LargestPeakProperties
-        # Using load_single_dataset instead of load will ensure no blindding cut is applies
-        data, _ = hax.minitrees.load_single_dataset(dataset, ['Fundamentals', 'LargestPeakProperties'])
+    def compute(self, frames):
+        look_back = hax.config['tailcut_look_back']
+        time_window = hax.config['tailcut_time_window']
 
+        data = self.merge_frames(frames)
         if data.empty:
-            return pd.DataFrame({})
-
-        # Get largest S2 in the event (or 0, if no S2 was found)
-        s2 = data['s2_area'].values
+            return pd.DataFrame([], columns=['event_number', 'run_number'])
+        s2, t = self.s2_and_time(data)
+
+        history = None
+        if hax.config['tailcut_across_runs']:
+            history = self.previous_run_history(t[0], look_back, time_window)
+        s2_over_tdiff, tailcut_set_by, s2_area_tailcut_set_by, _ = tailcut(s2, t, look_back, time_window,
+                                                                           history=history)
+
+        return pd.DataFrame(OrderedDict([('event_number', data['event_number'].values),
+                                         ('run_number', data['run_number'].values),
+                                         ('s2_over_tdiff', s2_over_tdiff),
+                                         ('tailcut_set_by', tailcut_set_by),
+                                         ('s2_area_tailcut_set_by', s2_area_tailcut_set_by)]))
+
+    @staticmethod
+    def s2_and_time(data):
+        """Return the largest S2 area (0 if there is no S2) and center time of the events in data"""
+        s2 = data['s2_area'].values.copy()
         s2[np.isnan(s2)] = 0
-
-        # Get the center time of the event
         t = data['event_time'].values + data['event_duration'].values/2
+        return s2, t
+
+    def previous_run_history(self, first_event_time, look_back, time_window):
+        """Return (s2 areas, center times) of the events in the previous run the events in this run look back at,
+        or None if there is no previous run, it ended too long before first_event_time (more than time_window,
+        or tailcut_max_run_gap ns if that is None), or we can't get its minitrees.
+        """
+        datasets = hax.runs.datasets
+        earlier = datasets[datasets['number'].values < self.run_number]
+        if not len(earlier):
+            return None
+        previous = earlier.iloc[np.argmax(earlier['number'].values)]
+        previous_run = int(previous['number'])
+        max_gap = time_window if time_window is not None else hax.config['tailcut_max_run_gap']
+        if pd.isnull(previous['end']) or first_event_time - pd.Timestamp(previous['end']).value > max_gap:
+            log.debug("Run %d ended too long before run %d, not using its events for the tail cut" % (
+                previous_run, self.run_number))
+            return None
+        previous_frames = hax.minitrees.RunMinitrees(previous_run)
+        try:
+            data = self.merge_frames([previous_frames[name] for name in self.depends_on])
+        except (hax.minitrees.NoMinitreeAvailable, FileNotFoundError) as e:
+            log.warning("Could not load the minitrees of the previous run %d (%s), so the tail cut of run %d "
+                        "does not consider its events" % (previous_run, e, self.run_number))
+            return None
+        s2, t = self.s2_and_time(data)
+        before = t < first_event_time
+        s2, t = s2[before], t[before]
+        if time_window is not None:
+            tail = t >= first_event_time - time_window
+        else:
+            tail = np.arange(len(t)) >= len(t) - look_back
+        return s2[tail], t[tail]
 
-        # Compute S2/tdif for each value of lookback (from 1 to look_back, inclusive)
-        # Allocates n_events * look_back floats; should not be a problem unless look_back is insane number.
-        s2_over_tdiff_lookback = np.zeros((len(t), look_back + 1))
-        s2_area_lookback = np.zeros((len(t), look_back + 1))
-        for i in range(1, look_back + 1):
-            s2_over_tdiff_lookback[i:, i] = s2[:-i]/(t[i:] - t[:-i])
-            s2_area_lookback[i:, i] = s2[:-i]
-
-        # Which event
-        tailcut_set_by = np.argmax(s2_over_tdiff_lookback, axis=1)
-        result = s2_over_tdiff_lookback.max(axis=1)
-
-        # Area of the peak corresponding to the 'tailcut_set_by' event
-        s2_area_tailcut_set_by = np.zeros(len(s2_area_lookback))
-        for i, s2back in enumerate(s2_area_lookback):
-            s2_area_tailcut_set_by[i] = np.take(s2back, tailcut_set_by[i])
-
-        return pd.DataFrame(dict(event_number=data['event_number'],
-                                 run_number=data['run_number'],
-                                 s2_over_tdiff=result,
-                                 tailcut_set_by=tailcut_set_by,
-                                 s2_area_tailcut_set_by=s2_area_tailcut_set_by))
+
+def tailcut(s2, t, look_back=100, time_window=None, history=None):
+    """Return s2_over_tdiff, tailcut_set_by, s2_area_tailcut_set_by (see TailCut) and the tail of the events
+    for events with largest S2 areas s2 and center times t.
+    :param look_back: number of previous events to consider
+    :param time_window: if not None, consider the previous events up to time_window ns ago instead
+    :param history: (s2, t) of events before the first one, e.g. the tail of a previous call
+    The tail is (s2, t) of the last events, the history the next events need.
+
+    We loop over the distance to the previous event, keeping the largest value so far for each event:
+    this takes O(n_events * look_back) time, but no n_events * look_back matrix.
+    """
+    if history is not None:
+        s2 = np.concatenate([history[0], s2])
+        t = np.concatenate([history[1], t])
+    n_history = 0 if history is None else len(history[0])
+    n = len(t)
+
+    best = np.zeros(n - n_history)
+    best_back = np.zeros(n - n_history, dtype=np.int64)
+    best_s2 = np.zeros(n - n_history)
+    back = 1
+    while back < n and (time_window is not None or back <= look_back):
+        # Events that have an event back events before them
+        first = max(n_history, back)
+        values = s2[first - back:n - back] / (t[first:] - t[first - back:n - back])
+        if time_window is not None:
+            in_window = t[first:] - t[first - back:n - back] <= time_window
+            if not np.any(in_window):
+                break
+            values[~in_window] = 0
+        # Keep the first maximum (or NaN), like np.argmax
+        current = best[first - n_history:]
+        update = (values > current) | (np.isnan(values) & ~np.isnan(current))
+        index = np.where(update)[0] + first - n_history
+        best[index] = values[update]
+        best_back[index] = back
+        best_s2[index] = s2[first - back:n - back][update]
+        back += 1
+
+    # The events the next events have to look back at
+    if time_window is not None:
+        tail = t >= t[-1] - time_window if n else np.zeros(0, dtype=np.bool_)
+    else:
+        tail = np.arange(n) >= n - look_back
+    return best, best_back, best_s2, (s2[tail], t[tail])
@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
 import pickle
 import zipfile
 import zlib
@@ -12,6 +15,9 @@ import pandas as pd
 from pax.configuration import load_configuration
 from pax import datastructure, units
 import hax
+from hax.utils import find_file_in_folders
+
+log = logging.getLogger('hax.trigger_data')
 
 # Custom data types used (others are just np.int)
 data_types = {
@@ -48,33 +54,68 @@ def get_trigger_data(run_id, select_data_types='all', format_version=2):
     """Return dictionary with the trigger data from run_id
     select_data_types can be 'all', a trigger data type name, or a list of trigger data type names.
     If you want to find out which data types exists, use 'all' and look at the keys of the dictionary.
+    For a single data type name, you get just the data of that type rather than a dictionary.
+
+    The decoded data of each type is cached in a directory next to the minitrees (if minitree_caching is on).
+    Arrays are loaded from there as read-only memory maps.
     """
-    if isinstance(select_data_types, str) and select_data_types != 'all':
+    # For a single data type name, we return just its data rather than a dictionary
+    single_type = isinstance(select_data_types, str) and select_data_types != 'all'
+    if single_type:
         select_data_types = [select_data_types]
 
-    data = defaultdict(list)
-    filename = get_special_file_filename('trigger_monitor_data.zip',
-                                         run_id,
-                                         'trigger_data_special_path')
+    cache_dir = _trigger_data_cache_dir(run_id, format_version)
+    if select_data_types == 'all' and cache_dir is not None:
+        # The cache knows which data types the run has, if we looked at all of them before
+        types_file = os.path.join(cache_dir, 'data_types.json')
+        if os.path.exists(types_file):
+            with open(types_file) as infile:
+                select_data_types = json.load(infile)
+
+    data = {}
+    if select_data_types != 'all' and cache_dir is not None:
+        for data_type in select_data_types:
+            value = _load_cached_trigger_data(cache_dir, data_type)
+            if value is not None:
+                data[data_type] = value
+
+    if select_data_types == 'all' or len(data) < len(select_data_types):
+        filename = get_special_file_filename('trigger_monitor_data.zip',
+                                             run_id,
+                                             'trigger_data_special_path')
+        decoded, all_data_types = _decode_trigger_data(
+            filename,
+            select_data_types if select_data_types == 'all' else [t for t in select_data_types if t not in data],
+            format_version)
+        data.update(decoded)
+        if hax.config['minitree_caching']:
+            _save_trigger_data_cache(run_id, format_version, decoded, all_data_types)
+
+    if single_type:
+        return data[select_data_types[0]]
+    return data
 
-    f = zipfile.ZipFile(filename)
-    for doc_name in f.namelist():
-        data_type, index = doc_name.split('=')
+
+def _decode_trigger_data(filename, select_data_types, format_version):
+    """Return (dictionary with the trigger data of select_data_types in the zipfile filename,
+               list of all data types in the file).
+    Only the documents of the selected types are read; they are decompressed and decoded in a thread pool
+    (zlib releases the GIL), with trigger_data_threads threads.
+    """
+    data = defaultdict(list)
+    with zipfile.ZipFile(filename) as f:
+        doc_names = f.namelist()
+        all_data_types = sorted(set([doc_name.split('=')[0] for doc_name in doc_names]))
         if select_data_types != 'all':
-            if data_type not in select_data_types:
-                continue
-        with f.open(doc_name) as doc_file:
-            d = doc_file.read()
-            d = zlib.decompress(d)
-            d = bson.BSON.decode(d)
-            if 'data' in d:
-                if format_version >= 2:
-                    # Numpy arrays stored as lists
-                    d = np.array(d['data'], dtype=data_types.get(data_type, np.int))
-                else:
-                    # Numpy arrays stored as strings
-                    d = np.fromstring(d['data'], dtype=data_types.get(data_type, np.int))
-            data[data_type].append(d)
+            doc_names = [doc_name for doc_name in doc_names if doc_name.split('=')[0] in select_data_types]
+        n_threads = max(1, int(hax.config.get('trigger_data_threads', 4) or 1))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            # Reading from the zipfile is sequential anyway, do that here
+            docs = executor.map(_decode_trigger_document,
+                                [(doc_name.split('=')[0], f.read(doc_name), format_version)
+                                 for doc_name in doc_names])
+            for doc_name, d in zip(doc_names, docs):
+                data[doc_name.split('=')[0]].append(d)
 
     # Flatten / post-process the data
     for k in data.keys():
@@ -101,29 +142,113 @@ def get_trigger_data(run_id, select_data_types='all', format_version=2):
             else:
                 data[k] = np.vstack(data[k])
 
-    if select_data_types != 'all' and len(select_data_types) == 1:
-        return data[select_data_types[0]]
-    return data
+    return dict(data), all_data_types
+
+
+def _decode_trigger_document(args):
+    """Decompress and decode one trigger data document. args is (data type, compressed bytes, format_version)"""
+    data_type, d, format_version = args
+    d = zlib.decompress(d)
+    d = bson.BSON.decode(d)
+    if 'data' in d:
+        if format_version >= 2:
+            # Numpy arrays stored as lists
+            d = np.array(d['data'], dtype=data_types.get(data_type, np.int))
+        else:
+            # Numpy arrays stored as strings
+            d = np.fromstring(d['data'], dtype=data_types.get(data_type, np.int))
+    return d
+
+
+def _trigger_data_cache_dirname(run_id, format_version):
+    return '%s_trigger_data_v%d' % (hax.runs.get_run_name(run_id), format_version)
+
+
+def _trigger_data_cache_dir(run_id, format_version):
+    """Return path to the trigger data cache directory of run_id, or None if there is none"""
+    try:
+        return find_file_in_folders(_trigger_data_cache_dirname(run_id, format_version),
+                                    hax.config['minitree_paths'])
+    except FileNotFoundError:
+        return None
+
+
+def _load_cached_trigger_data(cache_dir, data_type):
+    """Return the cached data of data_type, or None if it isn't cached"""
+    path = os.path.join(cache_dir, data_type)
+    if os.path.exists(path + '.npy'):
+        return np.load(path + '.npy', mmap_mode='r')
+    if os.path.exists(path + '.pkl'):
+        return pd.read_pickle(path + '.pkl')
+    return None
+
+
+def _save_trigger_data_cache(run_id, format_version, data, all_data_types):
+    cache_dir = os.path.join(hax.config['minitree_paths'][0], _trigger_data_cache_dirname(run_id, format_version))
+    os.makedirs(cache_dir, exist_ok=True)
+    for data_type, value in data.items():
+        path = os.path.join(cache_dir, data_type)
+        # Write to a temporary file first, so an interruption can't leave a corrupt cache file
+        if isinstance(value, pd.DataFrame):
+            value.to_pickle(path + '.pkl.tmp')
+            os.replace(path + '.pkl.tmp', path + '.pkl')
+        else:
+            with open(path + '.npy.tmp', mode='wb') as outfile:
+                np.save(outfile, value)
+            os.replace(path + '.npy.tmp', path + '.npy')
+    with open(os.path.join(cache_dir, 'data_types.json'), mode='w') as outfile:
+        json.dump(all_data_types, outfile)
 
 
 def get_aqm_pulses(run_id):
     """Return a dictionary of acquisition monitor pulse times in the run run_id.
-    keys are channel labels (e.g. muon_veto_trigger).
+    keys are channel labels (e.g. muon_veto_trigger), values sorted int64 arrays of times in ns since the unix epoch.
     Under the keys 'busy' and 'hev', you'll get the sorted combination of all busy/hev _on and _off signals.
+    Raises KeyError if there is a pulse in a (module, channel) that isn't an acquisition monitor channel.
+
+    The pulse times are cached in an npz file next to the minitrees (if minitree_caching is on),
+    so we only read the acquisition monitor pickles once per run. The cache is remade if the sample duration
+    or the acquisition monitor channels in the pax configuration change.
     """
-    filename = get_special_file_filename('acquisition_monitor_data.pickles',
-                                         run_id,
-                                         'acquisition_monitor_special_path')
+    dt, aqm_channel = _aqm_settings()
+    # Settings stored with the cached pulse times, to check they still apply
+    settings = dict(_sample_duration=np.int64(dt),
+                    _aqm_channels=np.array(['%d,%d:%s' % (module, channel, label)
+                                            for (module, channel), label in sorted(aqm_channel.items())]))
 
-    # Get the run start time in ns since the unix epoch. This isn't known with such accuracy,
-    # but we use the exact same determination here as in the event builder.
-    # Hence we can compare the times to the event times.
-    start_datetime = hax.runs.get_run_info(run_id, 'start').replace(tzinfo=pytz.utc).timestamp()
-    time_of_run_start = int(start_datetime * units.s)
+    cache_filename = '%s_acquisition_monitor.npz' % hax.runs.get_run_name(run_id)
+    try:
+        cache_path = find_file_in_folders(cache_filename, hax.config['minitree_paths'])
+    except FileNotFoundError:
+        pass
+    else:
+        with np.load(cache_path) as f:
+            if all(k in f.files and np.array_equal(f[k], v) for k, v in settings.items()):
+                return {k: f[k] for k in f.files if k not in settings}
+        log.info("Acquisition monitor settings changed since %s was made, remaking it" % cache_path)
+
+    aqm_signals = _read_aqm_pulses(run_id, dt, aqm_channel)
+
+    if hax.config['minitree_caching']:
+        creation_dir = hax.config['minitree_paths'][0]
+        if not os.path.exists(creation_dir):
+            os.makedirs(creation_dir)
+        cache_path = os.path.join(creation_dir, cache_filename)
+        # Write to a temporary file first, so an interruption can't leave a corrupt cache file
+        with open(cache_path + '.tmp', mode='wb') as outfile:
+            np.savez(outfile, **dict(aqm_signals, **settings))
+        os.replace(cache_path + '.tmp', cache_path)
 
-    # Get the pax configuration
+    return aqm_signals
+
+
+def _aqm_settings():
+    """Return the sample duration (in ns) and the (module, channel) -> acquisition monitor channel label map
+    from the pax configuration.
+    """
     pax_config = load_configuration(hax.config['experiment'])
-    dt = pax_config['DEFAULT']['sample_duration']
+    # The sample duration is an integer number of ns: keep the times integers, floats are too imprecise.
+    dt = int(round(pax_config['DEFAULT']['sample_duration']))
 
     # Make the (module, channel) -> Acquisition monitor channel label map
     pmt_map = pax_config['DEFAULT']['pmts']
@@ -133,21 +258,53 @@ def get_aqm_pulses(run_id):
     # Temp hack for the muon veto synchronization channel, which hasn't been added to pax (it would result in
     # incompatible raw data files)
     aqm_channel[(167, 6)] = 'mv_sync'
+    return dt, aqm_channel
 
-    aqm_signals = {k: [] for k in aqm_channel.values()}
+
+def _read_aqm_pulses(run_id, dt, aqm_channel):
+    """Return dictionary of acquisition monitor pulse times in the run run_id, read from the pickles.
+    dt and aqm_channel are the sample duration and channel map from _aqm_settings. See get_aqm_pulses.
+    """
+    filename = get_special_file_filename('acquisition_monitor_data.pickles',
+                                         run_id,
+                                         'acquisition_monitor_special_path')
+
+    # Get the run start time in ns since the unix epoch. This isn't known with such accuracy,
+    # but we use the exact same determination here as in the event builder.
+    # Hence we can compare the times to the event times.
+    start_datetime = hax.runs.get_run_info(run_id, 'start').replace(tzinfo=pytz.utc).timestamp()
+    time_of_run_start = int(start_datetime * units.s)
+
+    modules, channels, times = [], [], []
     with open(filename, 'rb') as infile:
         while True:
             try:
                 doc = pickle.load(infile)
-                if not isinstance(doc, dict):
-                    # There's some random string at the start of the file for newer runs, skip it.
-                    continue
-                aqm_signals[aqm_channel[doc['module'], doc['channel']]].append(doc['time'] * dt + time_of_run_start)
             except EOFError:
                 break
+            if not isinstance(doc, dict):
+                # There's some random string at the start of the file for newer runs, skip it.
+                continue
+            modules.append(doc['module'])
+            channels.append(doc['channel'])
+            times.append(doc['time'])
+    modules = np.array(modules, dtype=np.int64)
+    channels = np.array(channels, dtype=np.int64)
+    times = np.array(times, dtype=np.int64) * dt + time_of_run_start
+
+    aqm_signals = {}
+    known = np.zeros(len(times), dtype=np.bool_)
+    for (module, channel), label in aqm_channel.items():
+        is_channel = (modules == module) & (channels == channel)
+        known |= is_channel
+        aqm_signals[label] = np.sort(times[is_channel])
+    if not known.all():
+        # Like looking up the pulse's channel in aqm_channel
+        i = np.argmin(known)
+        raise KeyError((int(modules[i]), int(channels[i])))
 
     # Combine busy_on and hev_on signals for convenience
     for x in ('busy', 'hev'):
-        aqm_signals[x] = np.sort(aqm_signals[x + '_on'] + aqm_signals[x + '_off'])
+        aqm_signals[x] = np.sort(np.concatenate([aqm_signals[x + '_on'], aqm_signals[x + '_off']]))
 
-    return {k: np.array(v) for k, v in aqm_signals.items()}
+    return aqm_signals
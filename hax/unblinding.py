@@ -1,6 +1,10 @@
-import hax
 import logging
 
+import numpy as np
+import pandas as pd
+
+import hax
+
 log = logging.getLogger('hax.unblinding')
 
 blind_from_run = 3936
@@ -90,6 +94,13 @@ def make_unblinding_selection():
     # Remove extraneous AND
     unblinding_selection = unblinding_selection[:-3]
 
+    # Compile the selection now (it's cached by hax.expressions), rather than for every run we load
+    try:
+        columns = hax.expressions.compile_expression(unblinding_selection).columns
+        log.debug("Unblinding selection uses columns %s" % ', '.join(columns))
+    except hax.expressions.CannotCompile as e:
+        log.debug("Unblinding selection will be evaluated by pandas: %s" % e)
+
 
 def is_blind(run_id):
     """Determine if a dataset should be blinded based on the runDB
@@ -98,36 +109,62 @@ def is_blind(run_id):
 
     :returns : True if the blinding cut should be applied, False if not
     """
-    if hax.config['experiment'] != 'XENON1T':
-        return False
+    return bool(is_blind_many([run_id])[0])
 
-    # Do not blind MC
-    if hax.runs.is_mc(run_id)[0]:
-        return False
 
-    try:
-        run_number = hax.runs.get_run_number(run_id)
-        run_data = hax.runs.datasets.query('number == %d' % run_number).iloc[0]
-
-    except Exception:
-        # Couldn't find in runDB, so blind by default
-        log.warning("Exception while trying to find run %s: blinding by default" % run_id)
-        return True
-
-    tag_names = [tag for tag in run_data.tags.split(',')]
-    number = run_data['number']
-
-    # Blind runs with explicit blinding tag, unblind runs with explicit unblinding tag.
-    # (underscore means that it is a protected tag)
-    if 'blinded' in tag_names or '_blinded' in tag_names:
-        return True
-    if '_unblinded' in tag_names:
-        return False
-
-    # Blind runs past a configured run number
-    if number > blind_from_run and \
-            run_data.reader__ini__name.startswith('background'):
-        return True
-
-    # Everything else is not blinded
-    return False
+def is_blind_many(run_ids):
+    """Determine for several datasets at once if they should be blinded, based on the runDB.
+    The decision is made from the columns of hax.runs.datasets, without opening any pax root files.
+    Only for runs without an entry in the runs db do we check (using cached root file metadata) if they are MC.
+
+    :param run_ids: list of names and/or numbers of the runs to check
+
+    :returns : numpy array of booleans, True if the blinding cut should be applied to the corresponding run
+    """
+    run_ids = list(run_ids)
+    result = np.zeros(len(run_ids), dtype=np.bool_)
+    if hax.config['experiment'] != 'XENON1T' or not len(run_ids):
+        return result
+
+    dsets = hax.runs.datasets
+    if dsets is None:
+        dsets = pd.DataFrame([], columns=['name', 'number', 'tags', 'reader__ini__name'])
+
+    # Find the runs db row of each run: by name for strings, by number for everything else
+    is_name = np.array([isinstance(run_id, str) for run_id in run_ids])
+    row_index = np.full(len(run_ids), -1, dtype=np.int64)
+    for field, mask in (('name', is_name), ('number', ~is_name)):
+        if not mask.any() or field not in dsets:
+            continue
+        keys = [hax.runs.get_run_name(run_id) if field == 'name' else run_id
+                for run_id, m in zip(run_ids, mask) if m]
+        lookup = pd.Series(np.arange(len(dsets)), index=dsets[field].values)
+        lookup = lookup[~lookup.index.duplicated(keep='first')]
+        row_index[mask] = lookup.reindex(keys).fillna(-1).values.astype(np.int64)
+    found = row_index >= 0
+
+    # Evaluate the blinding criteria for all found runs at once
+    if found.any():
+        rows = dsets.iloc[row_index[found]]
+        # Pad the tags with commas, so we only match complete tag names.
+        # (underscore means that it is a protected tag)
+        tags = ',' + rows['tags'].fillna('').astype(str) + ','
+        has_blinded_tag = tags.str.contains(',_?blinded,', regex=True).values
+        has_unblinded_tag = tags.str.contains(',_unblinded,', regex=False).values
+        # Blind runs past a configured run number
+        is_late_background = ((rows['number'].values > blind_from_run) &
+                              rows['reader__ini__name'].astype(str).str.startswith('background').values)
+        result[found] = has_blinded_tag | (~has_unblinded_tag & is_late_background)
+
+    # Runs that are not in the runs db: do not blind MC, blind anything else by default.
+    for i in np.where(~found)[0]:
+        run_id = run_ids[i]
+        try:
+            if hax.runs.is_mc(run_id)[0]:
+                continue
+        except FileNotFoundError:
+            pass
+        log.warning("Couldn't find run %s in the runs db: blinding by default" % run_id)
+        result[i] = True
+
+    return result
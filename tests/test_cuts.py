@@ -0,0 +1,42 @@
+"""Tests of cut history tracking on dask dataframes"""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from hax import cuts
+
+
+class TestDaskCutHistory(unittest.TestCase):
+
+    def setUp(self):
+        import dask.dataframe as dd
+        self.data = pd.DataFrame(dict(cs1=np.arange(100.), cs2=np.arange(100.) % 10))
+        self.d = dd.from_pandas(self.data, npartitions=4)
+        self.assertEqual(self.d.npartitions, 4)
+
+    def select(self):
+        d = cuts.selection(self.d, self.d.cs1 >= 30, desc='cs1 >= 30', quiet=True)
+        return cuts.selection(d, d.cs2 < 5, desc='cs2 < 5', quiet=True)
+
+    def check_history(self, hist):
+        self.assertEqual(list(hist.selection_desc), ['cs1 >= 30', 'cs2 < 5'])
+        self.assertEqual(list(hist.n_before), [100, 70])
+        self.assertEqual(list(hist.n_after), [70, 35])
+
+    def test_compute(self):
+        result = cuts.compute(self.select(), quiet=True, scheduler='sync')
+        pd.testing.assert_frame_equal(result, self.data[(self.data.cs1 >= 30) & (self.data.cs2 < 5)])
+        self.check_history(cuts.history(result))
+
+    def test_history(self):
+        self.check_history(cuts.history(self.select()))
+
+    def test_repeated_selection_skipped(self):
+        d = self.select()
+        d = cuts.selection(d, d.cs1 >= 30, desc='cs1 >= 30', quiet=True)
+        self.check_history(cuts.history(d))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Tests of writing and reading the chunked output of DataExtractor"""
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from hax.data_extractor import ChunkedArray, ChunkedArrayWriter
+
+
+class TestChunkedArray(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, field_names, events_per_run, chunk_size=4):
+        """Write two peaks per event, like DataExtractor.loop_body, for runs mapping run number -> event numbers"""
+        writer = ChunkedArrayWriter(self.dir, field_names, chunk_size=chunk_size)
+        for run_number, event_numbers in events_per_run.items():
+            writer.start_run(run_number)
+            for event_number in event_numbers:
+                for peak_type in ('s1', 'lone_hit'):
+                    row = [event_number, 10. * event_number + run_number, peak_type][:len(field_names)]
+                    # Numbers and strings in one numpy array become strings
+                    writer.append(np.c_[[np.array(row)]], event_number)
+        return writer.close()
+
+    def test_read_run_and_event_range(self):
+        data = self.write(['event_number', 'area'], {1: range(10), 2: range(5)})
+        self.assertEqual(len(data), 30)
+        self.assertEqual(data.run_numbers, [1, 2])
+        rows = data.read(run_number=1, event_range=(3, 6))
+        np.testing.assert_array_equal(rows['event_number'], np.repeat([3, 4, 5, 6], 2))
+        np.testing.assert_array_equal(rows['area'], np.repeat([31, 41, 51, 61], 2))
+        self.assertEqual(len(data.read(run_number=2)), 10)
+        self.assertEqual(len(data.read(event_range=(20, 30))), 0)
+        # Reading from the index on disk gives the same
+        np.testing.assert_array_equal(ChunkedArray(self.dir).read(1, (3, 6)), rows)
+
+    def test_string_field(self):
+        data = self.write(['event_number', 'area', 'type'], {1: range(3)}, chunk_size=3)
+        rows = data.read(run_number=1, event_range=(1, 2))
+        self.assertEqual(rows.dtype['area'], np.float64)
+        self.assertEqual(list(rows['type']), ['s1', 'lone_hit'] * 2)
+        self.assertEqual(list(data.to_dataframe()['type']), ['s1', 'lone_hit'] * 3)
+
+    def test_non_numeric_after_numbers(self):
+        writer = ChunkedArrayWriter(self.dir, ['event_number', 'area'])
+        writer.start_run(1)
+        writer.append(np.array([[0, 1.]]), 0)
+        writer.append(np.array([['1', 'lots']]), 1)
+        self.assertRaises(ValueError, writer.close)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""Tests of storing jagged minitrees in npz files"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from hax.jagged import JaggedTable
+
+
+class TestJaggedTableSave(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'peaks.npz')
+        # Like a PeakExtractor minitree, with an array-valued field
+        self.data = pd.DataFrame(dict(event_number=[0, 0, 2], run_number=[5, 5, 5], area=[1., 2., 3.],
+                                      type=['s1', 's2', 'lone_hit'],
+                                      range_area_decile=[list(np.arange(11.) * i) for i in range(3)]))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        JaggedTable.from_dataframe(self.data, event_numbers=[0, 1, 2], run_number=5).save(self.filename)
+        with np.load(self.filename) as f:
+            self.assertEqual(f['row:range_area_decile'].shape, (3, 11))
+        table = JaggedTable.load(self.filename)
+        np.testing.assert_array_equal(table.counts(), [2, 0, 1])
+        data = table.to_dataframe()
+        self.assertEqual(list(data.columns), list(self.data.columns))
+        self.assertEqual(list(data['type']), list(self.data['type']))
+        for loaded, original in zip(data['range_area_decile'], self.data['range_area_decile']):
+            np.testing.assert_array_equal(loaded, original)
+
+    def test_empty(self):
+        table = JaggedTable.from_dataframe(self.data).select(np.zeros(3, dtype=np.bool_))
+        table.save(self.filename)
+        self.assertEqual(len(JaggedTable.load(self.filename)), 0)
+
+    def test_ragged_field_refused(self):
+        table = JaggedTable.from_dataframe(self.data.assign(range_area_decile=[[1.], [1., 2.], [3.]]))
+        self.assertRaises(ValueError, table.save, self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+"""Tests of the slow control cache, against a local stand-in for the slow control web API"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+import hax
+from hax import slow_control
+
+# The stand-in API has a measurement of every variable every MEASUREMENT_INTERVAL seconds
+MEASUREMENT_INTERVAL = 60
+T0 = 1500000000 // 86400 * 86400
+
+
+def measured_value(name, t):
+    return len(name) + t / 1000
+
+
+class FakeHistorianHandler(BaseHTTPRequestHandler):
+    """Answers GetSCData queries like the slow control web API, and records them in server.queries"""
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        name, start, end = params['name'], int(params['StartDateUnix']), int(params['EndDateUnix'])
+        self.server.queries.append((name, start, end))
+        first = -(-start // MEASUREMENT_INTERVAL) * MEASUREMENT_INTERVAL
+        body = json.dumps([dict(timestampseconds=t, value=measured_value(name, t))
+                           for t in range(first, end + 1, MEASUREMENT_INTERVAL)]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSlowControlCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), FakeHistorianHandler)
+        cls.server.queries = []
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.url = 'http://127.0.0.1:%d/GetSCData' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.old_config = dict(hax.config)
+        self.cache_dir = tempfile.mkdtemp()
+        hax.config.update(dict(sc_api_url=self.url, sc_api_username='test', sc_api_key='test',
+                               sc_max_concurrent_requests=2,
+                               sc_cache_dir=self.cache_dir, sc_cache_block_seconds=3600))
+        self.server.queries[:] = []
+        self.cache = slow_control.get_sc_cache()
+
+    def tearDown(self):
+        hax.config.clear()
+        hax.config.update(self.old_config)
+        shutil.rmtree(self.cache_dir)
+
+    def get(self, name, start, end):
+        return self.cache.get(name, start, end, fetch=slow_control._query_sc_api)
+
+    def check_values(self, data, name, start, end):
+        expected_times = np.arange(-(-start // MEASUREMENT_INTERVAL) * MEASUREMENT_INTERVAL, end + 1,
+                                   MEASUREMENT_INTERVAL)
+        np.testing.assert_array_equal(slow_control._to_unix_seconds(data.index), expected_times)
+        np.testing.assert_allclose(data.values, measured_value(name, expected_times))
+
+    def test_query_api(self):
+        data = slow_control._query_sc_api('XE1T.TEST', T0, T0 + 600)
+        self.check_values(data, 'XE1T.TEST', T0, T0 + 600)
+        self.assertEqual(self.server.queries, [('XE1T.TEST', T0, T0 + 600)])
+
+    def test_repeated_query_is_cached(self):
+        first = self.get('XE1T.TEST', T0 + 100, T0 + 10000)
+        second = self.get('XE1T.TEST', T0 + 100, T0 + 10000)
+        self.assertEqual(len(self.server.queries), 1)
+        self.check_values(second, 'XE1T.TEST', T0 + 100, T0 + 10000)
+        np.testing.assert_array_equal(first.values, second.values)
+        # Stored in blocks of an hour
+        self.assertEqual(len([f for f in os.listdir(self.cache._variable_dir('XE1T.TEST'))
+                              if f.endswith('.pklz')]), 3)
+
+    def test_only_missing_intervals_fetched(self):
+        self.get('XE1T.TEST', T0, T0 + 3600)
+        self.get('XE1T.TEST', T0 + 7200, T0 + 9000)
+        data = self.get('XE1T.TEST', T0 + 1800, T0 + 10000)
+        self.assertEqual(self.server.queries[2:], [('XE1T.TEST', T0 + 3601, T0 + 7199),
+                                                   ('XE1T.TEST', T0 + 9001, T0 + 10000)])
+        self.check_values(data, 'XE1T.TEST', T0 + 1800, T0 + 10000)
+        self.assertEqual(self.cache.covered_intervals('XE1T.TEST'), [[T0, T0 + 10000]])
+
+    def test_adjacent_intervals_coalesced(self):
+        self.get('XE1T.TEST', T0, T0 + 3600)
+        self.get('XE1T.TEST', T0 + 3601, T0 + 7200)
+        self.assertEqual(self.cache.covered_intervals('XE1T.TEST'), [[T0, T0 + 7200]])
+        data = self.get('XE1T.TEST', T0, T0 + 7200)
+        self.assertEqual(len(self.server.queries), 2)
+        self.check_values(data, 'XE1T.TEST', T0, T0 + 7200)
+
+    def test_variables_cached_separately(self):
+        self.get('XE1T.TEST', T0, T0 + 3600)
+        data = self.get('XE1T.OTHER', T0, T0 + 3600)
+        self.assertEqual([q[0] for q in self.server.queries], ['XE1T.TEST', 'XE1T.OTHER'])
+        self.check_values(data, 'XE1T.OTHER', T0, T0 + 3600)
+
+    def test_get_sc_data_many(self):
+        # Query by historian name directly, without the variable list
+        with mock.patch.object(slow_control, 'get_sc_name', side_effect=lambda name: name):
+            df = slow_control.get_sc_data_many(['XE1T.TEST', 'XE1T.OTHER'], start=T0, end=T0 + 3600)
+            slow_control.get_sc_data_many(['XE1T.TEST', 'XE1T.OTHER'], start=T0, end=T0 + 3600)
+        self.assertEqual(sorted(q[0] for q in self.server.queries), ['XE1T.OTHER', 'XE1T.TEST'])
+        self.assertEqual(list(df.columns), ['XE1T.TEST', 'XE1T.OTHER'])
+        self.check_values(df['XE1T.TEST'], 'XE1T.TEST', T0, T0 + 3600)
+
+
+class TestFindScRow(unittest.TestCase):
+    """Lookups by (part of a) description must find the same rows as scanning all descriptions"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.old_config = dict(hax.config)
+        hax.config['sc_variable_list'] = os.path.join(hax.hax_dir, 'sc_variables.csv')
+        slow_control.init_sc_interface()
+        cls.descriptions = slow_control.sc_variables['Description'].values
+
+    @classmethod
+    def tearDownClass(cls):
+        hax.config.clear()
+        hax.config.update(cls.old_config)
+
+    def scan(self, query):
+        return [i for i, x in enumerate(self.descriptions) if query in x]
+
+    def test_ambiguous_descriptions(self):
+        for query in ['10', 'gxe in', '000', 'fill', 'flux']:
+            self.assertGreater(len(self.scan(query)), 1)
+            self.assertRaises(slow_control.AmbiguousSlowControlMonikerException, slow_control._find_sc_row, query)
+
+    def check_query(self, query):
+        rows = self.scan(query)
+        if any(query in slow_control.sc_lookup[key] for key in slow_control.sc_exact_match_columns):
+            return
+        if len(rows) == 1:
+            self.assertEqual(slow_control._find_sc_row(query), rows[0])
+        elif len(rows) > 1:
+            self.assertRaises(slow_control.AmbiguousSlowControlMonikerException, slow_control._find_sc_row, query)
+        else:
+            self.assertRaises(slow_control.UnknownSlowControlMonikerException, slow_control._find_sc_row, query)
+
+    def test_unique_descriptions(self):
+        for description in self.descriptions:
+            words = description.split()
+            for query in [description] + [' '.join(words[i:i + n]) for n in (1, 2, 3) for i in range(len(words))]:
+                self.check_query(query)
+
+    def test_partial_words(self):
+        # Queries starting and ending in the middle of words
+        for description in self.descriptions[::7]:
+            for i in range(0, len(description), 5):
+                self.check_query(description[i:i + 9])
+                self.check_query(description[i:i + 3])
+        for query in ['pressure', 'cathode', 'xe', 'ssure', 'press', ' - ', 'nonexistent']:
+            self.check_query(query)
+
+    def test_get_sc_names(self):
+        names = ['PMT 000', 'PMT 001', 'PMT 000', 'nonexistent']
+        self.assertRaises(slow_control.UnknownSlowControlMonikerException, slow_control.get_sc_names, names)
+        result = slow_control.get_sc_names(names, errors='ignore')
+        self.assertEqual(result, [slow_control.get_sc_name(n) for n in names[:3]] + ['nonexistent'])
+
+
+class TestCoalesceIntervals(unittest.TestCase):
+
+    def test_coalesce(self):
+        self.assertEqual(slow_control.coalesce_intervals([[20, 30], [0, 10], [5, 12]]), [[0, 12], [20, 30]])
+        self.assertEqual(slow_control.coalesce_intervals([[0, 10], [11, 20]]), [[0, 20]])
+        self.assertEqual(slow_control.coalesce_intervals([[0, 10], [12, 20]]), [[0, 10], [12, 20]])
+        self.assertEqual(slow_control.coalesce_intervals([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()